@@ -0,0 +1,292 @@
+"""
+Benchmarks for Boris.
+
+Generates synthetic cycle-hire feeds of configurable sizes and, for each
+size, measures the time and peak memory taken to fetch and parse the feed,
+along with the latency of each type of query. Each size is benchmarked in
+its own process, so that peak memory figures are independent.
+
+Results are written as JSON so that runs can be compared:
+
+    $ python benchmarks/bench_boris.py --sizes 800 10000 --output new.json
+    $ python benchmarks/bench_boris.py --compare old.json new.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Process, Queue
+from SocketServer import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import boris
+
+STREETS = ["Alderney", "Arlington", "Bonny", "Bunhill", "Butler", "Charles",
+           "Christopher", "Church", "Earl's Court", "Finsbury", "Greenland",
+           "Howick", "Lodge", "Marlborough", "Moor", "Phillimore", "Queen's",
+           "Rochester", "Smith", "Vincent", "Warren", "Kingsway", "Temple"]
+KINDS = ["Street", "Road", "Square", "Place", "Row", "Lane", "Gardens"]
+AREAS = ["Pimlico", "Westminster", "Moorgate", "Camden Town", "Soho",
+         "Hyde Park", "Holborn", "Waterloo", "Borough", "Kensington",
+         "Chelsea", "Mayfair", "Marylebone", "Bloomsbury", "Shoreditch"]
+
+STATION = """    <station>
+        <id>%(id)d</id>
+        <name>%(name)s</name>
+        <terminalName>%(terminal)06d</terminalName>
+        <lat>%(lat).8f</lat>
+        <long>%(lng).8f</long>
+        <installed>true</installed>
+        <locked>%(locked)s</locked>
+        <installDate>1278241920000</installDate>
+        <removalDate/>
+        <temporary>%(temporary)s</temporary>
+        <nbBikes>%(bikes)d</nbBikes>
+        <nbEmptyDocks>%(empty)d</nbEmptyDocks>
+        <nbDocks>%(docks)d</nbDocks>
+    </station>
+"""
+
+
+def generate_feed(size, seed=0):
+    """
+    Generates a feed of `size` stations scattered around central London,
+    in the same format as the TFL feed.
+    """
+    rand = random.Random(seed)
+    now = int(time.time() * 1000)
+    parts = ['<stations lastUpdate="%d" version="2.0">\n' % now]
+    for i in xrange(size):
+        docks = rand.randint(10, 40)
+        bikes = rand.randint(0, docks)
+        name = "%s %s, %s" % (rand.choice(STREETS), rand.choice(KINDS),
+                              rand.choice(AREAS))
+        if i >= len(STREETS) * len(KINDS) * len(AREAS):
+            name = "%s %d" % (name, i)
+        parts.append(STATION % {
+            'id': i + 1, 'name': escape(name), 'terminal': 1000 + i,
+            'lat': rand.uniform(51.45, 51.55),
+            'lng': rand.uniform(-0.25, 0.0),
+            'locked': 'true' if rand.random() < 0.05 else 'false',
+            'temporary': 'true' if rand.random() < 0.1 else 'false',
+            'bikes': bikes, 'empty': docks - bikes, 'docks': docks})
+    parts.append('</stations>\n')
+    return ''.join(parts)
+
+
+class _FeedHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with open(self.server.path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _FeedServer(ThreadingMixIn, HTTPServer):
+    """ Serves a feed file over loopback HTTP """
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _FeedHandler)
+        self.path = path
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def percentiles(samples):
+    """ Summarises a list of latencies in seconds, as milliseconds """
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))]
+    return {'n': len(samples),
+            'mean_ms': 1000.0 * sum(samples) / len(samples),
+            'p50_ms': 1000.0 * pick(0.50),
+            'p90_ms': 1000.0 * pick(0.90),
+            'p99_ms': 1000.0 * pick(0.99),
+            'max_ms': 1000.0 * samples[-1]}
+
+def _time_calls(func, args_list):
+    samples = []
+    for args in args_list:
+        start = time.time()
+        func(*args)
+        samples.append(time.time() - start)
+    return percentiles(samples)
+
+def _typo(rand, name):
+    chars = list(name)
+    i = rand.randrange(len(chars))
+    if rand.random() < 0.5:
+        del chars[i]
+    else:
+        chars[i] = rand.choice('abcdefghijklmnopqrstuvwxyz')
+    return ''.join(chars)
+
+
+def run_size(path, size, source, queries, seed):
+    """ Benchmarks a single feed, returning a `dict` of results """
+    server = None
+    endpoint = path
+    if source == 'http':
+        server = _FeedServer(path)
+        endpoint = 'http://127.0.0.1:%d/feed.xml' % server.server_port
+
+    rss_before = _max_rss_kb()
+    bc = boris.BikeChecker(endpoint=endpoint)
+    start = time.time()
+    stations = bc.all(skip_cache=True)
+    load_time = time.time() - start
+    result = {'size': size, 'source': source,
+              'load_s': load_time,
+              'peak_rss_delta_kb': _max_rss_kb() - rss_before}
+
+    loads = []
+    for _ in range(3):
+        start = time.time()
+        bc.all(skip_cache=True)
+        loads.append(time.time() - start)
+    result['reload'] = percentiles(loads)
+
+    rand = random.Random(seed)
+    names = [s['name'] for s in rand.sample(stations, min(queries, size))]
+    points = [(rand.uniform(51.44, 51.56), rand.uniform(-0.26, 0.01))
+              for _ in range(queries)]
+    pairs = [(points[i], points[-i - 1]) for i in range(queries)]
+    fuzzy_queries = max(1, queries // 10)
+
+    result['queries'] = {
+        'get': _time_calls(bc.get, [(n,) for n in names]),
+        'get_fuzzy': _time_calls(lambda n: bc.get(n, fuzzy_matches=5),
+                                 [(_typo(rand, n),)
+                                  for n in names[:fuzzy_queries]]),
+        'find_with_geo': _time_calls(bc.find_with_geo, points),
+        'find_with_geo_predicate': _time_calls(
+            lambda lat, lng: bc.find_with_geo(
+                lat, lng, predicate=lambda x: x['nbBikes'] >= 5), points),
+        'find_k_nearest': _time_calls(lambda lat, lng:
+                                      bc.find_k_nearest(lat, lng, 5), points),
+        'haversine': _time_calls(boris._haversine, pairs),
+    }
+    bc.close()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    return result
+
+def _run_in_child(queue, *args):
+    try:
+        queue.put(run_size(*args))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+def run(sizes, source, queries, seed):
+    results = []
+    workdir = tempfile.mkdtemp(prefix='boris-bench-')
+    try:
+        for size in sizes:
+            path = os.path.join(workdir, 'feed-%d.xml' % size)
+            with open(path, 'wb') as f:
+                f.write(generate_feed(size, seed))
+            queue = Queue()
+            child = Process(target=_run_in_child,
+                            args=(queue, path, size, source, queries, seed))
+            child.start()
+            result = queue.get()
+            child.join()
+            result.setdefault('size', size)
+            result['feed_bytes'] = os.path.getsize(path)
+            os.remove(path)
+            results.append(result)
+            _report(result)
+    finally:
+        os.rmdir(workdir)
+    return {'python': sys.version.split()[0],
+            'numpy': boris.numpy is not None,
+            'timestamp': int(time.time()),
+            'results': results}
+
+
+def _report(result):
+    if 'error' in result:
+        print "%(size)8d stations: failed with %(error)s" % result
+        return
+    print "%8d stations: load %.3fs, reload p50 %.3fs, peak RSS +%d KB" % (
+        result['size'], result['load_s'], result['reload']['p50_ms'] / 1000,
+        result['peak_rss_delta_kb'])
+    for name, stats in sorted(result['queries'].items()):
+        print "    %-24s p50 %9.3fms  p90 %9.3fms  p99 %9.3fms" % (
+            name, stats['p50_ms'], stats['p90_ms'], stats['p99_ms'])
+
+def _flatten(run):
+    """ Maps (size, metric) to value for every metric in a run """
+    flat = {}
+    for result in run['results']:
+        if 'error' in result:
+            continue
+        size = result['size']
+        flat[(size, 'load_s')] = result['load_s']
+        flat[(size, 'reload_p50_ms')] = result['reload']['p50_ms']
+        flat[(size, 'peak_rss_delta_kb')] = result['peak_rss_delta_kb']
+        for name, stats in result['queries'].items():
+            flat[(size, name + '_p50_ms')] = stats['p50_ms']
+            flat[(size, name + '_p99_ms')] = stats['p99_ms']
+    return flat
+
+def compare(old_path, new_path):
+    """ Prints the ratio of each metric in two result files """
+    with open(old_path) as f:
+        old = _flatten(json.load(f))
+    with open(new_path) as f:
+        new = _flatten(json.load(f))
+    for key in sorted(set(old) & set(new)):
+        before, after = old[key], new[key]
+        ratio = after / before if before else float('inf')
+        print "%8d %-32s %12.4f -> %12.4f  (x%.2f)" % (key + (before, after,
+                                                           ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Boris.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[800, 10000, 100000],
+                        help='the numbers of stations to benchmark')
+    parser.add_argument('--source', choices=['file', 'http'], default='file',
+                        help='read the feed from a local file, or over '\
+                             'loopback HTTP')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='the number of each type of query to time')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the seed for generating feeds and queries')
+    parser.add_argument('--output', default='bench.json',
+                        help='the file to write JSON results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        results = run(args.sizes, args.source, args.queries, args.seed)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "Results written to %s" % args.output
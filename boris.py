@@ -1,14 +1,97 @@
 # -- coding: utf-8 --
 import datetime
+import bisect
+import csv
 import difflib
-from math import sin, cos, atan2, sqrt, radians
+import functools
+import hashlib
+import heapq
+import httplib
+import imp
+import importlib
+import json
+import marshal
+import mmap
+import operator
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import urlparse
+import zlib
+from collections import OrderedDict, deque
+from cStringIO import StringIO
+from itertools import count
+from multiprocessing.pool import ThreadPool
+from math import sin, cos, asin, atan2, sqrt, radians
 
-from lxml import etree
-from postcodes import PostCoder
+
+class _LazyModule(object):
+    """ A module that isn't imported until one of its attributes is used """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# NumPy and msgpack are optional, and NumPy is slow to import, so they are 
+# only imported when needed.
+try:
+    imp.find_module('numpy')
+except ImportError:
+    numpy = None
+else:
+    numpy = _LazyModule('numpy')
+
+try:
+    imp.find_module('msgpack')
+except ImportError:
+    msgpack = None
+else:
+    msgpack = _LazyModule('msgpack')
 
 # Configuration variables
 TFL_DATA_LOC = "http://www.tfl.gov.uk/tfl/syndication/feeds/cycle-hire/livecyclehireupdates.xml"
+# the expected interval between updates of the feed, until it has been 
+# observed, in milliseconds.
 CACHE_LIMIT = 180 * 1000
+# the feed is checked no more often than every MIN_REFRESH_INTERVAL ms; the 
+# interval doubles each time the feed is found unchanged (or can't be 
+# fetched), up to MAX_REFRESH_INTERVAL ms.
+MIN_REFRESH_INTERVAL = 30 * 1000
+MAX_REFRESH_INTERVAL = 10 * 60 * 1000
+# the number of intervals between feed updates the cadence is judged from
+CADENCE_SAMPLES = 8
+# the size, in degrees, of the cells stations are bucketed into for area
+# queries, and the fields that are totalled for named areas.
+GRID_CELL = 0.01
+AREA_FIELDS = ('nbBikes', 'nbEmptyDocks', 'nbDocks')
+# a refresh of federated feeds waits up to FEED_TIMEOUT seconds for them, 
+# before carrying on with the previous data of any that are slower.
+FEED_TIMEOUT = 5
+EARTH_RADIUS = 6371.0
+NAN = float('nan')
+# postcode lookups are cached for this many seconds (or, for unknown 
+# postcodes, for POSTCODE_NEGATIVE_TTL seconds), up to POSTCODE_CACHE_SIZE 
+# postcodes.
+POSTCODE_CACHE_SIZE = 4096
+POSTCODE_CACHE_TTL = 24 * 60 * 60
+POSTCODE_NEGATIVE_TTL = 60 * 60
+# the default number of stations a history file has room for
+HISTORY_CAPACITY = 2048
+# the number of refreshes for which changed stations are remembered
+CHANGE_LOG_SIZE = 100
+# the minimum number of candidate names scored by fuzzy matching
+FUZZY_CANDIDATES = 20
+# upper bound on the size of the distance matrix computed at once by 
+# batch queries.
+BATCH_CHUNK_SIZE = 1 << 20
 
 # dictionary for typing the web-service data
 boolean = lambda x: x.lower() == "true"
@@ -28,6 +111,26 @@ TAG_TYPES = {
                 'nbDocks': int
             }
 
+# the fields of a station record, in feed order
+STATION_FIELDS = ('id', 'name', 'terminalName', 'lat', 'long', 'installed', 
+                  'locked', 'installDate', 'removalDate', 'temporary', 
+                  'nbBikes', 'nbEmptyDocks', 'nbDocks')
+_STATION_SLOTS = frozenset(STATION_FIELDS)
+# the fields that few queries use, which are kept as the feed's text until 
+# one of them is first read. The rest are decoded as the feed is parsed.
+LAZY_FIELDS = ('terminalName', 'installed', 'locked', 'installDate', 
+               'removalDate', 'temporary')
+# separates the raw text of each lazy field, and stands in for absent fields; 
+# neither character may appear in XML.
+_RAW_SEPARATOR = '\x00'
+_RAW_ABSENT = '\x01'
+_LAZY_SLOTS = dict((field, pos) for pos, field in enumerate(LAZY_FIELDS))
+_EAGER_FIELDS = tuple(f for f in STATION_FIELDS if f not in _LAZY_SLOTS)
+
+# the comparisons subscriptions can be made with
+_OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, 
+              '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+
 def _time_ms(dt):
     """ Convert datetime into milliseconds since the epoch """
     epoch = datetime.datetime.utcfromtimestamp(0)
@@ -43,9 +146,368 @@ def _convert(element):
         value = TAG_TYPES.get(element.tag, unicode)(value)
     return (element.tag, value)
 
-def _parse_feed(endpoint):
-    """ Parses a web-feed and returns the root XML element """
-    return etree.parse(endpoint).getroot()
+def _is_url(endpoint):
+    """ Checks if `endpoint` is a web-service URL """
+    return isinstance(endpoint, basestring) and '://' in endpoint
+
+def _open_feed(endpoint):
+    """ 
+    Rewinds `endpoint` if it is a seekable file-like object, so that it 
+    can be read on every refresh.
+    """
+    if hasattr(endpoint, 'seek'):
+        endpoint.seek(0)
+    return endpoint
+
+def _parse_stations(endpoint):
+    """ 
+    Incrementally parses a web-feed, clearing each station's elements 
+    as soon as they have been read, so the full XML tree is never held 
+    in memory. The :data:`LAZY_FIELDS` of each station are left as text, 
+    to be decoded if they are ever used.
+
+    :returns: a tuple of the feed's ``lastUpdate`` attribute and a list 
+              of :class:`Station` records.
+    """
+    from lxml import etree
+    context = etree.iterparse(_open_feed(endpoint), events=('end',), 
+                              tag='station')
+    stations = []
+    for _, element in context:
+        station = Station()
+        raw = None
+        for child in element:
+            tag, value = child.tag, child.text
+            pos = _LAZY_SLOTS.get(tag)
+            if pos is not None:
+                if raw is None:
+                    raw = [_RAW_ABSENT] * len(LAZY_FIELDS)
+                raw[pos] = value or ''
+                continue
+            if value is not None:
+                value = TAG_TYPES.get(tag, unicode)(value)
+            if tag in _STATION_SLOTS:
+                setattr(station, tag, value)
+            else:
+                station[tag] = value
+        if raw is not None:
+            station._raw = _RAW_SEPARATOR.join(raw)
+            station._lazy = True
+        stations.append(station)
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return context.root.get("lastUpdate"), stations
+
+# the layout of a station record in a snapshot file: bitmasks of the fields 
+# that are present and that are null, followed by every field and the raw 
+# text of the lazy fields, with strings stored as an offset and length into 
+# the file's string table. Each station's strings are stored together, in 
+# that order.
+_SNAPSHOT_MAGIC = 'BORISSN2'
+_SNAPSHOT_HEADER = struct.Struct('<8sIqqII')
+_FIELD_CODES = {int: 'i', long: 'q', float: 'd', boolean: '?', unicode: 'II'}
+_SNAPSHOT_RECORD = struct.Struct('<HH' + ''.join(_FIELD_CODES[TAG_TYPES[f]] 
+                                                 for f in STATION_FIELDS) + 
+                                 'II')
+# set in the present bitmask of a station stored with its lazy fields' raw 
+# text, in which case they are not stored as fields.
+_SNAPSHOT_RAW = 1 << 15
+_STRING_FIELDS = frozenset(f for f in STATION_FIELDS 
+                           if TAG_TYPES[f] is unicode)
+
+def _record_indexes():
+    """ 
+    The bit and position in an unpacked record of each field (the 
+    position of a string's offset, which is followed by its length), and 
+    the position of the raw text's offset.
+    """
+    indexes, i = {}, 2
+    for bit, field in enumerate(STATION_FIELDS):
+        indexes[field] = bit, i
+        i += 2 if field in _STRING_FIELDS else 1
+    return indexes, i
+
+_RECORD_INDEXES, _RAW_INDEX = _record_indexes()
+# a station record without its string offsets, which differ from file to 
+# file, and where the offsets of its first string and raw text are.
+_FOOTPRINT_RECORD = struct.Struct('<HH' + ''.join(
+    '4xI' if f in _STRING_FIELDS else _FIELD_CODES[TAG_TYPES[f]] 
+    for f in STATION_FIELDS) + '4xI')
+_FIRST_STRING = struct.calcsize(
+    _SNAPSHOT_RECORD.format[:_SNAPSHOT_RECORD.format.index('II')])
+_RAW_STRING = _SNAPSHOT_RECORD.size - 8
+_STRING_SPAN = struct.Struct('<II')
+# what a station's place in the indexes depends on
+_LAYOUT_FIELDS = ('id', 'lat', 'long')
+_LAYOUT_MASK = sum(1 << _RECORD_INDEXES[f][0] 
+                   for f in _LAYOUT_FIELDS + ('name',))
+_LAYOUT_RECORD = struct.Struct('<HH' + ''.join(_FIELD_CODES[TAG_TYPES[f]] 
+                                               for f in _LAYOUT_FIELDS) + 'I')
+
+def _encode_snapshot(snapshot, expires=0):
+    """
+    Encodes `snapshot` in a compact binary format: a header, a fixed 
+    size record for each station, a table of the stations' strings, and 
+    any fields that aren't part of the usual feed, marshalled. Stations 
+    that still have the raw text of their :data:`LAZY_FIELDS` are stored 
+    with that text, so they decode as lazily as they were parsed.
+
+    :param expires: optional time in milliseconds after which the 
+                    snapshot should be refreshed.
+    """
+    records, strings, extras = [], [], []
+    offset = 0
+    for pos, station in enumerate(snapshot.stations):
+        raw = getattr(station, '_raw', None)
+        present = null = 0
+        values = []
+        for bit, field in enumerate(STATION_FIELDS):
+            # lazy fields are stored as their raw text, so aren't decoded
+            value = None
+            if (raw is None or field not in _LAZY_SLOTS) and field in station:
+                present |= 1 << bit
+                value = station[field]
+                if value is None:
+                    null |= 1 << bit
+            if field in _STRING_FIELDS:
+                data = (value or u'').encode('utf-8')
+                values.extend((offset, len(data)))
+                strings.append(data)
+                offset += len(data)
+            else:
+                values.append(value or 0)
+        data = ''
+        if raw is not None:
+            present |= _SNAPSHOT_RAW
+            data = raw.encode('utf-8')
+            strings.append(data)
+        values.extend((offset, len(data)))
+        offset += len(data)
+        records.append(_SNAPSHOT_RECORD.pack(present, null, *values))
+        if isinstance(station, Station):
+            extra = (station._extra or {}).items()
+        else:
+            extra = [(k, v) for k, v in station.items() 
+                     if k not in _STATION_SLOTS]
+        if extra:
+            extras.append((pos, extra))
+    header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, snapshot.version, 
+                                   long(snapshot.last_updated), long(expires), 
+                                   len(records), offset)
+    return ''.join([header] + records + strings + [marshal.dumps(extras)])
+
+def _read_snapshot_header(data):
+    """ 
+    The version, ``lastUpdate`` time, expiry time, number of stations 
+    and string table size of an encoded snapshot.
+    """
+    if len(data) < _SNAPSHOT_HEADER.size:
+        raise StationDataException("Truncated snapshot")
+    header = _SNAPSHOT_HEADER.unpack_from(data)
+    if header[0] != _SNAPSHOT_MAGIC:
+        raise StationDataException("Not a snapshot")
+    return header[1:]
+
+class _SnapshotView(object):
+    """
+    A snapshot encoded by :func:`_encode_snapshot`, read in place from a 
+    string or buffer, such as an `mmap`: each station's record is only 
+    unpacked when it is used.
+
+    :param data: the encoded snapshot.
+    """
+
+    def __init__(self, data):
+        (self.version, self.last_updated, self.expires, self.count, 
+         size) = _read_snapshot_header(data)
+        self._table = _SNAPSHOT_HEADER.size + \
+                      self.count * _SNAPSHOT_RECORD.size
+        if len(data) < self._table + size:
+            raise StationDataException("Truncated snapshot")
+        self.data = data
+        self.extras = dict(marshal.loads(data[self._table + size:]))
+
+    def record(self, pos):
+        """ The unpacked record of the station at `pos` """
+        return _SNAPSHOT_RECORD.unpack_from(self.data, _SNAPSHOT_HEADER.size + 
+                                            pos * _SNAPSHOT_RECORD.size)
+
+    def _string(self, values, i):
+        """ The bytes of the string whose offset is at `values[i]` """
+        start = self._table + values[i]
+        return self.data[start:start + values[i + 1]]
+
+    def _texts(self, values):
+        """ The raw text of each lazy field of a record, if it has any """
+        if values[0] & _SNAPSHOT_RAW:
+            text = self._string(values, _RAW_INDEX).decode('utf-8')
+            return text.split(_RAW_SEPARATOR)
+
+    def _value(self, values, field, texts=None):
+        """ 
+        The value of `field` in a record, decoded from the raw `texts` 
+        for lazy fields if given, or ``_RAW_ABSENT`` if it is missing.
+        """
+        if texts is not None and field in _LAZY_SLOTS:
+            text = texts[_LAZY_SLOTS[field]]
+            if text == _RAW_ABSENT:
+                return _RAW_ABSENT
+            return TAG_TYPES[field](text) if text else None
+        bit, i = _RECORD_INDEXES[field]
+        if not values[0] >> bit & 1:
+            return _RAW_ABSENT
+        if values[1] >> bit & 1:
+            return None
+        if field in _STRING_FIELDS:
+            return self._string(values, i).decode('utf-8')
+        return values[i]
+
+    def field(self, pos, field):
+        """ 
+        The value of the `field` of the station at `pos`.
+
+        :raises AttributeError: if the station doesn't have the field.
+        """
+        values = self.record(pos)
+        texts = self._texts(values) if field in _LAZY_SLOTS else None
+        value = self._value(values, field, texts)
+        if value is _RAW_ABSENT:
+            raise AttributeError(field)
+        return value
+
+    def items(self, pos):
+        """ The known fields of the station at `pos`, in feed order """
+        values = self.record(pos)
+        texts = self._texts(values)
+        items = []
+        for field in STATION_FIELDS:
+            value = self._value(values, field, texts)
+            if value is not _RAW_ABSENT:
+                items.append((field, value))
+        return items
+
+    def footprint(self, pos):
+        """ 
+        The record of the station at `pos` without its string offsets, 
+        and the bytes of its strings, which together identify its data 
+        whatever file it is stored in.
+        """
+        record = _SNAPSHOT_HEADER.size + pos * _SNAPSHOT_RECORD.size
+        start = _STRING_SPAN.unpack_from(self.data, record + _FIRST_STRING)[0]
+        end = sum(_STRING_SPAN.unpack_from(self.data, record + _RAW_STRING))
+        return (_FOOTPRINT_RECORD.unpack_from(self.data, record), 
+                self.data[self._table + start:self._table + end])
+
+    def layout(self):
+        """ 
+        A digest of every station's id, name and position, which the 
+        indexes of the stations are built from.
+        """
+        digest = hashlib.sha1()
+        name = _RECORD_INDEXES['name'][1]
+        for pos in xrange(self.count):
+            values = self.record(pos)
+            digest.update(_LAYOUT_RECORD.pack(
+                values[0] & _LAYOUT_MASK, values[1] & _LAYOUT_MASK, 
+                *[values[_RECORD_INDEXES[f][1]] for f in _LAYOUT_FIELDS] + 
+                [values[name + 1]]))
+            digest.update(self._string(values, name))
+        return digest.digest()
+
+    def station(self, pos):
+        """ 
+        The station at `pos` decoded into a :class:`Station`, with any 
+        lazy fields left as raw text.
+        """
+        values = self.record(pos)
+        raw = values[0] & _SNAPSHOT_RAW
+        station = Station()
+        for field in _EAGER_FIELDS if raw else STATION_FIELDS:
+            value = self._value(values, field)
+            if value is not _RAW_ABSENT:
+                setattr(station, field, value)
+        if raw:
+            station._raw = self._string(values, _RAW_INDEX).decode('utf-8')
+            station._lazy = True
+        if pos in self.extras:
+            station._extra = dict(self.extras[pos])
+        return station
+
+def _decode_snapshot(data):
+    """
+    Decodes a snapshot encoded by :func:`_encode_snapshot` from a string 
+    or buffer, such as an `mmap`.
+
+    :returns: a tuple of the snapshot's version, ``lastUpdate`` time, 
+              expiry time and list of :class:`Station` records.
+    """
+    view = _SnapshotView(data)
+    stations = [view.station(pos) for pos in xrange(view.count)]
+    return view.version, view.last_updated, view.expires, stations
+
+def _dump_json(station):
+    """ A station record as compact JSON """
+    return json.dumps(dict(station), separators=(',', ':'))
+
+def _dump_msgpack(station):
+    """ A station record as MessagePack """
+    # byte strings are packed as binary, so field names and any text read 
+    # as a byte string are packed as unicode.
+    text = lambda x: x.decode('utf-8') if isinstance(x, str) else x
+    return msgpack.packb(dict((text(k), text(v)) for k, v in 
+                              station.items()), use_bin_type=True)
+
+def _join_json(parts):
+    return '[%s]' % ','.join(parts)
+
+def _join_msgpack(parts):
+    # a MessagePack array is its header followed by its packed items
+    header = msgpack.Packer(use_bin_type=True).pack_array_header(len(parts))
+    return header + ''.join(parts)
+
+# the formats station data can be serialised to, as the functions encoding a 
+# single station and joining encoded stations into an array.
+SERIAL_FORMATS = {
+    'json': (_dump_json, _join_json),
+    'msgpack': (_dump_msgpack, _join_msgpack),
+}
+
+def _check_format(format):
+    """ Raises `ValueError` for an unknown serialisation format """
+    if format not in SERIAL_FORMATS:
+        raise ValueError("Unknown format %r" % format)
+    if format == 'msgpack' and msgpack is None:
+        raise ValueError("The msgpack format requires msgpack-python")
+
+def _normalise_postcode(postcode):
+    """ Normalises the spacing and case of a postcode """
+    return ''.join(postcode.split()).upper()
+
+def load_postcode_centroids(path):
+    """
+    Loads a table of postcode centroids from a CSV file of 
+    ``postcode,latitude,longitude`` rows. Rows that don't hold a valid 
+    point, such as a header row, are skipped.
+
+    :param path: the path of the CSV file.
+
+    :returns: a `dict` mapping normalised postcodes to (lat, lng) tuples.
+    """
+    centroids = {}
+    with open(path, 'rb') as f:
+        for row in csv.reader(f):
+            try:
+                postcode, lat, lng = row[0], float(row[1]), float(row[2])
+            except (IndexError, ValueError):
+                continue
+            if _is_geo_valid(lat, lng):
+                centroids[_normalise_postcode(postcode)] = (lat, lng)
+    return centroids
+
+def _as_float(value):
+    """ Converts a station's field value to a float, or `NaN` if missing """
+    return NAN if value is None else float(value)
 
 def _is_geo_valid(lat, lng):
     """ Checks if geographical point valid """
@@ -82,205 +544,3025 @@ def _haversine(first, second):
     :returns: the distance in km between two points.
     """
     for point in (first, second):
-        if not _is_geo_valid(*point):
-            msg = "(%s, %s) is not a valid decimal lat/lng" % point
-            raise IllegalPointException(msg)
+        _check_point(*point)
+    return _great_circle(first, second)
+
+def _check_point(lat, lng):
+    """ Raises :class:`IllegalPointException` for an invalid point """
+    if not _is_geo_valid(lat, lng):
+        msg = "(%s, %s) is not a valid decimal lat/lng" % (lat, lng)
+        raise IllegalPointException(msg)
 
+def _polygon(polygon):
+    """ Validates a polygon, as a tuple of (latitude, longitude) tuples """
+    polygon = tuple((float(lat), float(lng)) for lat, lng in polygon)
+    if len(polygon) < 3:
+        raise IllegalPointException("A polygon needs at least 3 vertices")
+    for point in polygon:
+        _check_point(*point)
+    return polygon
+
+def _great_circle(first, second):
+    """ 
+    The haversine distance in km between two points that are already 
+    known to be valid. See :func:`_haversine`.
+    """
     lat_1 = radians(first[0])
     lat_2 = radians(second[0])
     d_lat = radians(second[0] - first[0])
     d_lng = radians(second[1] - first[1])
-    R = 6371.0
     a = pow(sin(d_lat / 2.0), 2) + cos(lat_1) * cos(lat_2) * \
         pow(sin(d_lng / 2.0), 2)
     c = 2.0 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c
+    return EARTH_RADIUS * c
 
+def _to_unit(lat, lng):
+    """ Projects a (lat, lng) point onto the unit sphere """
+    lat, lng = radians(lat), radians(lng)
+    return (cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat))
 
-class BikeChecker(object):
-    """
-    The BikeChecker object allows you to access Barclay's Bike 
-    availabily.
+def _chord_to_km(sq_chord):
+    """ Great-circle distance in km for a squared chord on the unit sphere """
+    return 2.0 * EARTH_RADIUS * asin(min(1.0, sqrt(sq_chord) / 2.0))
 
-    It maintains the most recent availabily data, so you don't need 
-    to worry about refreshing the data source; simply use the methods 
-    provided to access bike data and the :class:`boris.BikeChecker` 
-    class will take care of whether to request new bike availabily data.
 
-    :param url: optional web-service url. You _may_ need to change this
-                if `TFL`_ change the endpoint in the future.
+class _SpatialIndex(object):
+    """
+    A k-d tree over the stations of a single snapshot.
 
-    .. _TFL: http://www.tfl.gov.uk/
+    Stations are projected onto the unit sphere, where the straight-line 
+    (chord) distance between two points grows monotonically with their 
+    great-circle distance. The tree is therefore searched using ordinary 
+    euclidean bounds, but the distances it reports are always the exact 
+    :func:`_haversine` values.
 
-    :returns: a list of dictionaries containing bike station data
+    Stations without a valid position are left out of the index.
     """
 
-    def __init__(self, endpoint=None):
-        self.pc = PostCoder()
-        self._last_updated = 0
-        self._etree = None
-        self._stations_lst = []
-        self._stations_map = {}
-        self.endpoint = endpoint or TFL_DATA_LOC
+    LEAF_SIZE = 8
 
-    def _process_stations(self):
-        stations = _parse_feed(self.endpoint)
-        self._last_updated = long(stations.get("lastUpdate"))
-        self._stations_lst = [dict(_convert(e) for e in st) for st in stations] 
-        if not self._stations_lst:
-            raise InvalidDataException("No Station data available")
-        for station in self._stations_lst:
-            self._stations_map[station['name'].lower()] = station
+    # node bounds are lowered by this many km to absorb rounding errors, so
+    # that a node is never pruned before a point at an equal distance.
+    SLACK = 1e-6
 
-    @property
-    def last_updated(self):
-        if self._last_updated:
-            return datetime.datetime.fromtimestamp(self._last_updated / 1000)
+    def __init__(self, stations):
+        self.stations = stations
+        self._geo = [None] * len(stations)
+        points = []
+        for pos, station in enumerate(stations):
+            lat, lng = station.get('lat'), station.get('long')
+            if lat is None or lng is None or not _is_geo_valid(lat, lng):
+                continue
+            self._geo[pos] = (lat, lng)
+            points.append((_to_unit(lat, lng), pos))
+        self._root = self._build(points) if points else None
+        self._columns = None
 
-    def all(self, skip_cache=False):
-        """
-        Gets all available bike data.
+    def point(self, pos):
+        """ The (latitude, longitude) of a position, if it is valid """
+        return self._geo[pos]
 
-        :param skip_cache: optional argument specifying whether to 
-                           check the cache (default) or skip it and 
-                           explicitly request fresh data.
+    def _build(self, points):
+        """
+        Builds a tree node, which is a tuple of the node's bounding box 
+        (``lo`` and ``hi`` corners), its children and, for leaves only, 
+        the station positions it holds.
+        """
+        lo = tuple(min(p[0][i] for p in points) for i in range(3))
+        hi = tuple(max(p[0][i] for p in points) for i in range(3))
+        if len(points) <= self.LEAF_SIZE:
+            return (lo, hi, None, None, [p[1] for p in points])
+        axis = max(range(3), key=lambda i: hi[i] - lo[i])
+        points.sort(key=lambda p: p[0][axis])
+        mid = len(points) // 2
+        return (lo, hi, self._build(points[:mid]), 
+                self._build(points[mid:]), None)
 
-        :returns: a list of dictionaries describing current status of 
-                  bike stations
+    def rebind(self, stations):
         """
-        now = _time_ms(datetime.datetime.utcnow())
-        if skip_cache or now - self._last_updated > CACHE_LIMIT:
-            self._process_stations()
-        return self._stations_lst
+        A copy of the index for a new list of `stations`, which must 
+        have the same positions as the stations it was built from.
+        """
+        index = object.__new__(_SpatialIndex)
+        index.__dict__.update(self.__dict__)
+        index.stations = stations
+        return index
 
-    def get(self, name, fuzzy_matches=0, skip_cache=False):
+    def nearest(self, lat, lng, accept=None):
         """
-        Availability information for the station(s) matching `name`.
+        Lazily yields ``(distance, position)`` pairs for indexed stations 
+        in order of increasing distance from (`lat`, `lng`), breaking 
+        ties on position. 
 
-        `get` allows fuzzy matching of stations based on their name, and 
-        returns up to `fuzzy_matches` stations; a station's inclusion 
-        is dependent on how close its name is to `name`, based on the 
-        result of the `Ratcliff/Obershelp`_ algorithm.
+        :param accept: optional callable taking a station position, 
+                       which must return `True` for the station to be 
+                       yielded.
+        """
+        if self._root is None:
+            return
+        origin = (lat, lng)
+        q = _to_unit(lat, lng)
+        # entries are (key, kind, position or node number, node); nodes 
+        # (kind 0) are expanded before any point (kind 1) sharing their key.
+        serial = count(1)
+        heap = [(0.0, 0, 0, self._root)]
+        while heap:
+            key, kind, pos, node = heapq.heappop(heap)
+            if kind:
+                yield key, pos
+                continue
+            lo, hi, left, right, leaf = node
+            if leaf is not None:
+                for pos in leaf:
+                    if accept is None or accept(pos):
+                        dist = _great_circle(origin, self._geo[pos])
+                        heapq.heappush(heap, (dist, 1, pos, None))
+                continue
+            for child in (left, right):
+                bound = self._bound(q, child[0], child[1])
+                heapq.heappush(heap, (bound, 0, next(serial), child))
 
-        .. _Ratcliff/Obershelp: http://xlinux.nist.gov/dads/HTML/ratcliffObershelp.html
+    def columns(self):
+        """
+        Contiguous NumPy arrays of the positions, latitudes and 
+        longitudes of the indexed stations, built on first use.
+        """
+        if self._columns is None:
+            valid = [pos for pos, geo in enumerate(self._geo) if geo]
+            self._columns = (
+                numpy.array(valid, dtype=numpy.intp),
+                numpy.array([self._geo[p][0] for p in valid], dtype=float),
+                numpy.array([self._geo[p][1] for p in valid], dtype=float))
+        return self._columns
 
-        :param name: the name of the bike station
+    def nearest_batch(self, points, k, accept=None, mask=None):
+        """
+        The `k` nearest indexed stations to each of `points`, computed 
+        as vectorised haversine distances over chunks of `points` so 
+        that no more than :data:`BATCH_CHUNK_SIZE` distances are held 
+        at once.
 
-        :param fuzzy_matches: optional argument specifying how many 
-                              fuzzy matches to return. By default 
-                              `fuzzy_matches` is 0 and so `get` will 
-                              return an empty list if `name` does not 
-                              exactly match a station name.
+        :param accept: optional callable taking a station position, 
+                       which must return `True` for the station to be 
+                       considered.
 
-        :param skip_cache: optional argument specifying whether to 
-                           check the cache (default) or skip it and 
-                           explicitly request fresh data.
+        :param mask: optional boolean array, alternative to `accept`, 
+                     which is `True` at the positions of the stations 
+                     to be considered.
 
-        :returns: a list of station availability data ordered by how 
-                  closely the station name matches `name`.
+        :returns: a list holding, for each point, a list of up to `k` 
+                  ``(distance, position)`` pairs, nearest first.
         """
-        now = _time_ms(datetime.datetime.utcnow())
-        if skip_cache or now - self._last_updated > CACHE_LIMIT:
-            self._process_stations()
+        positions, lats, lngs = self.columns()
+        if accept is not None:
+            mask = numpy.array([accept(p) for p in positions], dtype=bool)
+            keep = mask
+        elif mask is not None:
+            keep = mask[positions]
+        if mask is not None:
+            positions, lats, lngs = positions[keep], lats[keep], lngs[keep]
+        n = len(positions)
+        if not n or k < 1:
+            return [[] for _ in points]
+        k = min(k, n)
+        st_lat, st_cos = numpy.radians(lats), numpy.cos(numpy.radians(lats))
+        rows = max(1, BATCH_CHUNK_SIZE // n)
+        results = []
+        for start in xrange(0, len(points), rows):
+            chunk = numpy.array(points[start:start + rows], dtype=float)
+            q_lat, q_lng = chunk[:, 0:1], chunk[:, 1:2]
+            d_lat = numpy.radians(lats - q_lat)
+            d_lng = numpy.radians(lngs - q_lng)
+            a = numpy.sin(d_lat / 2.0) ** 2 + \
+                numpy.cos(numpy.radians(q_lat)) * st_cos * \
+                numpy.sin(d_lng / 2.0) ** 2
+            dist = 2.0 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+            if k < n:
+                nearest = numpy.argpartition(dist, k - 1, axis=1)[:, :k]
+            else:
+                nearest = numpy.tile(numpy.arange(n), (len(chunk), 1))
+            for point, cols in zip(points[start:start + rows], nearest):
+                # report exactly the distances the scalar queries would
+                found = [(_great_circle(point, self._geo[p]), p) 
+                         for p in positions[cols].tolist()]
+                found.sort()
+                results.append(found)
+        return results
 
-        name = name.strip().lower()
-        station = self._stations_map.get(name, None)
-        if station is None:
-            if not fuzzy_matches:
-                return []
-            names = self._stations_map.keys()
-            matches = difflib.get_close_matches(name, names, n=fuzzy_matches, 
-                                                cutoff=0)
-            if matches:
-                return [self._stations_map[x] for x in matches]
-        else:
-            return [station]
+    def _bound(self, q, lo, hi):
+        """ Lower bound in km from `q` to any point in the box (lo, hi) """
+        sq = 0.0
+        for i in range(3):
+            if q[i] < lo[i]:
+                sq += (lo[i] - q[i]) ** 2
+            elif q[i] > hi[i]:
+                sq += (q[i] - hi[i]) ** 2
+        return max(0.0, _chord_to_km(sq) - self.SLACK)
 
-    def find_with_geo(self, lat, lng, predicate=None, skip_cache=False):
+
+def _in_polygon(lat, lng, polygon):
+    """ 
+    Whether (`lat`, `lng`) is inside `polygon`, a sequence of (latitude, 
+    longitude) vertices, by the even-odd rule.
+    """
+    inside = False
+    lat_j, lng_j = polygon[-1]
+    for lat_i, lng_i in polygon:
+        if (lat_i > lat) != (lat_j > lat) and \
+           lng < (lng_j - lng_i) * (lat - lat_i) / (lat_j - lat_i) + lng_i:
+            inside = not inside
+        lat_j, lng_j = lat_i, lng_i
+    return inside
+
+
+class _GridIndex(object):
+    """
+    Buckets station positions into cells of :data:`GRID_CELL` degrees 
+    of latitude and longitude, so that the stations in a box can be 
+    found by looking only at the cells the box overlaps.
+
+    :param stations: a list of station records.
+    """
+
+    def __init__(self, stations):
+        self.cell = GRID_CELL
+        self._points = [None] * len(stations)
+        self.cells = {}
+        for pos, station in enumerate(stations):
+            lat = _as_float(station.get('lat'))
+            lng = _as_float(station.get('long'))
+            if lat != lat or lng != lng or not _is_geo_valid(lat, lng):
+                continue
+            self._points[pos] = (lat, lng)
+            self.cells.setdefault(self._key(lat, lng), []).append(pos)
+
+    def _key(self, lat, lng):
+        return int(lat // self.cell), int(lng // self.cell)
+
+    def point(self, pos):
+        """ The (latitude, longitude) of a position, if it is valid """
+        return self._points[pos]
+
+    def in_bbox(self, south, west, north, east):
+        """ 
+        The positions of the stations in a box, in order. Boxes with 
+        `west` greater than `east` cross the 180th meridian.
         """
-        Availability information for the nearest station to 
-        (`lat`, `lng`). Using `predicate` you can ensure that any 
-        returned stations also satisfy certain properties.
+        if west > east:
+            return sorted(self.in_bbox(south, west, north, 180.0) + 
+                          self.in_bbox(south, -180.0, north, east))
+        lo_i, lo_j = self._key(south, west)
+        hi_i, hi_j = self._key(north, east)
+        if (hi_i - lo_i + 1) * (hi_j - lo_j + 1) > len(self.cells):
+            keys = [(i, j) for i, j in self.cells 
+                    if lo_i <= i <= hi_i and lo_j <= j <= hi_j]
+        else:
+            keys = [(i, j) for i in xrange(lo_i, hi_i + 1) 
+                    for j in xrange(lo_j, hi_j + 1)]
+        found = []
+        for key in keys:
+            for pos in self.cells.get(key, ()):
+                lat, lng = self._points[pos]
+                if south <= lat <= north and west <= lng <= east:
+                    found.append(pos)
+        found.sort()
+        return found
 
-        For example, ensuring there are at least five bikes available:
+    def in_polygon(self, polygon):
+        """ The positions of the stations inside `polygon`, in order """
+        lats = [lat for lat, _ in polygon]
+        lngs = [lng for _, lng in polygon]
+        return [pos for pos in self.in_bbox(min(lats), min(lngs), 
+                                            max(lats), max(lngs)) 
+                if _in_polygon(self._points[pos][0], self._points[pos][1], 
+                               polygon)]
 
-        >>> bc = BikeChecker()
-        >>> bike_predicate = lambda x: x['nbBikes'] >= 4 
-        >>> bc.find_with_geo(51.49, -0.19, predicate=bike_predicate)
-        >>> # results here.
 
-        :param lat: latidude of position
+def _trigrams(text):
+    """ The set of character trigrams in `text`, padded at the ends """
+    text = '  %s ' % text
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
 
-        :param lng: longitude of position
 
-        :parma predicate: optional argument specifying a predicate 
-                          which must be satisfied by any station 
-                          returned.
+class _NameIndex(object):
+    """
+    A trigram inverted index over (lower-cased) station names.
 
-        :param skip_cache: optional argument specifying whether to 
-                           check the cache (default) or skip it and 
-                           explicitly request fresh data.
+    Fuzzy matching uses the index to pick out the handful of names that 
+    share the most trigrams with the query, and only scores those with 
+    the much more expensive `Ratcliff/Obershelp`_ algorithm. Word-start 
+    prefixes are kept sorted for autocompletion.
 
-        :returns: a `dict` containing an availability `dict` for the 
-                  nearest station, as well as the distance to that 
-                  station in kilometres. If no stations satisfy 
-                  `predicate`, and empty `dict` is returned.
+    .. _Ratcliff/Obershelp: http://xlinux.nist.gov/dads/HTML/ratcliffObershelp.html
+    """
+
+    def __init__(self, names):
+        self.names = sorted(names)
+        self._grams = [_trigrams(name) for name in self.names]
+        self._postings = {}
+        for i, grams in enumerate(self._grams):
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(i)
+        # every name, plus every tail of a name starting at a new word, 
+        # paired with the name's position.
+        self._prefixes = []
+        for i, name in enumerate(self.names):
+            for start, char in enumerate(name):
+                if start == 0 or (char.isalnum() and 
+                                  not name[start - 1].isalnum()):
+                    self._prefixes.append((name[start:], start, i))
+        self._prefixes.sort()
+
+    def candidates(self, word, n):
+        """ 
+        The (at least `n`) names most likely to be close matches for 
+        `word`, ranked by the trigram similarity of the two. 
         """
-        now = _time_ms(datetime.datetime.utcnow())
-        if skip_cache or now - self._last_updated > CACHE_LIMIT:
-            self._process_stations()
-
-        if predicate is None: 
-            predicate = lambda x: True
-        if not self._stations_lst: 
-            self._process_stations()
-
-        near, near_dist = None, None
-        for station in self._stations_lst:
-            st_geo = (station['lat'], station['long'])
-            station_dist = _haversine((lat, lng), st_geo)
-            if predicate(station) and \
-               (not near_dist or station_dist < near_dist):
-                near, near_dist = station, station_dist
-        return {'station': near, 'distance': near_dist} if near else {}
+        grams = _trigrams(word)
+        shared = {}
+        for gram in grams:
+            for i in self._postings.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        if len(shared) < n:
+            return self.names
+        score = lambda i: shared[i] / float(len(grams) + len(self._grams[i]))
+        best = heapq.nlargest(n, shared, key=score)
+        return [self.names[i] for i in best]
 
-    def find_with_postcode(self, postcode, predicate=None, skip_cache=False):
+    def close_matches(self, word, n):
+        """
+        Up to `n` names closest to `word`, best first. This ranks names 
+        exactly as :func:`difflib.get_close_matches` would with a 
+        `cutoff` of 0, but only amongst the indexed candidates.
+        """
+        candidates = self.candidates(word, max(n, FUZZY_CANDIDATES))
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        scored = []
+        for name in candidates:
+            matcher.set_seq1(name)
+            scored.append((matcher.ratio(), name))
+        return [name for _, name in heapq.nlargest(n, scored)]
+
+    def complete(self, prefix, limit):
+        """
+        Up to `limit` names that start with `prefix`, or contain a word 
+        starting with it. Names starting with `prefix` come first, and 
+        otherwise names are in alphabetical order.
+        """
+        lo = bisect.bisect_left(self._prefixes, (prefix,))
+        found = []
+        for tail, start, i in self._prefixes[lo:]:
+            if not tail.startswith(prefix):
+                break
+            found.append((start != 0, i))
+        seen, names = set(), []
+        for _, i in sorted(found):
+            if i not in seen:
+                seen.add(i)
+                names.append(self.names[i])
+                if len(names) == limit:
+                    break
+        return names
+
+
+class _PostcodeCache(object):
+    """
+    A thread-safe, least-recently-used cache of postcode locations, 
+    whose entries expire after a time-to-live. Unknown postcodes are 
+    cached too, as `None`, with a (usually shorter) time-to-live of 
+    their own.
+    """
+
+    def __init__(self, size=None, ttl=None, negative_ttl=None):
+        self.size = POSTCODE_CACHE_SIZE if size is None else size
+        self.ttl = POSTCODE_CACHE_TTL if ttl is None else ttl
+        self.negative_ttl = POSTCODE_NEGATIVE_TTL if negative_ttl is None \
+                            else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
         """ 
-        Availability information for the nearest station to `postcode`.
+        :returns: a tuple of whether `key` was found, and its location.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return False, None
+            self._entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
 
-        Using `predicate` you can ensure that any returned stations 
-        also satisfy certain properties, for example that they have a 
-        certain number of bikes available.
+    def put(self, key, location):
+        ttl = self.ttl if location is not None else self.negative_ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, location)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
 
-        :param postcode: the postcode to search
+    def __len__(self):
+        return len(self._entries)
 
-        :parma predicate: optional argument specifying a predicate 
-                          which must be satisfied by any station 
-                          returned.
 
-        :param skip_cache: optional argument specifying whether to 
-                           check the cache (default) or skip it and 
-                           explicitly request fresh data.
+class _Snapshot(object):
+    """
+    The station data from a single fetch of the feed, along with the 
+    structures derived from it. A snapshot is never modified once it 
+    has been built; a refresh builds a new one and swaps it in, so a 
+    query that holds on to a snapshot always sees consistent data.
 
-        :returns: a `dict` containing an availability `dict` for the 
-                  nearest station, as well as  the distance to that 
-                  station in kilometres. If no stations satisfy 
-                  `predicate`, and empty `dict` is returned.
+    When built from a `previous` snapshot, stations are matched up by 
+    ``id``: the records of unchanged stations are carried over, and the 
+    ids of changed and removed stations are noted. The name and spatial 
+    indexes are built when first used, and only rebuilt if a station's 
+    name or position changed, or stations were added, removed or 
+    reordered.
+
+    :param last_updated: the feed's ``lastUpdate`` time in milliseconds.
+
+    :param stations: a list of station records.
+
+    :param previous: optional snapshot that this one replaces.
+    """
+
+    # whether unchanged stations are replaced by those of `previous`
+    _carry_stations = True
+
+    def __init__(self, last_updated=0, stations=(), previous=None):
+        self.last_updated = last_updated
+        self.stations = list(stations)
+        self.masks = {}
+        self.totals = {}
+        self._columns = {}
+        self._encoded, self._dumps = {}, {}
+        self.by_id = {}
+        self.changed, self.removed = set(), set()
+        self.version = 0
+        if previous is not None:
+            self._merge(previous)
+        for station in self.stations:
+            if station.get('id') is not None:
+                self.by_id[station['id']] = station
+        if previous is not None:
+            self._carry_encoded(previous)
+
+        self._layout = self._read_layout()
+        self._index = None
+        if previous is not None and self._layout == previous._layout:
+            self._read_names(previous)
+            self._indexes = previous._indexes
+            return
+
+        self._read_names()
+        # the indexes are built on first use, and shared by every snapshot 
+        # with the same layout.
+        self._indexes = {}
+
+    def _read_layout(self):
+        """ The id, name and position of every station """
+        return [(s.get('id'), s.get('name'), s.get('lat'), s.get('long')) 
+                for s in self.stations]
+
+    def _read_names(self, previous=None):
+        """ 
+        Maps the stations' lowercased names to the stations, starting 
+        from the names of `previous` if it has the same layout.
         """
-        now = _time_ms(datetime.datetime.utcnow())
-        if skip_cache or now - self._last_updated > CACHE_LIMIT:
-            self._process_stations()
+        if previous is not None:
+            self.names = dict(previous.names)
+            for station in self.stations:
+                name = station.get('name')
+                if name is not None and station.get('id') in self.changed:
+                    self.names[name.lower()] = station
+            return
+        self.names = {}
+        for station in self.stations:
+            name = station.get('name')
+            if name is not None:
+                self.names[name.lower()] = station
+
+    @property
+    def index(self):
+        """ The :class:`_SpatialIndex` of the stations """
+        if self._index is None:
+            index = self._indexes.get('spatial')
+            if index is None:
+                index = _SpatialIndex(self.stations)
+            elif index.stations is not self.stations:
+                index = index.rebind(self.stations)
+            self._indexes['spatial'] = self._index = index
+        return self._index
+
+    @property
+    def name_index(self):
+        """ The :class:`_NameIndex` of the stations' names """
+        index = self._indexes.get('names')
+        if index is None:
+            index = self._indexes['names'] = _NameIndex(self.names)
+        return index
+
+    @property
+    def grid(self):
+        """ The :class:`_GridIndex` of the stations' positions """
+        grid = self._indexes.get('grid')
+        if grid is None:
+            grid = self._indexes['grid'] = _GridIndex(self.stations)
+        return grid
+
+    def in_polygon(self, polygon):
+        """ 
+        The positions of the stations inside `polygon`, which are 
+        remembered for as long as the stations don't move.
+        """
+        key = ('polygon', polygon)
+        found = self._indexes.get(key)
+        if found is None:
+            found = self._indexes[key] = self.grid.in_polygon(polygon)
+        return found
+
+    def area_totals(self, polygon):
+        """ 
+        The number of stations inside `polygon`, and the totals of their 
+        :data:`AREA_FIELDS`, computed once per snapshot.
+        """
+        totals = self.totals.get(polygon)
+        if totals is None:
+            totals = dict.fromkeys(AREA_FIELDS, 0)
+            found = self.in_polygon(polygon)
+            for pos in found:
+                station = self.stations[pos]
+                for field in AREA_FIELDS:
+                    totals[field] += station.get(field) or 0
+            totals['stations'] = len(found)
+            self.totals[polygon] = totals
+        return totals
+
+    def column(self, field):
+        """
+        A NumPy array of the values of `field` for every station, by 
+        position, with `NaN` for missing values. Built on first use.
+        """
+        column = self._columns.get(field)
+        if column is None:
+            column = numpy.array([_as_float(st.get(field)) 
+                                  for st in self.stations], dtype=float)
+            self._columns[field] = column
+        return column
+
+    def encode(self, station, format):
+        """
+        `station` serialised to `format`. The encoding of each of the 
+        snapshot's records is kept, and carried over to later snapshots 
+        for as long as the station doesn't change.
+        """
+        encoded = self._encoded.get(format)
+        if encoded is None:
+            encoded = self._encoded.setdefault(format, {})
+        # records are keyed by identity, so only those that belong to the 
+        # snapshot, and so are kept alive by it, are remembered.
+        data = encoded.get(id(station))
+        if data is None:
+            data = SERIAL_FORMATS[format][0](station)
+            if self.by_id.get(station.get('id')) is station:
+                encoded[id(station)] = data
+        return data
+
+    def dump(self, format):
+        """ Every station, serialised to `format` as an array """
+        data = self._dumps.get(format)
+        if data is None:
+            parts = [self.encode(station, format) for station in self.stations]
+            data = self._dumps[format] = SERIAL_FORMATS[format][1](parts)
+        return data
+
+    def _carry_encoded(self, previous):
+        """ Reuses the encodings of the unchanged stations of `previous` """
+        for format, old in previous._encoded.items():
+            encoded = self._encoded[format] = {}
+            for station in self.by_id.itervalues():
+                data = old.get(id(station))
+                if data is not None:
+                    encoded[id(station)] = data
+
+    def _merge(self, previous):
+        """ Reuses the unchanged stations of `previous` """
+        for pos, station in enumerate(self.stations):
+            key = station.get('id')
+            old = previous.by_id.get(key)
+            if old is not None and old == station:
+                if self._carry_stations:
+                    self.stations[pos] = old
+            else:
+                self.changed.add(key)
+        ids = set(station.get('id') for station in self.stations)
+        self.removed = set(previous.by_id) - ids
+        self.version = previous.version
+        if self.changed or self.removed:
+            self.version += 1
+
+
+class _MappedSnapshot(_Snapshot):
+    """
+    A snapshot read in place from a file encoded by 
+    :func:`_encode_snapshot` and mapped into memory. Its stations are 
+    :class:`_MappedStation` views of the file's records, so processes 
+    mapping the same file share its pages rather than each holding a 
+    copy of the station data; each process only holds what it indexes, 
+    such as the stations' ids and positions. The name index is built 
+    the first time it is used.
+
+    Unchanged stations aren't carried over from `previous`, as they 
+    would keep the file they were read from mapped.
+
+    :param data: the mapped file.
+
+    :param previous: optional snapshot that this one replaces.
+    """
+
+    _carry_stations = False
+
+    def __init__(self, data, previous=None):
+        view = self.view = _SnapshotView(data)
+        self._names = None
+        _Snapshot.__init__(self, view.last_updated, 
+                           [_MappedStation(view, pos) 
+                            for pos in xrange(view.count)], previous)
+
+    def _read_layout(self):
+        """ A digest of the id, name and position of every station """
+        return self.view.layout()
+
+    def _read_names(self, previous=None):
+        self._names = None
+
+    @property
+    def names(self):
+        """ The stations by lowercased name, mapped on first use """
+        names = self._names
+        if names is None:
+            names = {}
+            for station in self.stations:
+                name = station.get('name')
+                if name is not None:
+                    names[name.lower()] = station
+            self._names = names
+        return names
+
+
+class _FeedFetcher(object):
+    """
+    Fetches a web-feed over a persistent HTTP connection.
+
+    Requests are made conditional on the feed's ``ETag`` and 
+    ``Last-Modified`` headers, so an unchanged feed costs a ``304`` 
+    response rather than a full download. The headers of a fetched feed 
+    are only used once :meth:`commit` is called, after the feed has been 
+    successfully read, so that a feed that couldn't be is fetched again. 
+    The number of bytes received and the time taken by each fetch are 
+    recorded.
+
+    :param url: the URL of the feed.
+
+    :param timeout: optional socket timeout in seconds.
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, url, timeout=None):
+        self.url = url
+        self.timeout = timeout
+        self.etag = None
+        self.last_modified = None
+        self._validators = None
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes = 0
+        self.last_bytes = 0
+        self.last_fetch_time = None
+        self.total_fetch_time = 0.0
+        self._conn = None
+        self._conn_key = None
+        # where the feed is fetched from, following permanent redirects
+        self._location = url
+
+    def _target(self, url):
+        parts = urlparse.urlsplit(url)
+        self._scheme, self._netloc = parts.scheme, parts.netloc
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+
+    def _connection(self):
+        key = (self._scheme, self._netloc)
+        if self._conn is None or self._conn_key != key:
+            self.close()
+            if self._scheme == 'https':
+                cls = httplib.HTTPSConnection
+            else:
+                cls = httplib.HTTPConnection
+            self._conn = cls(self._netloc, timeout=self.timeout)
+            self._conn_key = key
+        return self._conn
+
+    def close(self):
+        """ Closes the underlying connection, if open """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _request(self, headers):
+        """ 
+        Makes a GET request, retrying once on a fresh connection if a 
+        reused one turns out to have been dropped by the server.
+        """
+        for attempt in (0, 1):
+            reused = self._conn is not None
+            conn = self._connection()
+            try:
+                conn.request('GET', self._path, headers=headers)
+                response = conn.getresponse()
+                return response, response.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt or not reused:
+                    raise
+
+    def fetch(self):
+        """
+        Fetches the feed.
+
+        :returns: the body of the feed, or `None` if it has not been 
+                  modified since the last fetch.
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        start = time.time()
+        url = self._location
+        self._target(url)
+        redirects = 0
+        permanent = True
+        while True:
+            response, body = self._request(headers)
+            self.requests += 1
+            self.bytes += len(body)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location \
+               and redirects < self.MAX_REDIRECTS:
+                redirects += 1
+                url = urlparse.urljoin(url, location)
+                self._target(url)
+                # only a chain of permanent redirects moves the feed
+                permanent = permanent and response.status in (301, 308)
+                if permanent:
+                    self._location = url
+                continue
+            break
+        self.last_bytes = len(body)
+        self.last_fetch_time = time.time() - start
+        self.total_fetch_time += self.last_fetch_time
+        if response.getheader('connection', '').lower() == 'close':
+            self.close()
+
+        if response.status == 304:
+            self.not_modified += 1
+            return None
+        if response.status != 200:
+            msg = "Feed request failed: %d %s" % (response.status, 
+                                                  response.reason)
+            raise StationDataException(msg)
+        self._validators = (response.getheader('etag'), 
+                            response.getheader('last-modified'))
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def commit(self):
+        """ 
+        Makes later fetches conditional on the headers of the feed last 
+        fetched, once it has been successfully read.
+        """
+        if self._validators is not None:
+            self.etag, self.last_modified = self._validators
+            self._validators = None
+
+    def stats(self):
+        """ A `dict` of the fetcher's transfer statistics """
+        return {'requests': self.requests, 
+                'not_modified': self.not_modified,
+                'bytes': self.bytes, 
+                'last_bytes': self.last_bytes,
+                'last_fetch_time': self.last_fetch_time,
+                'total_fetch_time': self.total_fetch_time}
+
+
+class Filter(object):
+    """
+    A declarative station predicate, covering the most common station 
+    requirements. Filters can be passed anywhere that a `predicate` 
+    function is accepted, but rather than being called on every 
+    station, they are evaluated once per snapshot of station data as a 
+    vectorised mask (when NumPy is installed), which is then reused by 
+    every query.
+
+    For example, the nearest unlocked station with at least 3 bikes:
+
+    >>> bc = BikeChecker()
+    >>> bc.find_with_geo(51.49, -0.19, predicate=Filter(min_bikes=3, 
+    ...                                                 locked=False))
+
+    :param min_bikes: optional minimum number of available bikes.
+
+    :param min_docks: optional minimum number of empty docks.
+
+    :param installed: optional required value of ``installed``.
+
+    :param locked: optional required value of ``locked``.
+
+    :param temporary: optional required value of ``temporary``.
+    """
+
+    def __init__(self, min_bikes=None, min_docks=None, installed=None, 
+                 locked=None, temporary=None):
+        minimums = (('nbBikes', min_bikes), ('nbEmptyDocks', min_docks))
+        flags = (('installed', installed), ('locked', locked), 
+                 ('temporary', temporary))
+        self._minimums = tuple((f, v) for f, v in minimums if v is not None)
+        self._flags = tuple((f, bool(v)) for f, v in flags if v is not None)
+        self._key = (self._minimums, self._flags)
+
+    def __call__(self, station):
+        for field, minimum in self._minimums:
+            value = station.get(field)
+            if value is None or value < minimum:
+                return False
+        for field, flag in self._flags:
+            if station.get(field) != flag:
+                return False
+        return True
+
+    def mask(self, snapshot):
+        """
+        Evaluates the filter against every station in `snapshot`.
+
+        :returns: a sequence of booleans, by station position, that is 
+                  a NumPy array when NumPy is installed.
+        """
+        mask = snapshot.masks.get(self._key)
+        if mask is None:
+            if numpy is None:
+                mask = [self(station) for station in snapshot.stations]
+            else:
+                mask = numpy.ones(len(snapshot.stations), dtype=bool)
+                # missing values are NaN, which never compare as true
+                with numpy.errstate(invalid='ignore'):
+                    for field, minimum in self._minimums:
+                        mask &= snapshot.column(field) >= minimum
+                    for field, flag in self._flags:
+                        mask &= snapshot.column(field) == flag
+            snapshot.masks[self._key] = mask
+        return mask
+
+    def __eq__(self, other):
+        return isinstance(other, Filter) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        terms = ['%s>=%r' % term for term in self._minimums] + \
+                ['%s=%r' % term for term in self._flags]
+        return 'Filter(%s)' % ', '.join(terms)
+
+
+class Station(object):
+    """
+    A compact record of a single bike station's availability data.
+
+    Stations behave like the `dict`s previously returned by Boris, so 
+    ``station['nbBikes']``, ``station.get('name')``, ``station.items()`` 
+    and so on all keep working, and a station compares equal to a 
+    `dict` with the same items. Known fields are stored in slots rather 
+    than in a per-station hash table; any other fields found in the 
+    feed are kept in a small overflow `dict`.
+
+    Stations parsed from a feed keep their :data:`LAZY_FIELDS` as the 
+    feed's text, which is decoded the first time any of them is read. 
+    Until then, comparing two such stations compares that text.
+    """
+
+    __slots__ = STATION_FIELDS + ('_extra', '_raw', '_lazy')
+
+    def __init__(self, items=()):
+        self._extra = None
+        self._raw = None
+        self._lazy = False
+        for key, value in items:
+            self[key] = value
+
+    def __getattr__(self, name):
+        # only called for fields that haven't been set
+        if name in _LAZY_SLOTS and self._lazy:
+            self._decode()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def _decode(self):
+        """ Decodes the raw text of the lazy fields """
+        texts = self._raw.split(_RAW_SEPARATOR)
+        for field, text in zip(LAZY_FIELDS, texts):
+            if text != _RAW_ABSENT:
+                setattr(self, field, TAG_TYPES[field](text) if text else None)
+        # cleared last, so other threads reading a field meanwhile decode 
+        # it for themselves rather than finding it missing.
+        self._lazy = False
+
+    def _copy(self):
+        """ A copy of the station, leaving its lazy fields undecoded """
+        copy = Station()
+        # read first: a station decoded meanwhile still has its raw text
+        lazy = self._lazy
+        for field in _EAGER_FIELDS if lazy else STATION_FIELDS:
+            try:
+                setattr(copy, field, getattr(self, field))
+            except AttributeError:
+                pass
+        if self._extra:
+            copy._extra = dict(self._extra)
+        copy._raw, copy._lazy = self._raw, lazy
+        return copy
+
+    def _eager(self):
+        """ The values of the fields that aren't lazy, for comparisons """
+        return tuple(getattr(self, field, _RAW_ABSENT) 
+                     for field in _EAGER_FIELDS), self._extra
+
+    def __getitem__(self, key):
+        if key in _STATION_SLOTS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _LAZY_SLOTS and self._raw is not None:
+            if self._lazy:
+                self._decode()
+            self._raw = None
+        if key in _STATION_SLOTS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _LAZY_SLOTS and hasattr(self, key):
+            self._raw = None
+        if key in _STATION_SLOTS and hasattr(self, key):
+            delattr(self, key)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for key in STATION_FIELDS:
+            try:
+                yield key, getattr(self, key)
+            except AttributeError:
+                pass
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
+
+    def iterkeys(self):
+        return (key for key, _ in self.iteritems())
+
+    def itervalues(self):
+        return (value for _, value in self.iteritems())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    __iter__ = iterkeys
+
+    def __len__(self):
+        return len(self.items())
+
+    def as_dict(self):
+        """ A plain `dict` copy of the station's data """
+        return dict(self.iteritems())
+
+    copy = as_dict
+
+    def __eq__(self, other):
+        if isinstance(other, Station):
+            if self._raw is not None and other._raw is not None:
+                return self._raw == other._raw and \
+                       self._eager() == other._eager()
+            other = other.as_dict()
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (Station, (self.items(),))
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class _MappedStation(Station):
+    """
+    A read-only :class:`Station` whose fields are unpacked from a 
+    :class:`_SnapshotView` every time they are read, rather than being 
+    held in memory. Two such stations compare equal if their records 
+    hold the same data, without decoding them.
+    """
+
+    __slots__ = ('_view', '_pos')
+
+    def __init__(self, view, pos):
+        Station.__init__(self)
+        self._view = view
+        self._pos = pos
+        if pos in view.extras:
+            self._extra = dict(view.extras[pos])
+
+    def __getattr__(self, name):
+        # only called for fields that haven't been set, which is all of them
+        if name in _STATION_SLOTS:
+            return self._view.field(self._pos, name)
+        raise AttributeError(name)
+
+    def __setitem__(self, key, value):
+        raise TypeError("Shared station records are read-only")
+
+    def __delitem__(self, key):
+        raise TypeError("Shared station records are read-only")
+
+    def iteritems(self):
+        for item in self._view.items(self._pos):
+            yield item
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
+
+    def _copy(self):
+        return Station(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, _MappedStation):
+            return self._view.footprint(self._pos) == \
+                   other._view.footprint(other._pos) and \
+                   self._extra == other._extra
+        return Station.__eq__(self, other)
+
+
+class Subscription(object):
+    """
+    A subscription to a field of a station satisfying a comparison, as 
+    returned by :meth:`BikeChecker.subscribe`.
+    """
+
+    def __init__(self, station_id, field, op, threshold, callback):
+        self.station_id = station_id
+        self.field = field
+        self.op = op
+        self.threshold = threshold
+        self.callback = callback
+
+    def matches(self, value):
+        """ Whether `value` satisfies the subscription's comparison """
+        return value is not None and _OPERATORS[self.op](value, self.threshold)
+
+    def __repr__(self):
+        return "Subscription(%r, %s %s %r)" % (self.station_id, self.field, 
+                                               self.op, self.threshold)
+
+
+class _Watch(object):
+    """
+    The subscriptions to a single field of a single station. Those made 
+    with an ordering comparison are kept sorted by threshold, so that 
+    the subscriptions a change of value triggers are found by bisection 
+    rather than by checking every one.
+    """
+
+    def __init__(self):
+        self.ordered = dict((op, ([], [])) for op in ('<', '<=', '>', '>='))
+        self.others = []
+
+    def __len__(self):
+        return len(self.others) + sum(len(subs) for _, subs in 
+                                      self.ordered.itervalues())
+
+    def add(self, sub):
+        if sub.op in self.ordered:
+            thresholds, subs = self.ordered[sub.op]
+            pos = bisect.bisect_right(thresholds, sub.threshold)
+            thresholds.insert(pos, sub.threshold)
+            subs.insert(pos, sub)
+        else:
+            self.others.append(sub)
+
+    def remove(self, sub):
+        """ Removes `sub`, returning whether it was found """
+        if sub.op not in self.ordered:
+            if sub in self.others:
+                self.others.remove(sub)
+                return True
+            return False
+        thresholds, subs = self.ordered[sub.op]
+        lo = bisect.bisect_left(thresholds, sub.threshold)
+        hi = bisect.bisect_right(thresholds, sub.threshold)
+        for pos in xrange(lo, hi):
+            if subs[pos] is sub:
+                del thresholds[pos], subs[pos]
+                return True
+        return False
+
+    def triggered(self, old, new):
+        """ 
+        The subscriptions whose comparison is satisfied by `new`, but 
+        wasn't by `old`.
+        """
+        changed = lambda sub: sub.matches(new) and not sub.matches(old)
+        if old is None or new is None:
+            subs = list(self.others)
+            for _, ordered in self.ordered.itervalues():
+                subs.extend(ordered)
+            return filter(changed, subs)
+        found = filter(changed, self.others)
+        left, right = bisect.bisect_left, bisect.bisect_right
+        if new < old:
+            # thresholds in (new, old] for <, and [new, old) for <=
+            ranges = (('<', right, new, old), ('<=', left, new, old))
+        else:
+            # thresholds in [old, new) for >, and (old, new] for >=
+            ranges = (('>', left, old, new), ('>=', right, old, new))
+        for op, side, lo, hi in ranges:
+            thresholds, subs = self.ordered[op]
+            found.extend(subs[side(thresholds, lo):side(thresholds, hi)])
+        return found
+
+
+def _instrumented(event):
+    """ 
+    Reports the duration of each call to the decorated 
+    :class:`BikeChecker` method to the checker's hooks as `event`.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self._hooks:
+                return method(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._emit(event, time.time() - start)
+        return wrapper
+    return decorate
+
+
+class BikeChecker(object):
+    """
+    The BikeChecker object allows you to access Barclay's Bike 
+    availabily.
+
+    It maintains the most recent availabily data, so you don't need 
+    to worry about refreshing the data source; simply use the methods 
+    provided to access bike data and the :class:`boris.BikeChecker` 
+    class will take care of whether to request new bike availabily data.
+
+    :param url: optional web-service url. You _may_ need to change this
+                if `TFL`_ change the endpoint in the future.
+
+    :param stale_while_revalidate: optional argument specifying whether 
+                                   expired data should be served while 
+                                   it is refreshed in the background.
+
+    :param history: optional :class:`HistoryWriter` that every new 
+                    snapshot of station data is recorded with. A 
+                    failure to record one is stored in 
+                    :attr:`refresh_error`.
+
+    :param cache_path: optional path of a file to save station data to, 
+                       so that a new :class:`BikeChecker` can start with 
+                       it rather than fetching the feed, as long as it 
+                       hasn't expired.
+
+    Station data expires when the feed is next expected to be updated, 
+    judged from how often its ``lastUpdate`` time has changed, but the 
+    feed is checked no more often than :data:`MIN_REFRESH_INTERVAL`. If 
+    the feed lags, or can't be fetched, the checks back off.
+
+    Hooks registered with :meth:`add_hook` are told how long fetching, 
+    parsing and building each snapshot of station data takes, as well 
+    as every query. Other counters are available from :meth:`stats`.
+
+    .. _TFL: http://www.tfl.gov.uk/
+
+    :returns: a list of dictionaries containing bike station data
+    """
+
+    def __init__(self, endpoint=None, stale_while_revalidate=False, 
+                 history=None, cache_path=None):
+        self._pc = None
+        self._snapshot = _Snapshot()
+        self._fetcher = None
+        self._generation = 0
+        self._reload_lock = threading.Lock()
+        self._reload_failure = None
+        self._revalidating = threading.Lock()
+        self._refresher = None
+        self.refresh_error = None
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)
+        self._postcodes = _PostcodeCache()
+        self._centroids = {}
+        self._centroid_hits = 0
+        self._remote_postcodes = True
+        self._hooks = ()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._refreshes = 0
+        self._refresh_errors = 0
+        self._expires = 0
+        self._unchanged = 0
+        self._intervals = deque(maxlen=CADENCE_SAMPLES)
+        self._watches = {}
+        self._watch_lock = threading.Lock()
+        self._areas = OrderedDict()
+        self.endpoint = endpoint or TFL_DATA_LOC
+        self.stale_while_revalidate = stale_while_revalidate
+        self.history = history
+        self.cache_path = cache_path
+        if cache_path is not None:
+            self._load_cache()
+
+    @property
+    def pc(self):
+        """ The `postcodes`_ client, created on first use """
+        if self._pc is None:
+            from postcodes import PostCoder
+            self._pc = PostCoder()
+        return self._pc
+
+    @pc.setter
+    def pc(self, value):
+        self._pc = value
+
+    @pc.deleter
+    def pc(self):
+        self._pc = None
+
+    def _load_cache(self):
+        """ 
+        Starts with the station data saved at :attr:`cache_path`, if 
+        there is any and it hasn't expired.
+        """
+        try:
+            with open(self.cache_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return
+        try:
+            version, last_updated, expires, stations = _decode_snapshot(data)
+        except (StationDataException, struct.error, ValueError, EOFError):
+            return
+        finally:
+            data.close()
+        now = _time_ms(datetime.datetime.utcnow())
+        if stations and now < expires:
+            snapshot = _Snapshot(last_updated, stations)
+            snapshot.version = version
+            self._snapshot = snapshot
+            self._expires = expires
+
+    def _save_cache(self, snapshot):
+        """ 
+        Atomically replaces the file at :attr:`cache_path` with 
+        `snapshot`. Failing to do so isn't an error, as the file is only 
+        a cache.
+        """
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        try:
+            data = _encode_snapshot(snapshot, self._expires)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.boris')
+        except (EnvironmentError, struct.error):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self.cache_path)
+        except EnvironmentError:
+            os.remove(tmp)
+
+    def _fetch(self):
+        """ 
+        Opens the feed for parsing, or returns `None` if the web-service 
+        reports that it hasn't changed since it was last fetched.
+        """
+        if not _is_url(self.endpoint):
+            return _open_feed(self.endpoint)
+        if self._fetcher is None or self._fetcher.url != self.endpoint:
+            self._fetcher = _FeedFetcher(self.endpoint)
+        body = self._fetcher.fetch()
+        return None if body is None else StringIO(body)
+
+    def add_hook(self, hook):
+        """
+        Registers `hook` to be called as ``hook(event, seconds)`` with 
+        the duration of each of the following events:
+
+        - ``fetch``, ``parse`` and ``snapshot``: fetching the feed, 
+          parsing it, and building a new snapshot of station data from it.
+        - ``notify``: finding and calling the subscriptions (see 
+          :meth:`subscribe`) triggered by a new snapshot.
+        - ``query.<method>``: a call to a public query method, such as 
+          ``query.get`` or ``query.find_with_geo``, including any 
+          refresh of station data it triggers.
+
+        Hooks are called on the thread the event happened on, so should 
+        be quick, e.g. incrementing a StatsD timer or Prometheus 
+        histogram. When no hooks are registered nothing is timed.
+
+        :param hook: the callable to register.
+        """
+        self._hooks = self._hooks + (hook,)
+
+    def remove_hook(self, hook):
+        """ Unregisters a hook registered with :meth:`add_hook` """
+        self._hooks = tuple(h for h in self._hooks if h is not hook)
+
+    def _emit(self, event, seconds):
+        for hook in self._hooks:
+            hook(event, seconds)
+
+    def _timed(self, event, func, *args):
+        """ Calls `func`, reporting its duration to any hooks as `event` """
+        if not self._hooks:
+            return func(*args)
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self._emit(event, time.time() - start)
+
+    def _process_stations(self):
+        feed = self._timed('fetch', self._fetch)
+        if feed is None:
+            return
+        last_update, stations = self._timed('parse', _parse_stations, feed)
+        if not stations:
+            raise InvalidDataException("No Station data available")
+        previous = self._snapshot
+        snapshot = self._timed('snapshot', _Snapshot, long(last_update), 
+                               stations, previous)
+        self._install(snapshot, previous)
+        if self._fetcher is not None and _is_url(self.endpoint):
+            self._fetcher.commit()
+
+    def _install(self, snapshot, previous):
+        """ 
+        Swaps in `snapshot`, noting how it differs from `previous` and 
+        notifying subscribers of the changes.
+        """
+        if snapshot.version != previous.version:
+            self._changes.append((snapshot.version, snapshot.changed, 
+                                  snapshot.removed))
+        self._snapshot = snapshot
+        if self._watches and snapshot.changed:
+            self._timed('notify', self._notify, snapshot, previous)
+        for polygon in self._areas.values():
+            snapshot.area_totals(polygon)
+        # recorded last, and a failure to record is noted rather than 
+        # raised, as the snapshot has already been installed
+        if self.history is not None and \
+           snapshot.last_updated != previous.last_updated:
+            try:
+                self.history.record(snapshot.last_updated, snapshot.stations)
+            except (HistoryException, struct.error, KeyError, 
+                    EnvironmentError) as e:
+                self.refresh_error = e
+
+    def subscribe(self, station_id, field, op, threshold, callback):
+        """
+        Subscribes to a station's `field` satisfying a comparison with 
+        `threshold`, for example the station with id 8 having fewer than 
+        three bikes:
+
+        >>> bc = BikeChecker()
+        >>> bc.subscribe(8, 'nbBikes', '<', 3, notify)
+
+        Subscriptions are edge-triggered: `callback` is called when a 
+        refresh of the station data satisfies the comparison when the 
+        previous data didn't (or didn't include the station), and not 
+        again until it has stopped being satisfied. Only the stations 
+        a refresh changes are checked, so subscriptions cost nothing 
+        while their stations are unchanged.
+
+        Callbacks are called in bulk, on the thread that refreshed the 
+        data, once per refresh with a list of the subscriptions that 
+        were triggered. Each is described by a `dict` containing the 
+        `subscription`, the `station` and the `previous` value of the 
+        field. An error raised by a callback is stored in 
+        :attr:`refresh_error` rather than raised, so it holds up neither 
+        the refresh nor the other callbacks.
+
+        :param station_id: the ``id`` of the station.
+
+        :param field: the field to compare, such as ``nbBikes`` or 
+                      ``nbEmptyDocks``.
+
+        :param op: the comparison, one of ``<``, ``<=``, ``>``, ``>=``, 
+                   ``==`` or ``!=``.
+
+        :param threshold: the value to compare the field with.
+
+        :param callback: the callable to notify.
+
+        :returns: a :class:`Subscription`, which can be passed to 
+                  :meth:`unsubscribe`.
+        """
+        if op not in _OPERATORS:
+            raise ValueError("Unknown comparison %r" % op)
+        sub = Subscription(station_id, field, op, threshold, callback)
+        with self._watch_lock:
+            fields = self._watches.setdefault(station_id, {})
+            fields.setdefault(field, _Watch()).add(sub)
+        return sub
+
+    def unsubscribe(self, subscription):
+        """ 
+        Cancels a subscription made with :meth:`subscribe`.
+
+        :returns: whether the subscription was found.
+        """
+        with self._watch_lock:
+            fields = self._watches.get(subscription.station_id, {})
+            watch = fields.get(subscription.field)
+            if watch is None or not watch.remove(subscription):
+                return False
+            if not watch:
+                del fields[subscription.field]
+            if not fields:
+                del self._watches[subscription.station_id]
+            return True
+
+    def _notify(self, snapshot, previous):
+        """ 
+        Calls the subscriptions triggered by `snapshot`'s changes. A 
+        callback that raises is kept from the others and from the rest of 
+        the refresh; its error is stored in :attr:`refresh_error`.
+        """
+        # grouped by identity, as callbacks needn't be hashable
+        fired, groups = [], {}
+        with self._watch_lock:
+            ids = snapshot.changed
+            if len(self._watches) < len(ids):
+                ids = [sid for sid in self._watches if sid in ids]
+            for sid in ids:
+                fields = self._watches.get(sid)
+                station = snapshot.by_id.get(sid)
+                if not fields or station is None:
+                    continue
+                old = previous.by_id.get(sid, {})
+                for field, watch in fields.iteritems():
+                    value, previous_value = station.get(field), old.get(field)
+                    if value == previous_value:
+                        continue
+                    for sub in watch.triggered(previous_value, value):
+                        triggered = groups.get(id(sub.callback))
+                        if triggered is None:
+                            triggered = groups[id(sub.callback)] = []
+                            fired.append((sub.callback, triggered))
+                        triggered.append({'subscription': sub, 
+                                          'station': station, 
+                                          'previous': previous_value})
+        for callback, triggered in fired:
+            try:
+                callback(triggered)
+            except Exception as e:
+                self.refresh_error = e
+
+    def _reload(self, generation):
+        """
+        Reloads station data, unless another thread has already done so 
+        since `generation` was read; concurrent reloads therefore 
+        collapse into a single fetch, and share its error if it fails.
+        """
+        with self._reload_lock:
+            if self._generation != generation:
+                failed = self._reload_failure
+                if failed is not None and failed[0] == generation:
+                    raise failed[1]
+                return
+            previous = self._snapshot
+            self._reload_failure = None
+            try:
+                self._process_stations()
+            except Exception as e:
+                self._reload_failure = (generation, e)
+                self._refresh_errors += 1
+                self._schedule(previous, failed=True)
+                raise
+            else:
+                self._refreshes += 1
+                self._schedule(previous)
+                if self.cache_path is not None and self._snapshot.stations:
+                    self._save_cache(self._snapshot)
+            finally:
+                self._generation += 1
+
+    @property
+    def cadence(self):
+        """ 
+        The median interval between updates of the feed seen so far, or 
+        :data:`CACHE_LIMIT` if none have been, in milliseconds.
+        """
+        intervals = sorted(self._intervals)
+        if not intervals:
+            return CACHE_LIMIT
+        return intervals[len(intervals) // 2]
+
+    def _schedule(self, previous, failed=False):
+        """
+        Decides when station data next expires, after a reload that 
+        replaced `previous` (or `failed`): when the feed is next expected 
+        to be updated, but no sooner than a minimum interval which 
+        doubles each time the feed is found unchanged or can't be fetched, 
+        and never later than :data:`MAX_REFRESH_INTERVAL` from now.
+        """
+        now = _time_ms(datetime.datetime.utcnow())
+        snapshot = self._snapshot
+        if failed or snapshot.last_updated == previous.last_updated:
+            self._unchanged += 1
+        else:
+            if 0 < previous.last_updated < snapshot.last_updated:
+                # a long stall upstream mustn't become the expected cadence
+                self._intervals.append(min(snapshot.last_updated - 
+                                           previous.last_updated, 
+                                           MAX_REFRESH_INTERVAL))
+            self._unchanged = 0
+        backoff = min(MIN_REFRESH_INTERVAL * 2 ** min(self._unchanged, 16), 
+                      MAX_REFRESH_INTERVAL)
+        self._expires = min(max(snapshot.last_updated + self.cadence, 
+                                now + backoff), 
+                            now + MAX_REFRESH_INTERVAL)
+
+    def _refresh_if_stale(self, skip_cache=False):
+        """ 
+        Reloads station data if `skip_cache` is set, it has expired or 
+        there isn't any. 
+
+        In stale-while-revalidate mode, expired data is reloaded on a 
+        background thread while the caller carries on with the current 
+        snapshot.
+        """
+        generation = self._generation
+        snapshot = self._snapshot
+        now = _time_ms(datetime.datetime.utcnow())
+        if not skip_cache and snapshot.stations and now < self._expires:
+            self._cache_hits += 1
+            return
+        self._cache_misses += 1
+        if self.stale_while_revalidate and snapshot.stations and \
+           not skip_cache:
+            self._revalidate(generation)
+        else:
+            self._reload(generation)
+
+    def _revalidate(self, generation):
+        """ Starts a background reload, unless one is already running """
+        if not self._revalidating.acquire(False):
+            return
+        def run():
+            try:
+                self._background_reload(generation)
+            finally:
+                self._revalidating.release()
+        thread = threading.Thread(target=run, name='boris-revalidate')
+        thread.daemon = True
+        thread.start()
+
+    def _background_reload(self, generation):
+        """ 
+        Reloads station data, recording rather than raising any error 
+        so that queries keep being answered from the current snapshot.
+        """
+        # cleared first, so that errors recorded by the refresh itself, 
+        # such as a failing subscriber's, are kept
+        self.refresh_error = None
+        try:
+            self._reload(generation)
+        except Exception as e:
+            self.refresh_error = e
+
+    def start_refresher(self, interval=None):
+        """
+        Starts a background thread that reloads station data every 
+        `interval` seconds, so that queries are rarely, if ever, left 
+        waiting on the web-service. Errors encountered by the thread 
+        are stored in :attr:`refresh_error`.
+
+        :param interval: optional refresh period in seconds. By default 
+                         data is reloaded whenever it expires.
+        """
+        if self._refresher is not None:
+            return
+        stop = threading.Event()
+        def run():
+            while True:
+                self._background_reload(self._generation)
+                wait = interval
+                if wait is None:
+                    now = _time_ms(datetime.datetime.utcnow())
+                    wait = max(self._expires - now, 
+                               MIN_REFRESH_INTERVAL) / 1000.0
+                stop.wait(wait)
+                if stop.is_set():
+                    break
+        thread = threading.Thread(target=run, name='boris-refresher')
+        thread.daemon = True
+        self._refresher = (thread, stop)
+        thread.start()
+
+    def stop_refresher(self):
+        """ Stops the background thread started by :meth:`start_refresher` """
+        if self._refresher is not None:
+            thread, stop = self._refresher
+            self._refresher = None
+            stop.set()
+            thread.join()
+
+    def close(self):
+        """ 
+        Stops any background refresher, and closes the connection to 
+        the web-service.
+        """
+        self.stop_refresher()
+        if self._fetcher is not None:
+            self._fetcher.close()
+
+    def _current(self, skip_cache=False):
+        """ The snapshot a query should be answered from """
+        self._refresh_if_stale(skip_cache)
+        return self._snapshot
+
+    @property
+    def fetch_stats(self):
+        """
+        Transfer statistics for the web-service: the number of requests 
+        made and how many were answered ``304 Not Modified``, the total 
+        and most recent number of bytes received, and the most recent 
+        and total fetch times in seconds. `None` if the endpoint is not 
+        a URL.
+        """
+        if self._fetcher is not None:
+            return self._fetcher.stats()
+
+    @property
+    def version(self):
+        """ 
+        The version of the station data, which increases whenever a 
+        refresh changes, adds or removes any stations.
+        """
+        return self._snapshot.version
+
+    @property
+    def last_updated(self):
+        last_updated = self._snapshot.last_updated
+        if last_updated:
+            return datetime.datetime.fromtimestamp(last_updated / 1000)
+
+    @_instrumented('query.all')
+    def all(self, skip_cache=False):
+        """
+        Gets all available bike data.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of dictionaries describing current status of 
+                  bike stations
+        """
+        return self._current(skip_cache).stations
+
+    @_instrumented('query.dumps')
+    def dumps(self, station=None, format='json', skip_cache=False):
+        """
+        Station data serialised, ready to be written out by a web 
+        service without building a response from the station records.
+
+        The encoding of each station is computed once and reused until 
+        the station changes, and the encoding of every station once per 
+        refresh of the data.
+
+        :param station: optional station record, as returned by a query; 
+                        by default every station is serialised as an 
+                        array, as returned by :meth:`all`.
+
+        :param format: optional argument specifying the format, 
+                       ``'json'`` (default) or ``'msgpack'``, which 
+                       requires `msgpack-python`.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a byte string.
+        """
+        _check_format(format)
+        snapshot = self._current(skip_cache)
+        if station is None:
+            return snapshot.dump(format)
+        return snapshot.encode(station, format)
+
+    @_instrumented('query.changes_since')
+    def changes_since(self, version, skip_cache=False):
+        """
+        The stations that have changed since `version` of the station 
+        data, allowing you to poll for changes rather than process 
+        every station on each refresh.
+
+        >>> bc = BikeChecker()
+        >>> changes = bc.changes_since(0)
+        >>> # ... some time later
+        >>> changes = bc.changes_since(changes['version'])
+
+        If `version` is too old for its changes to still be known, all 
+        stations are returned.
+
+        :param version: a version previously returned by this method, 
+                        or by :attr:`version`.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a `dict` with the current `version`, a list of the 
+                  stations that were added or `changed` and a list of 
+                  the ids of `removed` stations.
+        """
+        snapshot = self._current(skip_cache)
+        result = {'version': snapshot.version, 'changed': [], 'removed': []}
+        if version >= snapshot.version:
+            return result
+        log = [entry for entry in list(self._changes) 
+               if version < entry[0] <= snapshot.version]
+        if not log or log[0][0] != version + 1:
+            result['changed'] = list(snapshot.stations)
+            return result
+        changed, removed = set(), set()
+        for _, ids, gone in log:
+            changed.update(ids)
+            removed.update(gone)
+        result['changed'] = [station for station in snapshot.stations 
+                             if station.get('id') in changed]
+        result['removed'] = sorted(x for x in removed 
+                                   if x not in snapshot.by_id)
+        return result
+
+    @_instrumented('query.get')
+    def get(self, name, fuzzy_matches=0, skip_cache=False):
+        """
+        Availability information for the station(s) matching `name`.
+
+        `get` allows fuzzy matching of stations based on their name, and 
+        returns up to `fuzzy_matches` stations; a station's inclusion 
+        is dependent on how close its name is to `name`, based on the 
+        result of the `Ratcliff/Obershelp`_ algorithm. Only the names 
+        sharing the most trigrams with `name` are scored.
+
+        .. _Ratcliff/Obershelp: http://xlinux.nist.gov/dads/HTML/ratcliffObershelp.html
+
+        :param name: the name of the bike station
+
+        :param fuzzy_matches: optional argument specifying how many 
+                              fuzzy matches to return. By default 
+                              `fuzzy_matches` is 0 and so `get` will 
+                              return an empty list if `name` does not 
+                              exactly match a station name.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of station availability data ordered by how 
+                  closely the station name matches `name`.
+        """
+        snapshot = self._current(skip_cache)
+        stations = snapshot.names
+
+        name = name.strip().lower()
+        station = stations.get(name, None)
+        if station is None:
+            if not fuzzy_matches:
+                return []
+            matches = snapshot.name_index.close_matches(name, fuzzy_matches)
+            if matches:
+                return [stations[x] for x in matches]
+        else:
+            return [station]
+
+    @_instrumented('query.complete')
+    def complete(self, prefix, limit=10, skip_cache=False):
+        """
+        Autocompletes a partial station name: returns stations whose 
+        name starts with `prefix`, followed by those with a word in 
+        their name starting with `prefix`.
+
+        :param prefix: the partial station name.
+
+        :param limit: optional argument specifying the maximum number 
+                      of stations to return (default 10).
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of station availability data.
+        """
+        snapshot = self._current(skip_cache)
+        prefix = prefix.lstrip().lower()
+        if not prefix:
+            return []
+        names = snapshot.name_index.complete(prefix, limit)
+        return [snapshot.names[x] for x in names]
+
+    @_instrumented('query.find_with_geo')
+    def find_with_geo(self, lat, lng, predicate=None, skip_cache=False):
+        """
+        Availability information for the nearest station to 
+        (`lat`, `lng`). Using `predicate` you can ensure that any 
+        returned stations also satisfy certain properties.
+
+        For example, ensuring there are at least five bikes available:
+
+        >>> bc = BikeChecker()
+        >>> bike_predicate = lambda x: x['nbBikes'] >= 4 
+        >>> bc.find_with_geo(51.49, -0.19, predicate=bike_predicate)
+        >>> # results here.
+
+        Common requirements are better expressed as a :class:`Filter`, 
+        which is much cheaper to evaluate:
+
+        >>> bc.find_with_geo(51.49, -0.19, predicate=Filter(min_bikes=4))
+
+        :param lat: latidude of position
+
+        :param lng: longitude of position
+
+        :parma predicate: optional argument specifying a predicate 
+                          which must be satisfied by any station 
+                          returned.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a `dict` containing an availability `dict` for the 
+                  nearest station, as well as the distance to that 
+                  station in kilometres. If no stations satisfy 
+                  `predicate`, and empty `dict` is returned.
+        """
+        _check_point(lat, lng)
+        snapshot = self._current(skip_cache)
+        nearest = self._k_nearest(snapshot, lat, lng, 1, predicate)
+        return nearest[0] if nearest else {}
+
+    @_instrumented('query.find_k_nearest')
+    def find_k_nearest(self, lat, lng, k, predicate=None, skip_cache=False):
+        """
+        Availability information for the `k` nearest stations to 
+        (`lat`, `lng`), optionally restricted to those stations 
+        satisfying `predicate`.
+
+        :param lat: latidude of position
+
+        :param lng: longitude of position
+
+        :param k: the maximum number of stations to return.
+
+        :param predicate: optional argument specifying a predicate 
+                          which must be satisfied by any station 
+                          returned.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of up to `k` `dict`s, nearest first, each 
+                  containing a station's availability `dict` and its 
+                  distance in kilometres, as returned by 
+                  :meth:`find_with_geo`.
+        """
+        _check_point(lat, lng)
+        snapshot = self._current(skip_cache)
+        return self._k_nearest(snapshot, lat, lng, k, predicate)
+
+    def _k_nearest(self, snapshot, lat, lng, k, predicate):
+        """ The `k` nearest stations in `snapshot` satisfying `predicate` """
+        index = snapshot.index
+        results = []
+        if k < 1:
+            return results
+        accept = self._acceptor(snapshot, predicate)
+        for dist, pos in index.nearest(lat, lng, accept):
+            results.append({'station': index.stations[pos], 'distance': dist})
+            if len(results) == k:
+                break
+        return results
+
+    @_instrumented('query.find_within')
+    def find_within(self, lat, lng, radius_km, predicate=None, 
+                    skip_cache=False):
+        """
+        Availability information for every station within `radius_km` 
+        kilometres of (`lat`, `lng`).
+
+        :param lat: latidude of position
+
+        :param lng: longitude of position
+
+        :param radius_km: the search radius in kilometres.
+
+        :param predicate: optional argument specifying a predicate 
+                          which must be satisfied by any station 
+                          returned.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of `dict`s, nearest first, each containing a 
+                  station's availability `dict` and its distance in 
+                  kilometres.
+        """
+        _check_point(lat, lng)
+        snapshot = self._current(skip_cache)
+        index = snapshot.index
+        results = []
+        accept = self._acceptor(snapshot, predicate)
+        for dist, pos in index.nearest(lat, lng, accept):
+            if dist > radius_km:
+                break
+            results.append({'station': index.stations[pos], 'distance': dist})
+        return results
+
+    @_instrumented('query.find_with_geo_batch')
+    def find_with_geo_batch(self, points, predicate=None, k=1, 
+                            skip_cache=False):
+        """
+        Availability information for the `k` nearest stations to each 
+        of many points at once. This is much cheaper than calling 
+        :meth:`find_k_nearest` for every point, as distances are 
+        computed in vectorised chunks (when NumPy is installed) and 
+        `predicate` is evaluated only once per station.
+
+        :param points: a sequence of (latitude, longitude) tuples.
+
+        :param predicate: optional argument specifying a predicate 
+                          which must be satisfied by any station 
+                          returned.
+
+        :param k: optional argument specifying the maximum number of 
+                  stations to return for each point (default 1).
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list with an entry for each point in `points`, in 
+                  the same order. Each entry is a list of up to `k` 
+                  results, as returned by :meth:`find_k_nearest`.
+        """
+        points = [tuple(point) for point in points]
+        for point in points:
+            _check_point(*point)
+        snapshot = self._current(skip_cache)
+        stations = snapshot.stations
+        found = self._nearest_batch(snapshot, points, predicate, k)
+        return [[{'station': stations[pos], 'distance': dist} 
+                 for dist, pos in pairs] for pairs in found]
+
+    def _nearest_batch(self, snapshot, points, predicate, k):
+        """ 
+        The (distance, position) pairs of the `k` nearest stations in 
+        `snapshot` to each of `points` satisfying `predicate`.
+        """
+        index = snapshot.index
+        if numpy is None:
+            accept = self._acceptor(snapshot, predicate)
+            found = []
+            for lat, lng in points:
+                nearest = index.nearest(lat, lng, accept)
+                found.append([pair for _, pair in zip(xrange(k), nearest)])
+            return found
+        if isinstance(predicate, Filter):
+            return index.nearest_batch(points, k, 
+                                       mask=predicate.mask(snapshot))
+        accept = self._acceptor(snapshot, predicate)
+        return index.nearest_batch(points, k, accept)
+
+    @_instrumented('query.find_journey')
+    def find_journey(self, origin, destination, min_bikes=1, min_docks=1, 
+                     k=1, skip_cache=False):
+        """
+        The best stations to pick up a bike near `origin` and drop it 
+        off near `destination`: the pickup must have at least 
+        `min_bikes` bikes, and the drop-off at least `min_docks` empty 
+        docks.
+
+        :param origin: the (latitude, longitude) tuple the journey 
+                       starts from.
+
+        :param destination: the (latitude, longitude) tuple the journey 
+                            ends at.
+
+        :param min_bikes: optional minimum number of bikes at the 
+                          pickup station (default 1).
+
+        :param min_docks: optional minimum number of empty docks at the 
+                          drop-off station (default 1).
+
+        :param k: optional argument specifying the maximum number of 
+                  journeys to return (default 1).
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of up to `k` journeys, shortest walk first. 
+                  Each is a `dict` with the ``pickup`` and ``dropoff`` 
+                  results (as returned by :meth:`find_k_nearest`), the 
+                  total walking ``distance`` to the pickup and from the 
+                  drop-off, and the ``ride`` distance between them, all 
+                  in kilometres.
+        """
+        return self._journeys([(origin, destination)], min_bikes, 
+                              min_docks, k, skip_cache)[0]
+
+    @_instrumented('query.find_journey_batch')
+    def find_journey_batch(self, journeys, min_bikes=1, min_docks=1, k=1, 
+                           skip_cache=False):
+        """
+        :meth:`find_journey` for many journeys at once. The pickup and 
+        drop-off candidates for every journey are found together, as 
+        with :meth:`find_with_geo_batch`.
+
+        :param journeys: a sequence of (origin, destination) tuples, 
+                         each of which is a (latitude, longitude) tuple.
+
+        :returns: a list with an entry for each journey in `journeys`, 
+                  in the same order. Each entry is a list of up to `k` 
+                  journeys, as returned by :meth:`find_journey`.
+        """
+        return self._journeys(journeys, min_bikes, min_docks, k, skip_cache)
+
+    def _journeys(self, journeys, min_bikes, min_docks, k, skip_cache):
+        """ The implementation of :meth:`find_journey_batch` """
+        journeys = [(tuple(origin), tuple(destination)) 
+                    for origin, destination in journeys]
+        for journey in journeys:
+            for point in journey:
+                _check_point(*point)
+        snapshot = self._current(skip_cache)
+        if k < 1:
+            return [[] for _ in journeys]
+        stations, points = snapshot.stations, snapshot.index.point
+        # Walking distances to the pickup and from the drop-off are 
+        # independent, so the best k pairings are among the k + 1 nearest 
+        # candidates at either end: one more than k, in case a station is 
+        # the best at both.
+        pickups = self._nearest_batch(snapshot, [o for o, _ in journeys], 
+                                      Filter(min_bikes=min_bikes), k + 1)
+        dropoffs = self._nearest_batch(snapshot, [d for _, d in journeys], 
+                                       Filter(min_docks=min_docks), k + 1)
+        results = []
+        for starts, ends in zip(pickups, dropoffs):
+            pairs = heapq.nsmallest(k, ((to + away, to, start, away, end) 
+                                        for to, start in starts 
+                                        for away, end in ends 
+                                        if start != end))
+            results.append([{
+                'pickup': {'station': stations[start], 'distance': to}, 
+                'dropoff': {'station': stations[end], 'distance': away}, 
+                'distance': walk, 
+                'ride': _great_circle(points(start), points(end))} 
+                for walk, to, start, away, end in pairs])
+        return results
+
+    def _acceptor(self, snapshot, predicate):
+        """ 
+        Adapts a station `predicate`, or :class:`Filter`, to station 
+        positions within `snapshot`.
+        """
+        if predicate is None:
+            return None
+        if isinstance(predicate, Filter):
+            return predicate.mask(snapshot).__getitem__
+        stations = snapshot.stations
+        return lambda pos: predicate(stations[pos])
+
+    @_instrumented('query.find_in_bbox')
+    def find_in_bbox(self, south, west, north, east, predicate=None, 
+                     skip_cache=False):
+        """
+        Availability information for every station in a box, such as 
+        the viewport of a map. Only the stations near the box are looked 
+        at, so small boxes are cheap however many stations there are.
+
+        :param south: the latitude of the southern edge of the box.
+
+        :param west: the longitude of the western edge of the box, which 
+                     may be greater than `east` if the box crosses the 
+                     180th meridian.
+
+        :param north: the latitude of the northern edge of the box.
+
+        :param east: the longitude of the eastern edge of the box.
+
+        :param predicate: optional argument specifying a predicate 
+                          which must be satisfied by any station 
+                          returned.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of station availability data, in feed order.
+        """
+        _check_point(south, west)
+        _check_point(north, east)
+        if south > north:
+            raise IllegalPointException("%s is north of %s" % (south, north))
+        snapshot = self._current(skip_cache)
+        found = snapshot.grid.in_bbox(south, west, north, east)
+        return self._select(snapshot, found, predicate)
+
+    @_instrumented('query.find_in_polygon')
+    def find_in_polygon(self, polygon, predicate=None, skip_cache=False):
+        """
+        Availability information for every station inside a polygon.
+
+        :param polygon: a sequence of at least three (latitude, 
+                        longitude) vertices; the last is joined to the 
+                        first.
+
+        :param predicate: optional argument specifying a predicate 
+                          which must be satisfied by any station 
+                          returned.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a list of station availability data, in feed order.
+        """
+        polygon = _polygon(polygon)
+        snapshot = self._current(skip_cache)
+        found = snapshot.grid.in_polygon(polygon)
+        return self._select(snapshot, found, predicate)
+
+    def _select(self, snapshot, positions, predicate):
+        """ The stations at `positions` satisfying `predicate` """
+        accept = self._acceptor(snapshot, predicate)
+        stations = snapshot.stations
+        return [stations[pos] for pos in positions 
+                if accept is None or accept(pos)]
+
+    def add_area(self, name, polygon):
+        """
+        Registers a named area, the totals for which are computed 
+        whenever the station data is refreshed; see :meth:`area_totals`.
+
+        :param name: the name of the area.
+
+        :param polygon: a sequence of at least three (latitude, 
+                        longitude) vertices.
+        """
+        areas = OrderedDict(self._areas)
+        areas[name] = _polygon(polygon)
+        self._areas = areas
+
+    def remove_area(self, name):
+        """ Unregisters an area registered with :meth:`add_area` """
+        areas = OrderedDict(self._areas)
+        del areas[name]
+        self._areas = areas
+
+    @_instrumented('query.area_totals')
+    def area_totals(self, name=None, skip_cache=False):
+        """
+        The number of stations in a named area, along with the total 
+        number of bikes, empty docks and docks at them.
+
+        :param name: optional name of an area registered with 
+                     :meth:`add_area`; by default, the totals for every 
+                     area are returned.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a `dict` of totals, or if `name` isn't given a `dict` 
+                  of the totals for each area, by name.
+        """
+        snapshot = self._current(skip_cache)
+        areas = self._areas
+        if name is not None:
+            return dict(snapshot.area_totals(areas[name]))
+        return OrderedDict((area, dict(snapshot.area_totals(polygon))) 
+                           for area, polygon in areas.iteritems())
+
+    @_instrumented('query.find_with_postcode')
+    def find_with_postcode(self, postcode, predicate=None, skip_cache=False):
+        """ 
+        Availability information for the nearest station to `postcode`.
+
+        Using `predicate` you can ensure that any returned stations 
+        also satisfy certain properties, for example that they have a 
+        certain number of bikes available.
+
+        :param postcode: the postcode to search
+
+        :parma predicate: optional argument specifying a predicate 
+                          which must be satisfied by any station 
+                          returned.
+
+        :param skip_cache: optional argument specifying whether to 
+                           check the cache (default) or skip it and 
+                           explicitly request fresh data.
+
+        :returns: a `dict` containing an availability `dict` for the 
+                  nearest station, as well as  the distance to that 
+                  station in kilometres. If no stations satisfy 
+                  `predicate`, and empty `dict` is returned.
+        """
+        snapshot = self._current(skip_cache)
+        lat, lng = self.locate_postcode(postcode)
+        _check_point(lat, lng)
+        nearest = self._k_nearest(snapshot, lat, lng, 1, predicate)
+        return nearest[0] if nearest else {}
+
+    def locate_postcode(self, postcode):
+        """
+        The location of `postcode`, from the table loaded with 
+        :meth:`load_postcode_centroids` if possible, and otherwise 
+        looked up with the `postcodes`_ library. Lookups, including 
+        of unknown postcodes, are cached.
+
+        .. _postcodes: https://github.com/e-dard/postcodes
+
+        :param postcode: the postcode to locate.
+
+        :returns: a (latitude, longitude) tuple.
+        """
+        key = _normalise_postcode(postcode)
+        location = self._centroids.get(key)
+        if location is not None:
+            self._centroid_hits += 1
+            return location
+        found, location = self._postcodes.get(key)
+        if not found:
+            if self._remote_postcodes:
+                location = self._lookup_postcode(postcode)
+            self._postcodes.put(key, location)
+        if location is None:
+            raise InvalidPostcodeException("No known postcode %s" % postcode)
+        return location
+
+    def _lookup_postcode(self, postcode):
+        """ Looks up a postcode's location with the `postcodes` library """
+        info = self.pc.get(postcode)
+        if not info:
+            return None
+        if 'geo' not in info or not set(['lat', 'lng']) <= set(info['geo']):
+            raise InvalidDataException("Missing latitude and/or longitude")
+        return float(info['geo']['lat']), float(info['geo']['lng'])
+
+    def load_postcode_centroids(self, path, remote_fallback=True):
+        """
+        Loads a table of postcode centroids (see 
+        :func:`load_postcode_centroids`) to locate postcodes with, 
+        rather than looking them up remotely.
+
+        :param path: the path of the CSV file.
+
+        :param remote_fallback: optional argument specifying whether 
+                                postcodes missing from the table should 
+                                be looked up remotely (default), or be 
+                                treated as unknown.
+        """
+        self._centroids = load_postcode_centroids(path)
+        self._remote_postcodes = remote_fallback
+
+    @property
+    def postcode_stats(self):
+        """
+        Postcode lookup statistics: the number of lookups answered by 
+        the centroid table, the number of cache hits and misses, and the 
+        number of cached postcodes.
+        """
+        return {'centroid_hits': self._centroid_hits,
+                'hits': self._postcodes.hits,
+                'misses': self._postcodes.misses,
+                'cached': len(self._postcodes)}
+
+    def stats(self):
+        """
+        Statistics describing the checker, suitable for exporting to a 
+        monitoring system:
+
+        - `cache_hits` and `cache_misses`: the number of times station 
+          data was checked and found current, and found expired (or 
+          the cache was skipped).
+        - `refreshes` and `refresh_errors`: the number of successful and 
+          failed reloads of station data.
+        - `stations`, `version` and `age`: the number of stations, 
+          version and age in seconds of the current station data; 
+          `age` is `None` before any data has been loaded.
+        - `expires_in` and `cadence`: the number of seconds until the 
+          data expires, and see :attr:`cadence`, in seconds.
+        - `fetch` and `postcodes`: see :attr:`fetch_stats` and 
+          :attr:`postcode_stats`.
+
+        :returns: a `dict` of statistics.
+        """
+        snapshot = self._snapshot
+        now = _time_ms(datetime.datetime.utcnow())
+        age = None
+        if snapshot.last_updated:
+            age = max(0, now - snapshot.last_updated) / 1000.0
+        return {'cache_hits': self._cache_hits,
+                'cache_misses': self._cache_misses,
+                'refreshes': self._refreshes,
+                'refresh_errors': self._refresh_errors,
+                'stations': len(snapshot.stations),
+                'version': snapshot.version,
+                'age': age,
+                'expires_in': max(0, self._expires - now) / 1000.0,
+                'cadence': self.cadence / 1000.0,
+                'fetch': self.fetch_stats,
+                'postcodes': self.postcode_stats}
+
+
+class SharedBikeChecker(BikeChecker):
+    """
+    A :class:`BikeChecker` that never fetches the feed itself, but reads 
+    the station data published to `path` by another process's 
+    :class:`BikeChecker` (created with ``cache_path=path``). This lets 
+    many worker processes share a single refresher: 
+
+    >>> # in the refresher process
+    >>> bc = BikeChecker(cache_path='/dev/shm/boris')
+    >>> bc.start_refresher()
+    >>> # in each worker process
+    >>> bc = SharedBikeChecker('/dev/shm/boris')
+
+    Published data is replaced atomically, so each query checks whether 
+    a new version has been published with a single ``stat``. A new 
+    version is mapped into memory and read in place: station records 
+    are views of the mapped file, whose fields are unpacked when they 
+    are read, so every reader shares the same pages of station data. 
+    Each reader only holds the indexes its queries use, such as those of 
+    the stations' ids and positions. Placing `path` on a memory backed 
+    file-system, such as ``/dev/shm``, avoids disk I/O altogether.
+
+    All the query methods of :class:`BikeChecker` are available. As 
+    station data is only ever read, `skip_cache` merely checks for a 
+    new version, and the station records returned are read-only.
+
+    :param path: the path station data is published to.
+
+    :param history: optional :class:`HistoryWriter` that every new 
+                    snapshot of station data is recorded with. A 
+                    failure to record one is stored in 
+                    :attr:`refresh_error`.
+    """
+
+    def __init__(self, path, history=None):
+        BikeChecker.__init__(self, history=history)
+        self.path = path
+        self._published = None
+
+    def _refresh_if_stale(self, skip_cache=False):
+        """ Reads the published station data, if it has been replaced """
+        generation = self._generation
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            if self._snapshot.stations:
+                return
+            raise StationDataException("No station data published at %s" % 
+                                       self.path)
+        if self._identify(stat) == self._published:
+            self._cache_hits += 1
+            return
+        self._cache_misses += 1
+        self._reload(generation)
+
+    def _process_stations(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        snapshot = None
+        try:
+            version, last_updated, expires, _, _ = _read_snapshot_header(data)
+            previous = self._snapshot
+            if (version, last_updated) != (previous.version, 
+                                           previous.last_updated):
+                snapshot = self._timed('snapshot', _MappedSnapshot, data, 
+                                       previous)
+                # versions only go back if the publisher started afresh
+                if version > previous.version:
+                    snapshot.version = version
+                self._install(snapshot, previous)
+        finally:
+            # otherwise the stations are read from the mapping, which is 
+            # closed once they are no longer used
+            if snapshot is None:
+                data.close()
+        self._expires = expires
+        self._published = self._identify(stat)
+
+    @staticmethod
+    def _identify(stat):
+        """ 
+        Identifies a published file; a new version is written to a new 
+        file, which is then renamed over the old one.
+        """
+        return stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size
+
+    def _schedule(self, previous, failed=False):
+        """ Expiry is decided by the publisher """
+
+    def start_refresher(self, interval=None):
+        """ 
+        Does nothing: station data is refreshed by the publishing 
+        process, and new versions are picked up by the next query.
+        """
+
+
+class FederatedBikeChecker(BikeChecker):
+    """
+    A :class:`BikeChecker` that merges several feeds in the same format 
+    as the TFL feed, such as those of other cities' cycle-hire schemes, 
+    and answers every query from one index of all their stations:
+
+    >>> bc = FederatedBikeChecker({'london': TFL_DATA_LOC, 
+    ...                            'elsewhere': 'http://example.com/feed'})
+    >>> bc.find_with_geo(51.49, -0.19)
+
+    Each feed is fetched by a :class:`BikeChecker` of its own, so keeps 
+    its own expiry, and expired feeds are refreshed concurrently. A feed 
+    that can't be fetched, or takes more than `timeout` seconds, keeps 
+    its previous stations (its error is noted in :attr:`feed_errors`) 
+    while the others are refreshed; a slow feed's stations are merged 
+    in once it arrives. Station ids are prefixed with the name of their 
+    feed, so station 8 of the ``london`` feed has the id ``london:8``.
+
+    The merged data expires when the data of the first feed does, and 
+    `skip_cache` checks every feed for expiry rather than refetching 
+    them all.
+
+    History files hold integer station ids, so the merged data, with its 
+    namespaced ids, can't be recorded. Give the :class:`BikeChecker` of 
+    each feed a :class:`HistoryWriter` of its own instead.
+
+    :param feeds: a mapping (or sequence of pairs) of names to the 
+                  endpoint of each feed, or a :class:`BikeChecker` for 
+                  it, for example one with its own `cache_path`.
+
+    :param timeout: optional number of seconds to wait for feeds to be 
+                    refreshed; see :data:`FEED_TIMEOUT`.
+
+    :param stale_while_revalidate: optional argument specifying whether 
+                                   expired data is refreshed in the 
+                                   background; see :class:`BikeChecker`.
+    """
+
+    def __init__(self, feeds, timeout=FEED_TIMEOUT, 
+                 stale_while_revalidate=False):
+        BikeChecker.__init__(self, 
+                             stale_while_revalidate=stale_while_revalidate)
+        self.endpoint = None
+        self.timeout = timeout
+        self.feeds = OrderedDict()
+        self._owned = []
+        for name, feed in OrderedDict(feeds).iteritems():
+            if not isinstance(feed, BikeChecker):
+                feed = BikeChecker(feed)
+                self._owned.append(feed)
+            self.feeds[name] = feed
+        self.feed_errors = {}
+        self._pending = {}
+        self._copies = {}
+        self._merged = None
+        self._pool = ThreadPool(max(1, len(self.feeds)))
+
+    def _process_stations(self):
+        self._timed('fetch', self._refresh_feeds)
+        snapshots = tuple(feed._snapshot for feed in self.feeds.itervalues())
+        if snapshots == self._merged:
+            return
+        stations = []
+        for name, snapshot in zip(self.feeds, snapshots):
+            stations.extend(self._namespaced(name, snapshot.stations))
+        if not stations:
+            errors = [self.feed_errors[name] for name in self.feeds 
+                      if name in self.feed_errors]
+            if errors:
+                raise errors[0]
+            raise InvalidDataException("No Station data available")
+        last_update = max(snapshot.last_updated for snapshot in snapshots)
+        previous = self._snapshot
+        snapshot = self._timed('snapshot', _Snapshot, last_update, stations, 
+                               previous)
+        self._install(snapshot, previous)
+        self._merged = snapshots
+
+    def _refresh_feeds(self):
+        """ 
+        Refreshes every expired feed concurrently, waiting for them for up 
+        to :attr:`timeout` seconds.
+        """
+        now = _time_ms(datetime.datetime.utcnow())
+        deadline = time.time() + self.timeout
+        started = []
+        for name, feed in self.feeds.iteritems():
+            pending = self._pending.get(name)
+            if pending is not None and not pending.ready():
+                continue
+            # failing feeds are retried once their back-off has passed
+            if name in self.feed_errors and now < feed._expires:
+                continue
+            pending = self._pool.apply_async(self._refresh_feed, (name, feed))
+            self._pending[name] = pending
+            started.append(pending)
+        for pending in started:
+            pending.wait(max(0, deadline - time.time()))
+
+    def _refresh_feed(self, name, feed):
+        try:
+            feed._refresh_if_stale()
+        except Exception as e:
+            self.feed_errors[name] = e
+        else:
+            self.feed_errors.pop(name, None)
+        # a feed that missed the deadline is merged on the next query
+        self._expires = 0
+
+    def _namespaced(self, name, stations):
+        """ 
+        Copies of a feed's `stations` with namespaced ids; the copies of 
+        unchanged stations are reused.
+        """
+        # keyed by identity, so each entry keeps its original alive
+        previous = self._copies.get(name, {})
+        copies, namespaced = {}, []
+        for station in stations:
+            original, copy = previous.get(id(station), (None, None))
+            if original is not station:
+                if isinstance(station, Station):
+                    copy = station._copy()
+                else:
+                    copy = Station(station.items())
+                if station.get('id') is not None:
+                    copy['id'] = u'%s:%s' % (name, station['id'])
+            copies[id(station)] = station, copy
+            namespaced.append(copy)
+        self._copies[name] = copies
+        return namespaced
+
+    def _schedule(self, previous, failed=False):
+        """ The merged data expires when the first feed's data does """
+        now = _time_ms(datetime.datetime.utcnow())
+        snapshots = tuple(feed._snapshot for feed in self.feeds.itervalues())
+        if snapshots != self._merged:
+            # a feed arrived after its data was merged
+            self._expires = now
+            return
+        expires = [feed._expires for name, feed in self.feeds.iteritems() 
+                   if self._pending.get(name) is None or 
+                      self._pending[name].ready()]
+        self._expires = min(expires or [now + MIN_REFRESH_INTERVAL])
+
+    def close(self):
+        """ 
+        Stops any background refresher, and closes the checkers created 
+        for each feed.
+        """
+        BikeChecker.close(self)
+        self._pool.terminate()
+        for feed in self._owned:
+            feed.close()
+
+    def stats(self):
+        """ 
+        See :meth:`BikeChecker.stats`; `feeds` maps the name of each 
+        feed to its own statistics, along with its most recent `error`.
+        """
+        stats = BikeChecker.stats(self)
+        stats['feeds'] = {}
+        for name, feed in self.feeds.iteritems():
+            error = self.feed_errors.get(name)
+            stats['feeds'][name] = dict(feed.stats(), 
+                                        error=error and unicode(error))
+        return stats
+
+
+class AsyncBikeChecker(object):
+    """
+    A non-blocking interface to a :class:`BikeChecker`, for use from 
+    event loops and other code that mustn't wait on the TFL or postcode 
+    web-services.
+
+    Every query method returns immediately with a result object (a 
+    :class:`multiprocessing.pool.AsyncResult`), while the feed is 
+    fetched and parsed, and postcodes are looked up, on a pool of 
+    worker threads. Call ``get()`` on the result to wait for it, or 
+    pass a `callback` to be called with its value once it is ready (on 
+    a worker thread).
+
+    Queries that find the station data expired at the same time share 
+    a single refresh of it.
+
+    :param endpoint: optional web-service url, as for 
+                     :class:`BikeChecker`.
+
+    :param workers: optional number of worker threads for queries, and 
+                    separately for postcode lookups (default 4).
+
+    :param checker: optional :class:`BikeChecker` to wrap, instead of 
+                    creating one for `endpoint`.
+    """
+
+    def __init__(self, endpoint=None, workers=4, checker=None):
+        self._owns_checker = checker is None
+        self.checker = checker or BikeChecker(endpoint)
+        self._pool = ThreadPool(workers)
+        # postcode lookups get their own pool, so that queries waiting on 
+        # them can never starve them of workers.
+        self._lookups = ThreadPool(workers)
+        self._lock = threading.Lock()
+        self._refreshing = None
+        self._callbacks = None
+
+    def _submit(self, func, args=(), kwargs=None, callback=None):
+        return self._pool.apply_async(func, args, kwargs or {}, callback)
+
+    def refresh(self, skip_cache=False, callback=None):
+        """
+        Refreshes the station data if it has expired, or if `skip_cache` 
+        is set. A refresh requested while another is in progress shares 
+        the result of that refresh, and `callback` is called when it 
+        succeeds along with those of every other request sharing it.
+
+        :returns: the result of the refresh, which holds no value.
+        """
+        with self._lock:
+            pending = self._refreshing
+            if pending is None or pending.ready() or self._callbacks is None:
+                callbacks = self._callbacks = []
+                def refreshed(value):
+                    with self._lock:
+                        if self._callbacks is callbacks:
+                            self._callbacks = None
+                    for callback in callbacks:
+                        callback(value)
+                pending = self._submit(self.checker._refresh_if_stale, 
+                                       (skip_cache,), callback=refreshed)
+                self._refreshing = pending
+            if callback is not None:
+                self._callbacks.append(callback)
+            return pending
+
+    def all(self, skip_cache=False, callback=None):
+        """ Non-blocking :meth:`BikeChecker.all` """
+        return self._submit(self.checker.all, (skip_cache,), 
+                            callback=callback)
+
+    def dumps(self, station=None, format='json', skip_cache=False, 
+              callback=None):
+        """ Non-blocking :meth:`BikeChecker.dumps` """
+        return self._submit(self.checker.dumps, (station, format, 
+                            skip_cache), callback=callback)
+
+    def get(self, name, fuzzy_matches=0, skip_cache=False, callback=None):
+        """ Non-blocking :meth:`BikeChecker.get` """
+        return self._submit(self.checker.get, (name, fuzzy_matches, 
+                                               skip_cache), callback=callback)
+
+    def find_with_geo(self, lat, lng, predicate=None, skip_cache=False, 
+                      callback=None):
+        """ Non-blocking :meth:`BikeChecker.find_with_geo` """
+        return self._submit(self.checker.find_with_geo, 
+                            (lat, lng, predicate, skip_cache), 
+                            callback=callback)
+
+    def find_with_postcode(self, postcode, predicate=None, skip_cache=False, 
+                           callback=None):
+        """ Non-blocking :meth:`BikeChecker.find_with_postcode` """
+        return self._submit(self.checker.find_with_postcode, 
+                            (postcode, predicate, skip_cache), 
+                            callback=callback)
+
+    def find_with_postcodes(self, postcodes, predicate=None, 
+                            skip_cache=False, callback=None):
+        """
+        Availability information for the nearest station to each of 
+        `postcodes`. Each distinct postcode is only looked up once, and 
+        the lookups run concurrently.
+
+        :returns: the result of the search, which holds a list with an 
+                  entry for each postcode as returned by 
+                  :meth:`BikeChecker.find_with_postcode`, or `None` if 
+                  the postcode is unknown.
+        """
+        return self._submit(self._find_with_postcodes, 
+                            (list(postcodes), predicate, skip_cache), 
+                            callback=callback)
+
+    def _find_with_postcodes(self, postcodes, predicate, skip_cache):
+        self.checker._refresh_if_stale(skip_cache)
+        keys = [_normalise_postcode(postcode) for postcode in postcodes]
+        unique = dict(zip(keys, postcodes))
+        located = self._lookups.map(self._locate, unique.values())
+        locations = dict(zip(unique, located))
+        results = []
+        for key in keys:
+            location = locations[key]
+            if location is not None:
+                location = self.checker.find_with_geo(*location, 
+                                                      predicate=predicate)
+            results.append(location)
+        return results
+
+    def _locate(self, postcode):
+        try:
+            return self.checker.locate_postcode(postcode)
+        except InvalidPostcodeException:
+            return None
+
+    def close(self):
+        """ 
+        Waits for outstanding queries, then stops the worker threads, and 
+        closes the wrapped :class:`BikeChecker` if it was created here.
+        """
+        for pool in (self._pool, self._lookups):
+            pool.close()
+            pool.join()
+        if self._owns_checker:
+            self.checker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_HISTORY_MAGIC = 'BORISHS1'
+_HISTORY_HEADER = struct.Struct('<8sI')
+
+def _history_start(capacity):
+    """ The offset of the first frame in a history file """
+    return _HISTORY_HEADER.size + 4 * capacity
+
+def _read_history_header(f):
+    """ Reads the capacity and slot ids of a history file """
+    f.seek(0)
+    header = f.read(_HISTORY_HEADER.size)
+    if len(header) != _HISTORY_HEADER.size or \
+       _HISTORY_HEADER.unpack(header)[0] != _HISTORY_MAGIC:
+        raise HistoryException("%s is not a history file" % f.name)
+    capacity = _HISTORY_HEADER.unpack(header)[1]
+    ids = list(struct.unpack('<%di' % capacity, f.read(4 * capacity)))
+    return capacity, ids
+
+
+class HistoryWriter(object):
+    """
+    Records the availability of every station over time in a compact, 
+    fixed-width columnar file.
+
+    The file starts with a header and a table of the station ids held 
+    in each of its `capacity` slots. Each recorded snapshot is then 
+    appended as a frame holding the feed's ``lastUpdate`` time followed 
+    by the ``nbBikes`` column and the ``nbEmptyDocks`` column, with one 
+    16-bit value per slot (-1 for a station missing from the snapshot). 
+    As every frame has the same size, :class:`HistoryReader` can find 
+    any value in the file without reading the rest of it.
+
+    :param path: the path of the history file, which is created if it 
+                 doesn't exist.
+
+    :param capacity: optional number of station slots to create a new 
+                     file with (default :data:`HISTORY_CAPACITY`).
+    """
+
+    def __init__(self, path, capacity=None):
+        self.path = path
+        if not os.path.exists(path) or not os.path.getsize(path):
+            capacity = capacity or HISTORY_CAPACITY
+            with open(path, 'wb') as f:
+                f.write(_HISTORY_HEADER.pack(_HISTORY_MAGIC, capacity))
+                f.write(struct.pack('<%di' % capacity, *[-1] * capacity))
+        self._file = open(path, 'r+b')
+        self.capacity, self._ids = _read_history_header(self._file)
+        self._slots = dict((sid, slot) for slot, sid in enumerate(self._ids) 
+                           if sid != -1)
+        self._frame = struct.Struct('<q%dh' % (2 * self.capacity))
+        # drop any partly written frame
+        start = _history_start(self.capacity)
+        frames = (os.path.getsize(path) - start) // self._frame.size
+        self._file.truncate(start + frames * self._frame.size)
+
+    def _slot(self, sid):
+        """ The slot for station `sid`, allocating one if necessary """
+        slot = self._slots.get(sid)
+        if slot is None:
+            if len(self._slots) == self.capacity:
+                msg = "History file %s is full" % self.path
+                raise HistoryException(msg)
+            slot = self._ids.index(-1)
+            self._file.seek(_HISTORY_HEADER.size + 4 * slot)
+            self._file.write(struct.pack('<i', sid))
+            self._ids[slot] = sid
+            self._slots[sid] = slot
+        return slot
+
+    def record(self, last_updated, stations):
+        """
+        Appends the availability of `stations` to the history file.
+
+        :param last_updated: the time of the snapshot, in milliseconds.
+
+        :param stations: a list of station records.
+        """
+        bikes, docks = [-1] * self.capacity, [-1] * self.capacity
+        for station in stations:
+            slot = self._slot(station['id'])
+            # fields may be missing, or present but empty
+            for column, field in ((bikes, 'nbBikes'), (docks, 'nbEmptyDocks')):
+                value = station.get(field)
+                column[slot] = -1 if value is None else value
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(self._frame.pack(last_updated, *(bikes + docks)))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class HistoryReader(object):
+    """
+    Queries a history file written by :class:`HistoryWriter`. The file 
+    is memory-mapped, so only the parts of it that a query touches are 
+    ever read.
+
+    :param path: the path of the history file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self.reload()
+
+    def reload(self):
+        """ Picks up any frames appended since the file was opened """
+        with open(self.path, 'rb') as f:
+            self.capacity, ids = _read_history_header(f)
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._slots = dict((sid, slot) for slot, sid in enumerate(ids) 
+                           if sid != -1)
+        self._start = _history_start(self.capacity)
+        self._frame_size = 8 + 4 * self.capacity
+        self._column = struct.Struct('<%dh' % self.capacity)
+        self.frames = (len(self._map) - self._start) // self._frame_size
+
+    def _offset(self, frame):
+        return self._start + frame * self._frame_size
+
+    def timestamp(self, frame):
+        """ The ``lastUpdate`` time of the `frame`th recorded snapshot """
+        return struct.unpack_from('<q', self._map, self._offset(frame))[0]
+
+    def timestamps(self):
+        """ The ``lastUpdate`` times of every recorded snapshot """
+        return [self.timestamp(i) for i in xrange(self.frames)]
+
+    def series(self, station_id):
+        """
+        The availability of a station over time.
+
+        :param station_id: the station's id.
+
+        :returns: a list of ``(lastUpdate, nbBikes, nbEmptyDocks)`` 
+                  tuples for every snapshot that included the station.
+        """
+        slot = self._slots.get(station_id)
+        if slot is None:
+            return []
+        result = []
+        bikes_at = 8 + 2 * slot
+        docks_at = bikes_at + 2 * self.capacity
+        for frame in xrange(self.frames):
+            offset = self._offset(frame)
+            bikes = struct.unpack_from('<h', self._map, offset + bikes_at)[0]
+            if bikes == -1:
+                continue
+            docks = struct.unpack_from('<h', self._map, offset + docks_at)[0]
+            result.append((self.timestamp(frame), bikes, docks))
+        return result
+
+    def at(self, timestamp):
+        """
+        The availability of every station at `timestamp`, taken from the 
+        most recent snapshot recorded at or before it.
+
+        :param timestamp: a time in milliseconds since the epoch.
+
+        :returns: a `dict` mapping station ids to ``(nbBikes, 
+                  nbEmptyDocks)`` tuples, which is empty if nothing was 
+                  recorded by `timestamp`.
+        """
+        lo, hi = 0, self.frames
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        if not lo:
+            return {}
+        offset = self._offset(lo - 1) + 8
+        bikes = self._column.unpack_from(self._map, offset)
+        docks = self._column.unpack_from(self._map, 
+                                         offset + 2 * self.capacity)
+        return dict((sid, (bikes[slot], docks[slot])) 
+                    for sid, slot in self._slots.iteritems() 
+                    if bikes[slot] != -1)
+
+    def close(self):
+        self._map.close()
+
 
-        info = self.pc.get(postcode)
-        if not info:
-            raise InvalidPostcodeException("No known postcode %s" % postcode)
-        if 'geo' not in info or not set(['lat', 'lng']) <= set(info['geo']):
-            raise InvalidDataException("Missing latitude and/or longitude")
-        lat, lng = float(info['geo']['lat']), float(info['geo']['lng'])
-        return self.find_with_geo(lat, lng, predicate=predicate)
 
 class IllegalPointException(Exception): pass
 class StationDataException(Exception): pass
 class InvalidDataException(Exception): pass
 class InvalidPostcodeException(Exception): pass
+class HistoryException(Exception): pass
         
@@ -1,39 +1,154 @@
 import datetime
 import argparse
+import httplib
+import json
+import os
 import re
+import socket
+import stat
+import sys
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from SocketServer import ThreadingMixIn, UnixStreamServer
 
 import boris
 
 POSTCODE_REGEX = re.compile("[a-z]{1,2}[0-9r][0-9a-z]?[0-9][a-z]{2}")
-bc = boris.BikeChecker()
+# where the query daemon listens: either host:port, or the path of a unix 
+# socket.
+DAEMON_ADDRESS = os.environ.get('BORIS_DAEMON', 'localhost:8642')
+DAEMON_TIMEOUT = 30
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# batches of searches are answered this many at a time, looking up to 
+# BATCH_WORKERS postcodes at once.
+BATCH_SIZE = 1000
+BATCH_WORKERS = 8
+CONTENT_TYPES = {'json': 'application/json', 'msgpack': 'application/x-msgpack'}
+# station data is saved here between runs, so that searches made in quick 
+# succession don't each fetch the feed.
+CACHE_PATH = os.environ.get('BORIS_CACHE', os.path.join(
+                            os.path.expanduser('~'), '.cache', 'boris', 'stations'))
+bc = boris.BikeChecker(cache_path=CACHE_PATH)
 
 def get_bikes(search, fuzzy=None, min_bikes=None):
-    res = None
-    predicate = None
+    try:
+        return _query(search, fuzzy, min_bikes)
+    except ValueError as e:
+        print e
+
+def _predicate(min_bikes):
     if min_bikes >= 1:
-        predicate = lambda x: x['nbBikes'] > min_bikes
-    # decipher input.
+        return boris.Filter(min_bikes=min_bikes + 1)
+
+def _classify(search):
+    """ 
+    Deciphers a search as a ``geo`` point, a ``postcode`` or a station 
+    ``name``, returning the kind of search and its term.
+    """
     try:
         nums = [float(x) for x in search]
     except ValueError:
         # try for postcode
         as_postcode = ''.join(search).lower()
         if POSTCODE_REGEX.match(as_postcode):
-            res = bc.find_with_postcode(as_postcode, predicate=predicate)
+            return 'postcode', as_postcode
+        # search by name
+        return 'name', ' '.join(search)
+    # lat / lng match
+    if len(nums) != 2:
+        raise ValueError("Wrong number of arguments (%d) for a geo "\
+                         "point." % len(nums))
+    return 'geo', tuple(nums)
+
+def _invalid_point(point):
+    return ValueError("Sorry, (%s, %s) doesn't seem like a valid point" % 
+                      point)
+
+def _query(search, fuzzy=None, min_bikes=None):
+    predicate = _predicate(min_bikes)
+    kind, term = _classify(search)
+    if kind == 'postcode':
+        return bc.find_with_postcode(term, predicate=predicate)
+    if kind == 'name':
+        return bc.get(term, fuzzy_matches=fuzzy or 1)
+    try:
+        return bc.find_with_geo(term[0], term[1], predicate=predicate)
+    except boris.IllegalPointException:
+        raise _invalid_point(term)
+
+def batch_bikes(lines, fuzzy=None, min_bikes=None):
+    """
+    Answers many searches, one per line of `lines`, in the same format 
+    as on the command line (a lat, lng point may also be separated by a 
+    comma). Postcodes are looked up concurrently, each only once, and 
+    the nearest stations to every point are found together.
+
+    :returns: an iterator of (search, results, error) tuples, in the 
+              order of `lines`; blank lines are skipped.
+    """
+    predicate = _predicate(min_bikes)
+    pool = ThreadPool(BATCH_WORKERS)
+    lines = (line.strip() for line in lines)
+    lines = (line.decode('utf-8') if isinstance(line, str) else line 
+             for line in lines if line)
+    try:
+        while True:
+            chunk = list(islice(lines, BATCH_SIZE))
+            if not chunk:
+                break
+            for answer in _batch_chunk(chunk, fuzzy, predicate, pool):
+                yield answer
+    finally:
+        pool.close()
+        pool.join()
+
+def _locate(postcode):
+    try:
+        return bc.locate_postcode(postcode)
+    except Exception as e:
+        return e
+
+def _batch_chunk(chunk, fuzzy, predicate, pool):
+    searches = []
+    for line in chunk:
+        try:
+            searches.append(_classify(line.replace(',', ' ').split()))
+        except ValueError as e:
+            searches.append(('error', e))
+    postcodes = sorted(set(term for kind, term in searches 
+                           if kind == 'postcode'))
+    located = dict(zip(postcodes, pool.map(_locate, postcodes)))
+    points = []
+    for kind, term in searches:
+        if kind == 'postcode' and not isinstance(located[term], Exception):
+            points.append(located[term])
+        elif kind == 'geo':
+            points.append(term)
+    try:
+        nearest = bc.find_with_geo_batch(points, predicate=predicate)
+        nearest = iter([x[0] if x else {} for x in nearest])
+    except boris.IllegalPointException:
+        nearest = None
+
+    for line, (kind, term) in zip(chunk, searches):
+        if kind == 'postcode' and isinstance(located[term], Exception):
+            kind, term = 'error', located[term]
+        if kind == 'error':
+            yield line, None, term
+        elif kind == 'name':
+            yield line, bc.get(term, fuzzy_matches=fuzzy or 1), None
+        elif nearest is not None:
+            yield line, next(nearest), None
         else:
-            # search by name
-            fuzzy = fuzzy or 1
-            res = bc.get(' '.join(search), fuzzy_matches=fuzzy)
-    else: 
-        # lat / lng match
-        if len(nums) == 2:
+            point = located[term] if kind == 'postcode' else term
             try:
-                res = bc.find_with_geo(nums[0], nums[1], predicate=predicate)
+                yield line, bc.find_with_geo(point[0], point[1], 
+                                             predicate=predicate), None
             except boris.IllegalPointException:
-                print "Sorry, (%s, %s) doesn't seem like a valid point" % nums
-        else:
-            print "Wrong number of arguments (%d) for a geo point." % len(nums)
-    return res   
+                yield line, None, _invalid_point(point)
 
 def _plural(num, string='s'):
     return string[num==1:]
@@ -79,12 +194,203 @@ def display_bikes(results, updated):
         result = '%s\n\n%s\n' % (result, ''.join(details))
     return result
 
+def _parse_address(address):
+    """ A unix socket path, or a (host, port) tuple """
+    if '/' in address:
+        return address
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+def _to_json(obj):
+    return json.dumps(obj, default=lambda x: x.as_dict())
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    """
+    Answers queries with the daemon's warm :class:`boris.BikeChecker`:
+
+    - ``GET /query?q=...&fuzzy=...&min=...`` returns the same results as 
+      a command line search, along with when they were last updated.
+    - ``GET /stations?format=...`` returns every station, serialised as 
+      JSON (default) or MessagePack by :meth:`boris.BikeChecker.dumps`.
+    - ``GET /stats`` returns :meth:`boris.BikeChecker.stats`.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        if url.path == '/stats':
+            self._respond(200, bc.stats())
+        elif url.path == '/stations':
+            format = params.get('format', ['json'])[0]
+            try:
+                body = bc.dumps(format=format)
+            except ValueError as e:
+                self._respond(400, {'error': unicode(e)})
+            except Exception as e:
+                self._respond(503, {'error': unicode(e) or repr(e)})
+            else:
+                self._write(200, CONTENT_TYPES[format], body)
+        elif url.path == '/query':
+            search = [x.decode('utf-8') for x in params.get('q', [])]
+            fuzzy, min_bikes = params.get('fuzzy'), params.get('min')
+            try:
+                res = _query(search, fuzzy and int(fuzzy[0]), 
+                             min_bikes and int(min_bikes[0]))
+            except (ValueError, boris.InvalidPostcodeException) as e:
+                self._respond(400, {'error': unicode(e)})
+            except Exception as e:
+                self._respond(503, {'error': unicode(e) or repr(e)})
+            else:
+                updated = bc.last_updated
+                self._respond(200, {'results': res, 'last_updated': 
+                                    updated and updated.strftime(TIME_FORMAT)})
+        else:
+            self._respond(404, {'error': 'Unknown path %s' % url.path})
+
+    def _respond(self, status, obj):
+        self._write(status, CONTENT_TYPES['json'], _to_json(obj))
+
+    def _write(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s - - [%s] %s\n" % (self.address_string(), 
+                         self.log_date_time_string(), format % args))
+
+
+class _QueryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _UnixQueryServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def _remove_stale_socket(path):
+    """ 
+    Removes the unix socket at `path` if it was left behind by a daemon 
+    that is no longer running.
+
+    :raises ValueError: if `path` is not a socket, or a daemon is still 
+                        listening on it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError("%s exists and is not a socket" % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.remove(path)
+    else:
+        raise ValueError("A daemon is already listening on %s" % path)
+    finally:
+        sock.close()
+
+def make_server(address=DAEMON_ADDRESS):
+    """ 
+    A query daemon listening on `address`, see :data:`DAEMON_ADDRESS`.
+
+    :raises ValueError: if `address` is a path that is already in use.
+    """
+    address = _parse_address(address)
+    if isinstance(address, tuple):
+        return _QueryServer(address, _QueryHandler)
+    _remove_stale_socket(address)
+    return _UnixQueryServer(address, _QueryHandler)
+
+def serve(address=DAEMON_ADDRESS):
+    """ 
+    Runs the query daemon until interrupted, keeping station data fresh 
+    in the background so that queries are answered immediately.
+    """
+    server = make_server(address)
+    bc.stale_while_revalidate = True
+    bc.start_refresher()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        bc.close()
+        if not isinstance(server.server_address, tuple):
+            os.remove(server.server_address)
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+def forward(search, fuzzy=None, min_bikes=None, address=DAEMON_ADDRESS):
+    """
+    Sends a search to the query daemon at `address`. 
+
+    :returns: a (results, last updated) tuple, or `None` if no daemon is 
+              running, it dropped the connection, or whatever answered 
+              isn't a daemon.
+
+    :raises ValueError: if the daemon couldn't answer the search.
+    """
+    address = _parse_address(address)
+    if isinstance(address, tuple):
+        conn = httplib.HTTPConnection(*address, timeout=DAEMON_TIMEOUT)
+    else:
+        conn = _UnixHTTPConnection(address, timeout=DAEMON_TIMEOUT)
+    try:
+        conn.connect()
+    except socket.error:
+        return None
+    params = [('q', x.encode('utf-8')) for x in search]
+    params += [(k, v) for k, v in (('fuzzy', fuzzy), ('min', min_bikes)) 
+               if v is not None]
+    try:
+        conn.request('GET', '/query?' + urllib.urlencode(params))
+        response = conn.getresponse()
+        body = json.loads(response.read())
+    except (httplib.HTTPException, socket.error, ValueError):
+        return None
+    finally:
+        conn.close()
+    # some other service may be listening at the address
+    if not isinstance(body, dict) or \
+       ('results' if response.status == 200 else 'error') not in body:
+        return None
+    if response.status != 200:
+        raise ValueError(body.get('error', 'Query failed'))
+    updated = body['last_updated']
+    if updated is not None:
+        updated = datetime.datetime.strptime(updated, TIME_FORMAT)
+    return body['results'], updated
+
 
 if __name__ == '__main__':
     msg = 'Easily lookup current Barclays Bike availability by name, '\
           'postcode or geographical position.'
     parser = argparse.ArgumentParser(description=msg)
-    parser.add_argument('search', metavar='string', type=unicode, nargs='+',
+    parser.add_argument('search', metavar='string', type=unicode, nargs='*',
                help='the search term (postcode, station name or lat,lng point')
 
     parser.add_argument('--fuzzy', metavar='fuzzy', type=int,
@@ -94,7 +400,51 @@ if __name__ == '__main__':
                help='for geo/postcode based queries, only show stations with '\
                     'minimum available bikes')
 
+    parser.add_argument('--serve', action='store_true',
+               help='run a daemon answering queries, which later searches '\
+                    'are forwarded to')
+
+    parser.add_argument('--address', metavar='address', 
+               default=DAEMON_ADDRESS,
+               help='the host:port or unix socket path of the daemon '\
+                    '(default %s)' % DAEMON_ADDRESS)
+
+    parser.add_argument('--no-daemon', action='store_true',
+               help="don't forward the search to a running daemon")
+
+    parser.add_argument('--batch', metavar='file', type=argparse.FileType(),
+               help='answer the searches in file (or - for stdin), one per '\
+                    'line, as JSON lines')
+
     args = parser.parse_args()
-    bikes = get_bikes(args.search, fuzzy=args.fuzzy, min_bikes=args.min)
-    print display_bikes(bikes, bc.last_updated)
+    if args.serve:
+        try:
+            serve(args.address)
+        except ValueError as e:
+            sys.exit(e)
+        sys.exit()
+    if args.batch:
+        for search, res, error in batch_bikes(args.batch, fuzzy=args.fuzzy, 
+                                              min_bikes=args.min):
+            answer = {'search': search}
+            if error is None:
+                answer['results'] = res
+            else:
+                answer['error'] = unicode(error)
+            print _to_json(answer)
+        sys.exit()
+    if not args.search:
+        parser.error('a search term is required')
+
+    found = None
+    if not args.no_daemon:
+        try:
+            found = forward(args.search, fuzzy=args.fuzzy, 
+                            min_bikes=args.min, address=args.address)
+        except ValueError as e:
+            sys.exit(e)
+    if found is None:
+        found = get_bikes(args.search, fuzzy=args.fuzzy, min_bikes=args.min), \
+                bc.last_updated
+    print display_bikes(*found)
 
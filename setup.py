@@ -24,6 +24,10 @@ setup(
     install_requires=[
         'lxml>=3.0.1', 'Postcodes>=0.1'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'msgpack': ['msgpack-python']
+    },
     tests_require=['mock'],
     classifiers=[
         'Environment :: Web Environment',
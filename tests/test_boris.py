@@ -1,8 +1,17 @@
 import unittest
 import datetime
+import difflib
+import json
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 from StringIO import StringIO
 
-from lxml import etree
 from mock import patch, Mock, call
 
 import boris
@@ -10,6 +19,66 @@ from boris import BikeChecker, IllegalPointException, \
                   InvalidPostcodeException, InvalidDataException
 
 
+FEED = """<stations lastUpdate="1353300000000">
+    <station>
+        <id>8</id>
+        <name>Lodge Road, St. John's Wood</name>
+        <lat>51.5</lat>
+        <long>-0.14</long>
+        <nbBikes>3</nbBikes>
+    </station>
+</stations>"""
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """ Serves `server.feed`, honouring conditional request headers """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        etag = '"%d"' % hash(self.server.feed)
+        modified = 'Mon, 19 Nov 2012 04:40:00 GMT'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', modified)
+        self.send_header('Content-Length', str(len(self.server.feed)))
+        self.end_headers()
+        self.wfile.write(self.server.feed)
+
+    def log_message(self, *args):
+        pass
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    """ A local stand-in for the TFL web-service, run on its own thread """
+
+    daemon_threads = True
+
+    def __init__(self, feed=FEED):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FeedHandler)
+        self.feed = feed
+        self.connections = 0
+        self.requests = []
+        self.url = 'http://127.0.0.1:%d/feed.xml' % self.server_port
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
 class TestBoris(unittest.TestCase):
 
     def test_time_ms(self):
@@ -40,6 +109,390 @@ class TestBoris(unittest.TestCase):
         self.assertRaises(IllegalPointException, f, b, d)
 
 
+    def test_parse_stations(self):
+        """ Tests boris._parse_stations """
+        x = """
+            <stations lastUpdate="12">
+                <station><id>1</id><name>A</name><nbBikes/></station>
+                <station><id>2</id><name>B</name><colour>red</colour></station>
+            </stations>
+            """
+        last_update, stations = boris._parse_stations(StringIO(x))
+        self.assertEquals("12", last_update)
+        self.assertEquals([{'id': 1, 'name': u'A', 'nbBikes': None}, 
+                           {'id': 2, 'name': u'B', 'colour': u'red'}], 
+                          stations)
+        self.assertTrue(all(isinstance(s, boris.Station) for s in stations))
+
+
+    def test_snapshot_encoding(self):
+        """ Tests boris._encode_snapshot and boris._decode_snapshot """
+        stations = [{'id': 1, 'name': u'Caf\xe9', 'lat': 51.5, 'long': -0.1, 
+                     'installed': True, 'removalDate': None, 'nbBikes': 4},
+                    {'id': 2, 'terminalName': u'', 'colour': u'red'}]
+        snapshot = boris._Snapshot(1353300000000, stations)
+        snapshot.version = 7
+        data = boris._encode_snapshot(snapshot, expires=1353300060000)
+        version, last_updated, expires, decoded = boris._decode_snapshot(data)
+        self.assertEquals((7, 1353300000000, 1353300060000), 
+                          (version, last_updated, expires))
+        self.assertEquals(stations, decoded)
+        self.assertTrue(all(isinstance(s, boris.Station) for s in decoded))
+        self.assertRaises(boris.StationDataException, 
+                          boris._decode_snapshot, data[:40])
+        self.assertRaises(boris.StationDataException, 
+                          boris._decode_snapshot, 'x' * len(data))
+
+    def test_snapshot_encoding_lazy(self):
+        """ Tests parsed stations stay lazy through a snapshot """
+        x = u"""
+            <stations lastUpdate="12">
+                <station><id>1</id><terminalName>Caf\xe9</terminalName>
+                    <installed>true</installed><removalDate/>
+                    <colour>red</colour><nbBikes>4</nbBikes></station>
+                <station><id>2</id><locked>false</locked></station>
+            </stations>
+            """.encode('utf-8')
+        _, stations = boris._parse_stations(StringIO(x))
+        snapshot = boris._Snapshot(12, stations)
+        data = boris._encode_snapshot(snapshot)
+        self.assertTrue(all(s._lazy for s in stations))
+        _, _, _, decoded = boris._decode_snapshot(data)
+        self.assertTrue(all(s._lazy for s in decoded))
+        _, parsed = boris._parse_stations(StringIO(x))
+        self.assertEquals(parsed, decoded)
+        self.assertTrue(all(s._lazy for s in decoded + parsed))
+        self.assertEquals([s.as_dict() for s in parsed], 
+                          [s.as_dict() for s in decoded])
+
+    def test_mapped_snapshot(self):
+        """ Tests boris._MappedSnapshot reads stations in place """
+        x = u"""
+            <stations lastUpdate="12">
+                <station><id>1</id><name>Caf\xe9</name><lat>51.5</lat>
+                    <long>-0.1</long><installed>true</installed>
+                    <removalDate/><colour>red</colour><nbBikes>4</nbBikes>
+                </station>
+                <station><id>2</id><name>B</name><nbBikes/></station>
+            </stations>
+            """.encode('utf-8')
+        _, parsed = boris._parse_stations(StringIO(x))
+        encode = lambda stations: boris._encode_snapshot(
+            boris._Snapshot(12, stations))
+        first = boris._MappedSnapshot(encode(parsed))
+        self.assertEquals(parsed, first.stations)
+        self.assertEquals([s.as_dict() for s in parsed], 
+                          [s.as_dict() for s in first.stations])
+        self.assertTrue(first.stations[0]['installed'])
+        self.assertNotIn('locked', first.stations[0])
+        self.assertIs(first.stations[1], first.names['b'])
+
+        # unchanged stations are recognised across files, and the indexes 
+        # are kept while no station has moved
+        index = first.index
+        parsed[1]['nbBikes'] = 3
+        second = boris._MappedSnapshot(encode(parsed), first)
+        self.assertEquals((set([2]), set()), (second.changed, second.removed))
+        self.assertIsNot(first.stations[0], second.stations[0])
+        self.assertIs(second.stations, second.index.stations)
+        self.assertIs(index._root, second.index._root)
+        parsed[1]['name'] = u'C'
+        third = boris._MappedSnapshot(encode(parsed), second)
+        self.assertEquals(set([2]), third.changed)
+        self.assertEquals(['c', u'caf\xe9'], sorted(third.names))
+        self.assertIsNot(index._root, third.index._root)
+
+    def test_watch(self):
+        """ Tests boris._Watch finds triggered subscriptions like a scan """
+        rand = random.Random(1)
+        watch, subs = boris._Watch(), []
+        for _ in range(200):
+            op = rand.choice(sorted(boris._OPERATORS))
+            sub = boris.Subscription(1, 'nbBikes', op, rand.randint(0, 10), 
+                                     None)
+            watch.add(sub)
+            subs.append(sub)
+        for sub in subs[::3]:
+            self.assertTrue(watch.remove(sub))
+        self.assertFalse(watch.remove(subs[0]))
+        subs = [sub for i, sub in enumerate(subs) if i % 3]
+        self.assertEquals(len(subs), len(watch))
+        for old, new in [(5, 2), (2, 5), (0, 10), (10, 0), (None, 4), 
+                         (4, None), (3, 4)]:
+            expected = [sub for sub in subs 
+                        if sub.matches(new) and not sub.matches(old)]
+            self.assertEquals(sorted(expected), 
+                              sorted(watch.triggered(old, new)))
+
+    def test_name_index(self):
+        """ Tests boris._NameIndex ranks names like difflib """
+        names = ["lodge road, st. john's wood", 'alderney street, pimlico', 
+                 'smith square, westminster', 'howick place, westminster', 
+                 'butler place, westminster', 'parkway, camden town', 
+                 'bonny street, camden town', 'moor street, soho']
+        index = boris._NameIndex(names)
+        for word in ('westminstr', 'camden', 'lodge rd', 'xyz'):
+            expected = difflib.get_close_matches(word, names, n=3, cutoff=0)
+            self.assertEquals(expected, index.close_matches(word, 3))
+
+        with patch('boris.FUZZY_CANDIDATES', 2):
+            self.assertEquals(['parkway, camden town', 
+                               'bonny street, camden town'], 
+                              index.close_matches('camden tow', 2))
+
+        self.assertEquals(['bonny street, camden town', 
+                           'butler place, westminster'], 
+                          index.complete('b', 5))
+        self.assertEquals(['smith square, westminster', 
+                           'alderney street, pimlico', 
+                           'bonny street, camden town'], 
+                          index.complete('s', 3))
+        self.assertEquals([], index.complete('zz', 3))
+
+
+class TestFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.stations = [
+            {'nbBikes': 3, 'nbEmptyDocks': 1, 'locked': False}, 
+            {'nbBikes': 5, 'nbEmptyDocks': 0, 'locked': False}, 
+            {'nbBikes': 9, 'nbEmptyDocks': 4, 'locked': True}, 
+            {'nbEmptyDocks': 4}]
+        self.snapshot = boris._Snapshot(stations=self.stations)
+
+    def test_call(self):
+        """ Tests boris.Filter can be used as a predicate """
+        f = boris.Filter(min_bikes=4, locked=False)
+        self.assertEquals([False, True, False, False], 
+                          [f(x) for x in self.stations])
+        self.assertTrue(boris.Filter()(self.stations[3]))
+
+    def test_mask(self):
+        """ Tests boris.Filter.mask with and without NumPy """
+        filters = [boris.Filter(min_bikes=4), boris.Filter(min_docks=1), 
+                   boris.Filter(min_bikes=0, locked=False), 
+                   boris.Filter(locked=True), boris.Filter()]
+        for f in filters:
+            expected = [f(x) for x in self.stations]
+            self.assertEquals(expected, list(f.mask(self.snapshot)))
+            self.assertIs(f.mask(self.snapshot), f.mask(self.snapshot))
+            with patch('boris.numpy', None):
+                snapshot = boris._Snapshot(stations=self.stations)
+                self.assertEquals(expected, f.mask(snapshot))
+
+    def test_equality(self):
+        """ Tests boris.Filter equality and hashing """
+        self.assertEquals(boris.Filter(min_bikes=2, locked=0), 
+                          boris.Filter(locked=False, min_bikes=2))
+        self.assertNotEqual(boris.Filter(min_bikes=2), boris.Filter())
+        self.assertEquals(1, len(set([boris.Filter(), boris.Filter()])))
+        self.assertEquals("Filter(nbBikes>=2, locked=False)", 
+                          repr(boris.Filter(min_bikes=2, locked=False)))
+
+
+class TestStation(unittest.TestCase):
+
+    def test_mapping(self):
+        """ Tests boris.Station behaves like a dict """
+        station = boris.Station([('id', 1), ('name', u'A'), ('extra', 2)])
+        self.assertEquals(1, station['id'])
+        self.assertEquals(2, station['extra'])
+        self.assertRaises(KeyError, lambda: station['nbBikes'])
+        self.assertIsNone(station.get('nbBikes'))
+        self.assertTrue('name' in station)
+        self.assertFalse('lat' in station)
+        self.assertEquals(['id', 'name', 'extra'], station.keys())
+        self.assertEquals(3, len(station))
+
+        station['nbBikes'] = 4
+        del station['extra']
+        expected = {'id': 1, 'name': u'A', 'nbBikes': 4}
+        self.assertEquals(expected, station)
+        self.assertEquals(station, expected)
+        self.assertEquals(expected, dict(station))
+        self.assertNotEqual({'id': 1}, station)
+        self.assertEquals(repr(expected), repr(station))
+
+    def test_lazy_fields(self):
+        """ Tests boris.Station decodes lazy fields when first read """
+        feed = """<stations lastUpdate="1">
+            <station><id>8</id><name>A</name><terminalName>003423</terminalName>
+                <installed>true</installed><removalDate/>
+                <installDate>1278241920000</installDate><nbBikes>3</nbBikes>
+            </station>
+            <station><id>8</id><name>A</name><terminalName>003423</terminalName>
+                <installed>true</installed><removalDate/>
+                <installDate>1278241920000</installDate><nbBikes>3</nbBikes>
+            </station>
+        </stations>"""
+        _, (first, second) = boris._parse_stations(StringIO(feed))
+        expected = {'id': 8, 'name': u'A', 'terminalName': u'003423', 
+                    'installed': True, 'removalDate': None, 
+                    'installDate': 1278241920000, 'nbBikes': 3}
+        self.assertTrue(first._lazy)
+        self.assertEquals(first, second)
+        self.assertTrue(first._lazy and second._lazy)
+        self.assertEquals(8, first['id'])
+        self.assertTrue(first._lazy)
+        self.assertIs(True, first['installed'])
+        self.assertFalse(first._lazy)
+        self.assertEquals(expected, first)
+        self.assertFalse('locked' in first)
+        self.assertEquals(first, second)
+
+        second['installed'] = False
+        self.assertIsNone(second._raw)
+        self.assertNotEqual(first, second)
+        self.assertEquals(u'003423', second['terminalName'])
+        second['nbBikes'] = 4
+        self.assertNotEqual(first, second)
+        self.assertEquals(expected, pickle.loads(pickle.dumps(first)))
+
+    def test_pickle(self):
+        """ Tests boris.Station can be pickled """
+        station = boris.Station([('id', 1), ('extra', 2)])
+        self.assertEquals(station, pickle.loads(pickle.dumps(station)))
+
+
+class TestAsyncBikeChecker(unittest.TestCase):
+
+    def setUp(self):
+        now = boris._time_ms(datetime.datetime.utcnow())
+        self.server = FeedServer(FEED.replace('1353300000000', '%d' % now))
+        self.addCleanup(self.server.stop)
+        self.abc = boris.AsyncBikeChecker(endpoint=self.server.url)
+        self.addCleanup(self.abc.close)
+
+    def test_queries(self):
+        """ Tests boris.AsyncBikeChecker queries share a single fetch """
+        results = [self.abc.all() for _ in range(6)]
+        results.append(self.abc.get("lodge road, st. john's wood"))
+        results.append(self.abc.find_with_geo(51.5, -0.14))
+        stations = results[0].get(timeout=5)
+        self.assertEquals(8, stations[0]['id'])
+        for result in results[1:6]:
+            self.assertIs(stations, result.get(timeout=5))
+        self.assertEquals(stations, results[6].get(timeout=5))
+        self.assertEquals(0.0, results[7].get(timeout=5)['distance'])
+        self.assertEquals(1, len(self.server.requests))
+
+    def test_refresh(self):
+        """ Tests boris.AsyncBikeChecker.refresh coalesces refreshes """
+        release = threading.Event()
+        process = self.abc.checker._process_stations
+        self.abc.checker._process_stations = lambda: (release.wait(), 
+                                                      process())
+        called = []
+        first = self.abc.refresh(skip_cache=True, callback=called.append)
+        self.assertIs(first, self.abc.refresh(skip_cache=True, 
+                                              callback=called.append))
+        release.set()
+        first.get(timeout=5)
+        self.assertEquals([None, None], called)
+        self.assertIsNot(first, self.abc.refresh())
+        self.assertEquals(1, len(self.server.requests))
+
+    def test_find_with_postcodes(self):
+        """ Tests boris.AsyncBikeChecker looks up postcodes concurrently """
+        def lookup(postcode):
+            threading.Event().wait(0.2)
+            if postcode != 'bad':
+                return {'geo': {'lat': 51.5, 'lng': -0.14}}
+        self.abc.checker.pc.get = Mock(side_effect=lookup)
+        start = datetime.datetime.now()
+        result = self.abc.find_with_postcodes(['N1 1AA', 'n11aa', 'bad', 
+                                               'E1 6AN', 'W1 1AA'])
+        found = result.get(timeout=5)
+        elapsed = datetime.datetime.now() - start
+        self.assertLess(elapsed, datetime.timedelta(seconds=0.6))
+        self.assertEquals(4, self.abc.checker.pc.get.call_count)
+        self.assertIsNone(found[2])
+        self.assertEquals([8, 8, 8, 8], [found[i]['station']['id'] 
+                                         for i in (0, 1, 3, 4)])
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        f = tempfile.NamedTemporaryFile(suffix='.hist', delete=False)
+        f.close()
+        self.path = f.name
+        self.addCleanup(os.remove, self.path)
+
+    def test_record_and_query(self):
+        """ Tests boris.HistoryWriter and boris.HistoryReader """
+        writer = boris.HistoryWriter(self.path, capacity=3)
+        writer.record(1000, [{'id': 8, 'nbBikes': 3, 'nbEmptyDocks': 15}, 
+                             {'id': 2, 'nbBikes': 0, 'nbEmptyDocks': 9}])
+        writer.record(2000, [{'id': 2, 'nbBikes': 1, 'nbEmptyDocks': 8}])
+        writer.close()
+
+        # reopening appends, discarding any partly written frame
+        with open(self.path, 'ab') as f:
+            f.write('junk')
+        writer = boris.HistoryWriter(self.path)
+        self.assertEquals(3, writer.capacity)
+        writer.record(3000, [{'id': 5, 'nbBikes': 4, 'nbEmptyDocks': 4}, 
+                             {'id': 8, 'nbBikes': 2, 'nbEmptyDocks': 16}])
+        self.assertRaises(boris.HistoryException, writer.record, 4000, 
+                          [{'id': 6, 'nbBikes': 1, 'nbEmptyDocks': 1}])
+        writer.close()
+
+        reader = boris.HistoryReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEquals([1000, 2000, 3000], reader.timestamps())
+        self.assertEquals([(1000, 3, 15), (3000, 2, 16)], reader.series(8))
+        self.assertEquals([(1000, 0, 9), (2000, 1, 8)], reader.series(2))
+        self.assertEquals([], reader.series(99))
+        self.assertEquals({}, reader.at(999))
+        self.assertEquals({2: (1, 8)}, reader.at(2999))
+        self.assertEquals({8: (2, 16), 5: (4, 4)}, reader.at(10 ** 13))
+
+    def test_not_a_history_file(self):
+        """ Tests boris.HistoryReader rejects other files """
+        with open(self.path, 'wb') as f:
+            f.write('<stations/>')
+        self.assertRaises(boris.HistoryException, boris.HistoryReader, 
+                          self.path)
+
+    def test_bike_checker_history(self):
+        """ Tests boris.BikeChecker records each new snapshot """
+        writer = boris.HistoryWriter(self.path)
+        bc = BikeChecker(endpoint=StringIO(FEED), history=writer)
+        bc._process_stations()
+        bc._process_stations()
+        writer.close()
+        reader = boris.HistoryReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEquals([(1353300000000, 3, -1)], reader.series(8))
+
+    def test_record_empty_values(self):
+        """ Tests empty availability fields are recorded as missing """
+        writer = boris.HistoryWriter(self.path)
+        feed = FEED.replace('<nbBikes>3</nbBikes>', '<nbBikes/>')
+        bc = BikeChecker(endpoint=StringIO(feed), history=writer)
+        bc.add_area('all', [(51, -1), (52, -1), (52, 1)])
+        bc._process_stations()
+        writer.close()
+        self.assertEquals(1, bc._snapshot.totals.values()[0]['stations'])
+        reader = boris.HistoryReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEquals(1, reader.frames)
+        self.assertEquals([], reader.series(8))
+
+    def test_record_failure(self):
+        """ Tests a failure to record history doesn't fail the refresh """
+        writer = boris.HistoryWriter(self.path, capacity=1)
+        self.addCleanup(writer.close)
+        writer.record(1000, [{'id': 1, 'nbBikes': 3, 'nbEmptyDocks': 15}])
+        bc = BikeChecker(endpoint=StringIO(FEED), history=writer)
+        stations = bc.all()
+        self.assertEquals(8, stations[0]['id'])
+        self.assertIsInstance(bc.refresh_error, boris.HistoryException)
+        self.assertEquals((1, 0), (bc.stats()['refreshes'], 
+                                   bc.stats()['refresh_errors']))
+
+
 class TestBikeChecker(unittest.TestCase):
 
     def setUp(self):
@@ -67,7 +520,7 @@ class TestBikeChecker(unittest.TestCase):
     def test_last_updated(self):
         """ Tests the boris.BikeChecker.last_updated property """
         self.assertIsNone(self.bc.last_updated)
-        self.bc._last_updated = long(1353300000000)
+        self.bc._snapshot = boris._Snapshot(long(1353300000000))
         expected = datetime.datetime(2012, 11, 19, 4, 40)
         self.assertEquals(expected, self.bc.last_updated)
 
@@ -86,16 +539,21 @@ class TestBikeChecker(unittest.TestCase):
                          ('nbDocks', 18)])] 
         exp_map = {exp_lst[0]['name'].lower(): exp_lst[0]}
         self.bc._process_stations()
-        self.assertEquals(exp_lst, self.bc._stations_lst)
-        self.assertEquals(exp_map, self.bc._stations_map)
+        self.assertEquals(exp_lst, self.bc._snapshot.stations)
+        self.assertEquals(exp_map, self.bc._snapshot.names)
 
-    @patch('boris.etree.parse', wraps=etree.parse)
+    @patch('boris._parse_stations', wraps=boris._parse_stations)
     @patch('boris.datetime', wraps=datetime)
     def test_all_cache(self, dt_mock, etree_mock):
         """ Tests boris.BikeChecker.all respects the cache """
         now = dt_mock.datetime.utcnow
         now.return_value = datetime.datetime.utcfromtimestamp(0)
+        # update because there's no data yet
+        self.bc.all()
+        self.assertTrue(etree_mock.called)
+
         # no update because cache not exceeded
+        etree_mock.reset_mock()
         self.bc.all()
         self.assertFalse(etree_mock.called)
 
@@ -110,20 +568,498 @@ class TestBikeChecker(unittest.TestCase):
         self.bc.all()
         self.assertTrue(etree_mock.called)
 
+    def test_hooks_and_stats(self):
+        """ Tests instrumentation hooks and boris.BikeChecker.stats """
+        events = []
+        hook = lambda event, seconds: events.append(event)
+        self.assertIsNone(self.bc.stats()['age'])
+        self.bc.add_hook(hook)
+        self.bc.all(skip_cache=True)
+        self.assertEquals(['fetch', 'parse', 'snapshot', 'query.all'], events)
+
+        del events[:]
+        self.bc.find_with_geo(51.5, -0.14)
+        self.assertEquals(['query.find_with_geo'], events)
+        stats = self.bc.stats()
+        self.assertEquals((1, 1, 1, 0), (stats['cache_hits'], 
+                          stats['cache_misses'], stats['refreshes'], 
+                          stats['refresh_errors']))
+        self.assertEquals((1, 1), (stats['stations'], stats['version']))
+
+        self.bc.remove_hook(hook)
+        del events[:]
+        self.bc.endpoint = StringIO("<stations/>")
+        self.assertRaises(InvalidDataException, self.bc.all, skip_cache=True)
+        self.assertEquals([], events)
+        self.assertEquals(1, self.bc.stats()['refresh_errors'])
+        self.bc._snapshot = boris._Snapshot(long(1353300000000))
+        self.assertTrue(self.bc.stats()['age'] > 0)
+
+    def test_cache_path(self):
+        """ Tests boris.BikeChecker starts with data saved to cache_path """
+        path = os.path.join(tempfile.mkdtemp(), 'cache', 'stations')
+        self.addCleanup(os.rmdir, os.path.dirname(os.path.dirname(path)))
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+        now = boris._time_ms(datetime.datetime.utcnow())
+        feed = StringIO(FEED.replace('1353300000000', '%d' % now))
+        bc = BikeChecker(endpoint=feed, cache_path=path)
+        stations = bc.all()
+        self.assertEquals(['stations'], os.listdir(os.path.dirname(path)))
+
+        with patch('boris._parse_stations') as parse:
+            bc = BikeChecker(endpoint=feed, cache_path=path)
+            self.assertEquals(stations, bc.all())
+            self.assertEquals(1, bc.version)
+            self.assertFalse(parse.called)
+
+        with patch('boris.datetime', wraps=datetime) as dt:
+            later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+            dt.datetime.utcnow.return_value = later
+            bc = BikeChecker(endpoint=feed, cache_path=path)
+        self.assertIsNone(bc.last_updated)
+        with open(path, 'wb') as f:
+            f.write('corrupt')
+        bc = BikeChecker(endpoint=feed, cache_path=path)
+        self.assertEquals(stations, bc.all())
+
+    @patch('boris.datetime', wraps=datetime)
+    def test_adaptive_expiry(self, dt_mock):
+        """ Tests expiry adapts to the feed's cadence, and backs off """
+        minute = 60 * 1000
+        clock = [1000 * minute]
+        dt_mock.datetime.utcnow.side_effect = lambda: datetime.datetime.\
+            utcfromtimestamp(clock[0] / 1000.0)
+        feed = [clock[0] - 10 * minute]
+        def process():
+            self.bc._snapshot = boris._Snapshot(feed[0], [{'name': 'A'}])
+        self.bc._process_stations = Mock(side_effect=process)
+        expires_in = lambda: self.bc.stats()['expires_in'] / 60
+
+        # the feed is lagging, so it is checked again soon, backing off
+        self.bc.all()
+        self.assertEquals(0.5, expires_in())
+        for expected in (1, 2, 4, 8, 10, 10):
+            clock[0] += self.bc._expires - clock[0]
+            self.bc.all()
+            self.assertEquals(expected, expires_in())
+        self.assertEquals(7, self.bc._process_stations.call_count)
+
+        # updates every two minutes are expected two minutes apart
+        feed[0] = clock[0]
+        self.bc.all(skip_cache=True)
+        for _ in range(3):
+            feed[0] += 2 * minute
+            clock[0] = feed[0] + minute / 2
+            self.bc.all(skip_cache=True)
+        self.assertEquals(2, self.bc.cadence / minute)
+        self.assertEquals(1.5, expires_in())
+        clock[0] += minute
+        self.bc.all()
+        self.assertEquals(11, self.bc._process_stations.call_count)
+
+        # failures back off too, while the current data is still served
+        self.bc._process_stations.side_effect = IOError
+        clock[0] += minute
+        self.assertRaises(IOError, self.bc.all)
+        self.assertEquals(1, expires_in())
+        self.assertEquals([{'name': 'A'}], self.bc.all())
+
+        # a long stall, or a time in the future, never delays the next 
+        # check by more than MAX_REFRESH_INTERVAL
+        self.bc._process_stations.side_effect = process
+        for _ in range(4):
+            feed[0] += 60 * minute
+            clock[0] = feed[0] + minute / 2
+            self.bc.all(skip_cache=True)
+        self.assertEquals(10, self.bc.cadence / minute)
+        self.assertEquals(9.5, expires_in())
+        feed[0] = clock[0] + 60 * minute
+        self.bc.all(skip_cache=True)
+        self.assertEquals(10, expires_in())
+
+    def test_shared_checker(self):
+        """ Tests boris.SharedBikeChecker reads published station data """
+        path = os.path.join(tempfile.mkdtemp(), 'stations')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        reader = boris.SharedBikeChecker(path)
+        self.assertRaises(boris.StationDataException, reader.all)
+
+        self.addCleanup(os.remove, path)
+        now = boris._time_ms(datetime.datetime.utcnow())
+        feed = FEED.replace('1353300000000', '%d' % now)
+        publisher = BikeChecker(endpoint=StringIO(feed), cache_path=path)
+        stations = publisher.all()
+        with patch('boris._MappedSnapshot', 
+                   wraps=boris._MappedSnapshot) as mapped:
+            self.assertEquals(stations, reader.all())
+            self.assertEquals(0.0, reader.find_with_geo(51.5, -0.14)['distance'])
+            self.assertEquals(1, mapped.call_count)
+            self.assertEquals((1, 1), (reader.version, 
+                                       reader.stats()['cache_hits']))
+
+            # republishing the same data doesn't map it again
+            publisher.all(skip_cache=True)
+            self.assertEquals(stations, reader.all())
+            self.assertEquals(1, mapped.call_count)
+
+        # records are read from the mapped file, not copied
+        station = reader.all()[0]
+        self.assertIsInstance(station, boris._MappedStation)
+        self.assertRaises(AttributeError, boris.Station.name.__get__, station)
+        self.assertEquals(u"Lodge Road, St. John's Wood", station['name'])
+        self.assertRaises(TypeError, station.__setitem__, 'nbBikes', 1)
+        self.assertEquals(stations[0].as_dict(), station.copy())
+
+        publisher.endpoint = StringIO(feed.replace('<nbBikes>3', 
+                                                   '<nbBikes>5').replace(
+                                      '%d' % now, '%d' % (now + 1000)))
+        publisher.all(skip_cache=True)
+        self.assertEquals(5, reader.get("lodge road, st. john's wood")[0]
+                          ['nbBikes'])
+        changes = reader.changes_since(1)
+        self.assertEquals((2, 8), (changes['version'], 
+                                   changes['changed'][0]['id']))
+        reader.start_refresher()
+        self.assertIsNone(reader._refresher)
+
+        os.remove(path)
+        self.assertEquals(5, reader.all()[0]['nbBikes'])
+        open(path, 'w').close()
+
+    def test_federated_checker(self):
+        """ Tests boris.FederatedBikeChecker merges feeds """
+        station = "<station><id>%d</id><name>%s</name><lat>%s</lat>" \
+                  "<long>0.1</long><nbBikes>%d</nbBikes></station>"
+        feed = lambda *st: '<stations lastUpdate="%d">%s</stations>' % (
+            boris._time_ms(datetime.datetime.utcnow()), 
+            ''.join(station % x for x in st))
+        london = BikeChecker(StringIO(feed((8, 'Lodge Road', 51.5, 3))))
+        paris = BikeChecker(StringIO(feed((8, 'Rue de Rivoli', 48.86, 5), 
+                                          (9, 'Bastille', 48.85, 0))))
+        dead = BikeChecker(os.path.join(tempfile.gettempdir(), 'missing'))
+        slow = BikeChecker(StringIO(feed((1, 'Slow Street', 40.0, 1))))
+        release = threading.Event()
+        refresh = slow._refresh_if_stale
+        slow._refresh_if_stale = lambda: (release.wait(), refresh())
+
+        bc = boris.FederatedBikeChecker([('london', london), ('paris', paris), 
+                                         ('dead', dead), ('slow', slow)], 
+                                        timeout=0.2)
+        self.addCleanup(bc.close)
+        self.addCleanup(release.set)
+        self.assertEquals([u'london:8', u'paris:8', u'paris:9'], 
+                          [s['id'] for s in bc.all()])
+        self.assertEquals(u'paris:8', 
+                          bc.find_with_geo(48.87, 0.1)['station']['id'])
+        self.assertEquals(u'Bastille', bc.get('bastille')[0]['name'])
+        self.assertEquals(set(['dead']), set(bc.feed_errors))
+        stats = bc.stats()
+        self.assertEquals(3, stats['stations'])
+        self.assertIsNotNone(stats['feeds']['dead']['error'])
+        self.assertIsNone(stats['feeds']['paris']['error'])
+
+        # unchanged stations are carried over, and the slow feed is merged 
+        # once it has been fetched
+        first = bc.all()
+        release.set()
+        for _ in range(50):
+            if bc._pending['slow'].ready():
+                break
+            time.sleep(0.01)
+        stations = bc.all()
+        self.assertEquals(u'slow:1', stations[-1]['id'])
+        self.assertIs(first[0], stations[0])
+        self.assertIsNone(bc.feed_errors.get('slow'))
+
+        # history files only hold integer ids
+        self.assertRaises(TypeError, boris.FederatedBikeChecker, [], 
+                          history=Mock())
+
+    def test_federated_lazy_fields(self):
+        """ Tests merging feeds leaves lazy fields undecoded """
+        feed = '<stations lastUpdate="%d"><station><id>8</id>' \
+               '<terminalName>003423</terminalName><installed>true' \
+               '</installed><nbBikes>3</nbBikes></station></stations>'
+        london = BikeChecker(StringIO(feed % 
+            boris._time_ms(datetime.datetime.utcnow())))
+        bc = boris.FederatedBikeChecker([('london', london)])
+        self.addCleanup(bc.close)
+        merged = bc.all(skip_cache=True)
+        merged = bc.all(skip_cache=True)
+        members = london._snapshot.stations
+        self.assertTrue(all(s._lazy for s in members + merged))
+        self.assertEquals(u'london:8', merged[0]['id'])
+        self.assertEquals(u'003423', merged[0]['terminalName'])
+        self.assertTrue(merged[0]['installed'])
+        self.assertTrue(members[0]._lazy)
+        self.assertEquals(8, members[0]['id'])
+
+        decoded = members[0]._copy()
+        decoded['terminalName']
+        copy = decoded._copy()
+        self.assertFalse(copy._lazy)
+        self.assertEquals(members[0], copy)
+
+    def test_incremental_refresh(self):
+        """ Tests refreshes reuse unchanged stations and record changes """
+        station = "<station><id>%d</id><name>%s</name><lat>%s</lat>" \
+                  "<long>0.1</long><nbBikes>%d</nbBikes></station>"
+        feed = lambda *st: '<stations lastUpdate="1">%s</stations>' % \
+                           ''.join(station % x for x in st)
+        bc = self.bc
+        bc.endpoint = StringIO(feed((1, 'A', 51.5, 2), (2, 'B', 51.6, 4)))
+        bc._process_stations()
+        first = bc._snapshot
+        self.assertEquals(1, bc.version)
+        self.assertEquals(first.stations, bc.changes_since(0)['changed'])
+
+        bc.endpoint = StringIO(feed((1, 'A', 51.5, 3), (2, 'B', 51.6, 4)))
+        bc._process_stations()
+        second = bc._snapshot
+        self.assertEquals(2, bc.version)
+        self.assertIs(first.stations[1], second.stations[1])
+        self.assertIs(first.index._root, second.index._root)
+        self.assertIs(first.name_index, second.name_index)
+        self.assertIs(second.stations[0], bc.get('a')[0])
+        self.assertIs(second.stations[0], 
+                      bc.find_with_geo(51.5, 0.1)['station'])
+        changes = bc.changes_since(1)
+        self.assertEquals({'version': 2, 'changed': [second.stations[0]], 
+                           'removed': []}, changes)
+        self.assertEquals(second.stations, bc.changes_since(0)['changed'])
+        self.assertEquals([], bc.changes_since(2)['changed'])
+
+        bc.endpoint = StringIO(feed((1, 'A', 51.5, 3), (2, 'B', 51.6, 4)))
+        bc._process_stations()
+        self.assertEquals(2, bc.version)
+
+        bc.endpoint = StringIO(feed((1, 'A', 51.7, 3), (3, 'C', 51.6, 4)))
+        bc._process_stations()
+        third = bc._snapshot
+        self.assertIsNot(second.index._root, third.index._root)
+        self.assertEquals(third.stations[0], 
+                          bc.find_with_geo(51.7, 0.1)['station'])
+        changes = bc.changes_since(2)
+        self.assertEquals(third.stations, changes['changed'])
+        self.assertEquals([2], changes['removed'])
+
+        # changes older than the change log are resent in full
+        bc._changes.popleft()
+        self.assertEquals(third.stations, bc.changes_since(0)['changed'])
+
+    def test_dumps(self):
+        """ Tests boris.BikeChecker.dumps reuses unchanged encodings """
+        station = "<station><id>%d</id><name>%s</name><lat>51.5</lat>" \
+                  "<long>0.1</long><nbBikes>%d</nbBikes></station>"
+        feed = lambda *st: '<stations lastUpdate="1">%s</stations>' % \
+                           ''.join(station % x for x in st)
+        bc = self.bc
+        bc._refresh_if_stale = Mock()
+        bc.endpoint = StringIO(feed((1, 'A', 2), (2, u'B\xe9'.encode('utf-8'), 
+                                                 4)))
+        bc._process_stations()
+        first = bc.dumps()
+        self.assertEquals(json.loads(first), bc.all())
+        self.assertIs(first, bc.dumps())
+        b = bc.dumps(bc.all()[1])
+        self.assertEquals(bc.all()[1], json.loads(b))
+
+        bc.endpoint = StringIO(feed((1, 'A', 3), (2, u'B\xe9'.encode('utf-8'), 
+                                                 4)))
+        bc._process_stations()
+        second = bc.dumps()
+        self.assertEquals(json.loads(second), bc.all())
+        self.assertIs(b, bc.dumps(bc.all()[1]))
+        self.assertEquals(3, json.loads(bc.dumps(bc.all()[0]))['nbBikes'])
+
+        # stations from elsewhere are encoded, but not remembered
+        other = {'id': 3, 'nbBikes': 1}
+        self.assertEquals(other, json.loads(bc.dumps(other)))
+        self.assertEquals(2, len(bc._snapshot._encoded['json']))
+
+        self.assertRaises(ValueError, bc.dumps, format='xml')
+        with patch('boris.msgpack', None):
+            self.assertRaises(ValueError, bc.dumps, format='msgpack')
+
+    @unittest.skipIf(boris.msgpack is None, "msgpack isn't installed")
+    def test_dumps_msgpack(self):
+        """ Tests boris.BikeChecker.dumps round-trips through msgpack """
+        self.bc._snapshot = boris._Snapshot(stations=[
+            boris.Station([('id', 8), ('name', u'Caf\xe9'), ('nbBikes', 3)]), 
+            {'id': 9, 'terminalName': '001', 'removalDate': None}])
+        self.bc._process_stations = int 
+        unpack = lambda data: boris.msgpack.unpackb(data, raw=False)
+        stations = unpack(self.bc.dumps(format='msgpack'))
+        self.assertEquals(self.bc.all(), stations)
+        self.assertTrue(all(isinstance(key, unicode) 
+                            for station in stations for key in station))
+        self.assertEquals(u'001', stations[1]['terminalName'])
+        self.assertEquals(stations[0], unpack(self.bc.dumps(
+            self.bc.all()[0], format='msgpack')))
+
+    def test_subscribe(self):
+        """ Tests boris.BikeChecker.subscribe notifies threshold crossings """
+        station = "<station><id>%d</id><name>%s</name><nbBikes>%d</nbBikes>" \
+                  "<nbEmptyDocks>%d</nbEmptyDocks></station>"
+        def refresh(*st):
+            self.bc.endpoint = StringIO('<stations lastUpdate="1">%s'\
+                '</stations>' % ''.join(station % x for x in st))
+            self.bc.all(skip_cache=True)
+        refresh((1, 'A', 5, 0), (2, 'B', 5, 0))
+        low, docks = Mock(), Mock()
+        first = self.bc.subscribe(1, 'nbBikes', '<', 3, low)
+        second = self.bc.subscribe(2, 'nbBikes', '<=', 2, low)
+        self.bc.subscribe(2, 'nbEmptyDocks', '>', 0, docks)
+        self.assertRaises(ValueError, self.bc.subscribe, 1, 'nbBikes', '~', 
+                          1, low)
+
+        refresh((1, 'A', 4, 0), (2, 'B', 5, 0))
+        self.assertFalse(low.called)
+        refresh((1, 'A', 2, 0), (2, 'B', 2, 3))
+        self.assertEquals(1, low.call_count)
+        triggered = low.call_args[0][0]
+        self.assertEquals([first, second], 
+                          [x['subscription'] for x in triggered])
+        self.assertEquals((2, 4), (triggered[0]['station']['nbBikes'], 
+                                   triggered[0]['previous']))
+        self.assertEquals(1, docks.call_count)
+
+        # not triggered again until the comparison has stopped holding
+        refresh((1, 'A', 1, 0), (2, 'B', 2, 3))
+        self.assertEquals(1, low.call_count)
+        self.assertTrue(self.bc.unsubscribe(second))
+        self.assertFalse(self.bc.unsubscribe(second))
+        refresh((1, 'A', 3, 0), (2, 'B', 3, 3))
+        refresh((1, 'A', 0, 0), (2, 'B', 0, 3))
+        self.assertEquals(2, low.call_count)
+        self.assertEquals([first], [x['subscription'] 
+                                    for x in low.call_args[0][0]])
+
+    def test_subscribe_callback_errors(self):
+        """ Tests subscription callbacks needn't be hashable or succeed """
+        station = "<station><id>%d</id><nbBikes>%d</nbBikes></station>"
+        def refresh(last_update, *st):
+            self.bc.endpoint = StringIO('<stations lastUpdate="%d">%s'\
+                '</stations>' % (last_update, 
+                                 ''.join(station % x for x in st)))
+            return self.bc.all(skip_cache=True)
+        refresh(1, (1, 5), (2, 5))
+        results = []
+        self.bc.subscribe(1, 'nbBikes', '<', 3, Mock(side_effect=IOError))
+        self.bc.subscribe(2, 'nbBikes', '<', 3, results.append)
+        history = self.bc.history = Mock()
+
+        stations = refresh(2, (1, 2), (2, 2))
+        self.assertEquals(2, self.bc._snapshot.last_updated)
+        self.assertEquals(2, stations[1]['nbBikes'])
+        self.assertEquals(1, len(results))
+        self.assertIsInstance(self.bc.refresh_error, IOError)
+        self.assertEquals(0, self.bc.stats()['refresh_errors'])
+        self.assertTrue(history.record.called)
+
+    def test_single_flight_reload(self):
+        """ Tests concurrent expired queries share a single reload """
+        calls = []
+        def slow_process():
+            calls.append(1)
+            threading.Event().wait(0.1)
+            now = boris._time_ms(datetime.datetime.utcnow())
+            self.bc._snapshot = boris._Snapshot(now, [{'name': 'A'}])
+        self.bc._process_stations = slow_process
+
+        threads = [threading.Thread(target=self.bc.all) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(1, len(calls))
+
+    def test_single_flight_reload_failure(self):
+        """ Tests queries waiting on a failed reload share its error """
+        calls, errors = [], []
+        def slow_failure():
+            calls.append(1)
+            threading.Event().wait(0.1)
+            raise InvalidDataException("No Station data available")
+        self.bc._process_stations = slow_failure
+        def query():
+            try:
+                self.bc.all()
+            except InvalidDataException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=query) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(1, len(calls))
+        self.assertEquals(4, len(errors))
+
+    def test_stale_while_revalidate(self):
+        """ Tests expired data is served while reloading in background """
+        stale = boris._Snapshot(1, [{'name': 'A'}])
+        fresh = boris._Snapshot(2, [{'name': 'B'}])
+        release = threading.Event()
+        def blocked_process():
+            release.wait()
+            self.bc._snapshot = fresh
+        bc = self.bc
+        bc.stale_while_revalidate = True
+        bc._snapshot = stale
+        bc._process_stations = blocked_process
+
+        self.assertIs(stale.stations, bc.all())
+        self.assertIs(stale.stations, bc.all())
+        release.set()
+        bc._revalidating.acquire()
+        bc._revalidating.release()
+        self.assertIs(fresh, bc._snapshot)
+        self.assertIsNone(bc.refresh_error)
+
+        bc._process_stations = Mock(side_effect=IOError)
+        bc._expires = 0
+        bc.all()
+        bc._revalidating.acquire()
+        self.assertIsInstance(bc.refresh_error, IOError)
+        self.assertIs(fresh, bc._snapshot)
+
+    def test_refresher(self):
+        """ Tests boris.BikeChecker.start_refresher reloads periodically """
+        reloaded = threading.Event()
+        self.bc._process_stations = reloaded.set
+        self.bc.start_refresher(interval=60)
+        self.assertTrue(reloaded.wait(5))
+        self.bc.stop_refresher()
+        self.assertIsNone(self.bc._refresher)
+
     def test_get(self):
         """ Tests boris.BikeChecker.get """
-        self.bc._stations_map = {'foo': 0, 'fooby': 1, 'zoo': 2}
+        st = [{'name': 'Foo'}, {'name': 'fooby'}, {'name': 'ZOO'}]
+        self.bc._snapshot = boris._Snapshot(stations=st)
         #harmless callable to stop the stations updating
         self.bc._process_stations = int 
-        self.assertEquals([0], self.bc.get("Foo "))
-        self.assertEquals([1, 0], self.bc.get("foby", fuzzy_matches=2))
-        self.assertEquals([2, 1, 0], self.bc.get("zooy", fuzzy_matches=5))
+        self.assertEquals([st[0]], self.bc.get("Foo "))
+        self.assertEquals([st[1], st[0]], self.bc.get("foby", fuzzy_matches=2))
+        self.assertEquals([st[2], st[1], st[0]], 
+                          self.bc.get("zooy", fuzzy_matches=5))
+
+    def test_complete(self):
+        """ Tests boris.BikeChecker.complete """
+        st = [{'name': 'Moor Street, Soho'}, {'name': 'Soho Square, Soho'}]
+        self.bc._snapshot = boris._Snapshot(stations=st)
+        self.bc._process_stations = int 
+        self.assertEquals([st[1], st[0]], self.bc.complete(" SOH"))
+        self.assertEquals([st[1]], self.bc.complete("soho", limit=1))
+        self.assertEquals([], self.bc.complete(" "))
 
     def test_find_with_geo(self):
         """ Tests boris.BikeChecker.find_with_geo """
         phillimore = {'lat': 51.4996, 'long': -0.1975, 'nbBikes': 5}
         christopher_st = {'lat': 51.5212, 'long': -0.08, 'nbBikes': 3}
-        self.bc._stations_lst = [phillimore, christopher_st]
+        stations = [phillimore, christopher_st]
+        self.bc._snapshot = boris._Snapshot(stations=stations)
         #harmless callable to stop the stations updating
         self.bc._process_stations = int 
 
@@ -149,6 +1085,297 @@ class TestBikeChecker(unittest.TestCase):
         actual = self.bc.find_with_geo(*warren, predicate=predicate)
         self.assertEquals({}, actual)
 
+    def test_find_k_nearest(self):
+        """ Tests boris.BikeChecker.find_k_nearest """
+        a = {'lat': 51.50, 'long': -0.10, 'nbBikes': 1}
+        b = {'lat': 51.51, 'long': -0.10, 'nbBikes': 7}
+        c = {'lat': 51.60, 'long': -0.10, 'nbBikes': 2}
+        self.bc._snapshot = boris._Snapshot(stations=[c, a, b])
+        self.bc._process_stations = int 
+
+        actual = self.bc.find_k_nearest(51.50, -0.10, 2)
+        self.assertEquals([a, b], [x['station'] for x in actual])
+        self.assertEquals(0.0, actual[0]['distance'])
+
+        predicate = lambda x: x['nbBikes'] < 5
+        actual = self.bc.find_k_nearest(51.50, -0.10, 5, predicate=predicate)
+        self.assertEquals([a, c], [x['station'] for x in actual])
+        self.assertEquals([], self.bc.find_k_nearest(51.50, -0.10, 0))
+        self.assertRaises(IllegalPointException, self.bc.find_k_nearest, 
+                          91, 0, 1)
+
+    def test_find_within(self):
+        """ Tests boris.BikeChecker.find_within """
+        a = {'lat': 51.50, 'long': -0.10}
+        b = {'lat': 51.51, 'long': -0.10}
+        c = {'lat': 51.60, 'long': -0.10}
+        self.bc._snapshot = boris._Snapshot(stations=[c, b, a])
+        self.bc._process_stations = int 
+
+        actual = self.bc.find_within(51.50, -0.10, 2.0)
+        self.assertEquals([a, b], [x['station'] for x in actual])
+        self.assertEquals([], self.bc.find_within(52.5, -0.10, 2.0))
+
+    def test_spatial_index_matches_linear_scan(self):
+        """ Tests boris._SpatialIndex agrees with a haversine scan """
+        rand = random.Random(42)
+        stations = [{'lat': rand.uniform(51.4, 51.6), 
+                     'long': rand.uniform(-0.3, 0.1)} for _ in range(500)]
+        stations.append({'lat': 200.0, 'long': 0.0})
+        index = boris._SpatialIndex(stations)
+        for _ in range(20):
+            point = (rand.uniform(51.3, 51.7), rand.uniform(-0.4, 0.2))
+            expected = sorted((boris._haversine(point, (s['lat'], s['long'])), 
+                               pos) for pos, s in enumerate(stations[:-1]))
+            actual = list(index.nearest(*point))
+            self.assertEquals(expected, actual)
+
+    def test_grid_index_matches_linear_scan(self):
+        """ Tests boris._GridIndex agrees with a linear scan """
+        rand = random.Random(3)
+        stations = [{'lat': rand.uniform(51.4, 51.6), 
+                     'long': rand.uniform(-0.3, 0.1)} for _ in range(500)]
+        stations.append({'lat': None, 'long': None})
+        grid = boris._GridIndex(stations)
+        for _ in range(20):
+            south, north = sorted(rand.uniform(51.3, 51.7) for _ in 'sn')
+            west, east = sorted(rand.uniform(-0.4, 0.2) for _ in 'we')
+            expected = [pos for pos, s in enumerate(stations[:-1]) 
+                        if south <= s['lat'] <= north and 
+                           west <= s['long'] <= east]
+            self.assertEquals(expected, grid.in_bbox(south, west, 
+                                                     north, east))
+        triangle = ((51.4, -0.3), (51.6, -0.1), (51.4, 0.1))
+        expected = [pos for pos, s in enumerate(stations[:-1]) 
+                    if boris._in_polygon(s['lat'], s['long'], triangle)]
+        self.assertEquals(expected, grid.in_polygon(triangle))
+        self.assertTrue(0 < len(expected) < 500)
+
+        grid = boris._GridIndex([{'lat': 0.0, 'long': 179.5}, 
+                                 {'lat': 0.0, 'long': 0.0}, 
+                                 {'lat': 0.0, 'long': -179.5}])
+        self.assertEquals([0, 2], grid.in_bbox(-1, 179, 1, -179))
+
+    def test_find_in_bbox_and_polygon(self):
+        """ Tests boris.BikeChecker.find_in_bbox and find_in_polygon """
+        a = {'lat': 51.50, 'long': -0.10, 'nbBikes': 1}
+        b = {'lat': 51.51, 'long': -0.12, 'nbBikes': 7}
+        c = {'lat': 51.60, 'long': -0.10, 'nbBikes': 2}
+        self.bc._snapshot = boris._Snapshot(stations=[c, a, b])
+        self.bc._process_stations = int 
+
+        self.assertEquals([a, b], self.bc.find_in_bbox(51.4, -0.2, 51.55, 0))
+        self.assertEquals([b], self.bc.find_in_bbox(51.4, -0.2, 51.55, 0, 
+                           predicate=boris.Filter(min_bikes=5)))
+        self.assertRaises(IllegalPointException, self.bc.find_in_bbox, 
+                          51.6, -0.2, 51.5, 0)
+        self.assertRaises(IllegalPointException, self.bc.find_in_bbox, 
+                          51.4, -0.2, 91, 0)
+
+        square = [(51.45, -0.11), (51.55, -0.11), (51.55, -0.09), 
+                  (51.45, -0.09)]
+        self.assertEquals([a], self.bc.find_in_polygon(square))
+        self.assertRaises(IllegalPointException, self.bc.find_in_polygon, 
+                          square[:2])
+
+    def test_area_totals(self):
+        """ Tests boris.BikeChecker.area_totals """
+        a = {'lat': 51.50, 'long': -0.10, 'nbBikes': 1, 'nbDocks': 10}
+        b = {'lat': 51.51, 'long': -0.12, 'nbBikes': 7, 'nbDocks': None}
+        c = {'lat': 51.60, 'long': -0.10, 'nbBikes': 2, 'nbDocks': 5}
+        self.bc._snapshot = boris._Snapshot(stations=[c, a, b])
+        self.bc._process_stations = int 
+        self.bc.add_area('centre', [(51.4, -0.2), (51.55, -0.2), 
+                                    (51.55, 0), (51.4, 0)])
+        self.bc.add_area('north', [(51.55, -0.2), (51.7, -0.1), 
+                                   (51.55, 0)])
+
+        expected = {'stations': 2, 'nbBikes': 8, 'nbEmptyDocks': 0, 
+                    'nbDocks': 10}
+        self.assertEquals(expected, self.bc.area_totals('centre'))
+        self.assertEquals(['centre', 'north'], 
+                          list(self.bc.area_totals()))
+        self.assertEquals(1, self.bc.area_totals()['north']['stations'])
+        self.assertRaises(KeyError, self.bc.area_totals, 'south')
+
+        self.bc.remove_area('north')
+        self.assertEquals(['centre'], list(self.bc.area_totals()))
+
+    def test_find_with_geo_batch(self):
+        """ Tests boris.BikeChecker.find_with_geo_batch """
+        rand = random.Random(7)
+        stations = [{'lat': rand.uniform(51.4, 51.6), 
+                     'long': rand.uniform(-0.3, 0.1),
+                     'nbBikes': rand.randint(0, 10)} for _ in range(200)]
+        self.bc._snapshot = boris._Snapshot(stations=stations)
+        self.bc._process_stations = int 
+        points = [(rand.uniform(51.3, 51.7), rand.uniform(-0.4, 0.2)) 
+                  for _ in range(50)]
+        predicate = lambda x: x['nbBikes'] > 3
+        expected = [self.bc.find_k_nearest(lat, lng, 3, predicate=predicate) 
+                    for lat, lng in points]
+
+        with patch('boris.BATCH_CHUNK_SIZE', 1000):
+            actual = self.bc.find_with_geo_batch(points, predicate, k=3)
+        self.assertEquals(expected, actual)
+
+        with patch('boris.numpy', None):
+            actual = self.bc.find_with_geo_batch(points, predicate, k=3)
+        self.assertEquals(expected, actual)
+
+        self.assertRaises(IllegalPointException, self.bc.find_with_geo_batch, 
+                          [(0, 0), (0, 181)])
+
+        f = boris.Filter(min_bikes=4)
+        self.assertEquals(expected, self.bc.find_with_geo_batch(points, f, 3))
+        self.assertEquals(expected[0], self.bc.find_k_nearest(*points[0], 
+                                                              k=3, 
+                                                              predicate=f))
+
+    def test_find_journey(self):
+        """ Tests boris.BikeChecker.find_journey and find_journey_batch """
+        rand = random.Random(11)
+        stations = []
+        for _ in range(200):
+            docks = rand.randint(0, 10)
+            bikes = rand.randint(0, docks)
+            stations.append({'lat': rand.uniform(51.4, 51.6), 
+                             'long': rand.uniform(-0.3, 0.1), 
+                             'nbBikes': bikes, 'nbEmptyDocks': docks - bikes})
+        self.bc._snapshot = boris._Snapshot(stations=stations)
+        self.bc._process_stations = int 
+        point = lambda: (rand.uniform(51.4, 51.6), rand.uniform(-0.3, 0.1))
+        journeys = [(point(), point()) for _ in range(20)]
+        journeys.append((journeys[0][0], journeys[0][0]))
+
+        def brute_force(origin, destination, k):
+            pairs = []
+            for start, s in enumerate(stations):
+                if s['nbBikes'] < 2:
+                    continue
+                for end, e in enumerate(stations):
+                    if e['nbEmptyDocks'] < 3 or start == end:
+                        continue
+                    to = boris._haversine(origin, (s['lat'], s['long']))
+                    away = boris._haversine(destination, 
+                                            (e['lat'], e['long']))
+                    pairs.append((to + away, start, end))
+            return [(start, end) for _, start, end in sorted(pairs)[:k]]
+
+        expected = [brute_force(o, d, 3) for o, d in journeys]
+        index = lambda s: stations.index(s)
+        for found in (self.bc.find_journey_batch(journeys, 2, 3, k=3), 
+                      [self.bc.find_journey(o, d, 2, 3, k=3) 
+                       for o, d in journeys]):
+            actual = [[(index(j['pickup']['station']), 
+                        index(j['dropoff']['station'])) for j in results] 
+                      for results in found]
+            self.assertEquals(expected, actual)
+
+        journey = self.bc.find_journey(*journeys[0], min_bikes=2, 
+                                       min_docks=3)[0]
+        pickup, dropoff = journey['pickup'], journey['dropoff']
+        self.assertAlmostEquals(pickup['distance'] + dropoff['distance'], 
+                                journey['distance'])
+        self.assertAlmostEquals(boris._haversine(
+            (pickup['station']['lat'], pickup['station']['long']), 
+            (dropoff['station']['lat'], dropoff['station']['long'])), 
+            journey['ride'])
+        self.assertEquals([], self.bc.find_journey(*journeys[0], k=0))
+        self.assertRaises(IllegalPointException, self.bc.find_journey, 
+                          (0, 0), (91, 0))
+
+    def test_conditional_fetch(self):
+        """ Tests boris.BikeChecker only re-parses a modified feed """
+        server = FeedServer()
+        self.addCleanup(server.stop)
+        bc = BikeChecker(endpoint=server.url)
+        self.addCleanup(bc.close)
+        self.assertIsNone(bc.fetch_stats)
+
+        bc._process_stations()
+        snapshot = bc._snapshot
+        self.assertEquals(3, snapshot.stations[0]['nbBikes'])
+        self.assertNotIn('If-None-Match', server.requests[0])
+
+        with patch('boris._parse_stations') as parse_mock:
+            bc._process_stations()
+            self.assertFalse(parse_mock.called)
+        self.assertIs(snapshot, bc._snapshot)
+        self.assertIn('if-none-match', server.requests[1])
+        self.assertIn('if-modified-since', server.requests[1])
+
+        server.feed = FEED.replace('<nbBikes>3', '<nbBikes>4')
+        bc._process_stations()
+        self.assertEquals(4, bc._snapshot.stations[0]['nbBikes'])
+
+        stats = bc.fetch_stats
+        self.assertEquals(1, server.connections)
+        self.assertEquals(3, stats['requests'])
+        self.assertEquals(1, stats['not_modified'])
+        self.assertEquals(len(server.feed), stats['last_bytes'])
+        self.assertEquals(len(FEED) + len(server.feed), stats['bytes'])
+        self.assertLessEqual(stats['last_fetch_time'], 
+                             stats['total_fetch_time'])
+
+    def test_conditional_fetch_after_bad_feed(self):
+        """ Tests a feed that couldn't be read isn't treated as current """
+        server = FeedServer('<stations lastUpdate="1"/>')
+        self.addCleanup(server.stop)
+        bc = BikeChecker(endpoint=server.url)
+        self.addCleanup(bc.close)
+        self.assertRaises(InvalidDataException, bc._process_stations)
+        self.assertRaises(InvalidDataException, bc._process_stations)
+        self.assertNotIn('if-none-match', server.requests[1])
+
+        server.feed = FEED
+        bc._process_stations()
+        self.assertNotIn('if-none-match', server.requests[2])
+        self.assertEquals(3, bc._snapshot.stations[0]['nbBikes'])
+
+    def test_fetch_redirects(self):
+        """ Tests only permanent redirects move the feed """
+        server = FeedServer()
+        self.addCleanup(server.stop)
+        redirects = {'/moved': (301, '/a/temp'), '/a/temp': (302, 'feed.xml'), 
+                     '/temp': (307, '/feed.xml')}
+        paths = []
+        serve = FeedHandler.do_GET
+        def do_GET(handler):
+            paths.append(handler.path)
+            if handler.path not in redirects:
+                return serve(handler)
+            status, location = redirects[handler.path]
+            handler.send_response(status)
+            handler.send_header('Location', location)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+
+        base = server.url.rsplit('/', 1)[0]
+        with patch.object(FeedHandler, 'do_GET', do_GET):
+            fetcher = boris._FeedFetcher(base + '/moved')
+            self.addCleanup(fetcher.close)
+            self.assertEquals(FEED, fetcher.fetch())
+            self.assertEquals(FEED, fetcher.fetch())
+            fetcher = boris._FeedFetcher(base + '/temp')
+            self.addCleanup(fetcher.close)
+            fetcher.fetch()
+            fetcher.fetch()
+        self.assertEquals(['/moved', '/a/temp', '/a/feed.xml', 
+                           '/a/temp', '/a/feed.xml', 
+                           '/temp', '/feed.xml', '/temp', '/feed.xml'], paths)
+
+    def test_fetch_errors(self):
+        """ Tests boris.BikeChecker surfaces failed feed requests """
+        server = FeedServer()
+        self.addCleanup(server.stop)
+        bc = BikeChecker(endpoint=server.url)
+        self.addCleanup(bc.close)
+        with patch.object(FeedHandler, 'do_GET', 
+                          lambda h: h.send_error(404)):
+            self.assertRaises(boris.StationDataException, 
+                              bc._process_stations)
+
     def test_find_with_postcode_errors(self):
         """ Tests boris.BikeChecker.find_with_postcode exceptions """
         get_mock = Mock(return_value=None)
@@ -156,22 +1383,82 @@ class TestBikeChecker(unittest.TestCase):
                                new=Mock(get=get_mock))
         patcher.start()
         f = self.bc.find_with_postcode
-        self.assertRaises(InvalidPostcodeException, f, None)
+        self.assertRaises(InvalidPostcodeException, f, "a1")
         get_mock.return_value = {'foo': 'bar'}
-        self.assertRaises(InvalidDataException, f, None)
+        self.assertRaises(InvalidDataException, f, "a2")
         get_mock.return_value = {'geo': {'lat':0}}
-        self.assertRaises(InvalidDataException, f, None)
+        self.assertRaises(InvalidDataException, f, "a3")
         patcher.stop()
 
+    def test_locate_postcode_cache(self):
+        """ Tests boris.BikeChecker.locate_postcode caches lookups """
+        self.bc.pc.get = Mock(return_value={'geo': {'lat': 1, 'lng': 2}})
+        self.assertEquals((1.0, 2.0), self.bc.locate_postcode("ab1 2cd"))
+        self.assertEquals((1.0, 2.0), self.bc.locate_postcode(" AB12CD"))
+        self.assertEquals(1, self.bc.pc.get.call_count)
+
+        self.bc.pc.get.return_value = None
+        f = self.bc.locate_postcode
+        self.assertRaises(InvalidPostcodeException, f, "zz9 9zz")
+        self.assertRaises(InvalidPostcodeException, f, "ZZ99ZZ")
+        self.assertEquals(2, self.bc.pc.get.call_count)
+        stats = self.bc.postcode_stats
+        self.assertEquals(2, stats['hits'])
+        self.assertEquals(2, stats['misses'])
+        self.assertEquals(2, stats['cached'])
+
+    def test_postcode_cache_expiry(self):
+        """ Tests boris._PostcodeCache evicts expired and old entries """
+        cache = boris._PostcodeCache(size=2, ttl=10, negative_ttl=1)
+        with patch('boris.time.time', return_value=0):
+            cache.put('A', (1, 2))
+            cache.put('B', None)
+            self.assertEquals((True, (1, 2)), cache.get('A'))
+            cache.put('C', (3, 4))
+        self.assertEquals(2, len(cache))
+        with patch('boris.time.time', return_value=5):
+            self.assertEquals((False, None), cache.get('B'))
+            self.assertEquals((True, (1, 2)), cache.get('A'))
+        with patch('boris.time.time', return_value=11):
+            self.assertEquals((False, None), cache.get('C'))
+
+    def test_load_postcode_centroids(self):
+        """ Tests boris.BikeChecker.load_postcode_centroids """
+        f = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        self.addCleanup(os.remove, f.name)
+        f.write("postcode,lat,lng\nEC2A 1AD,51.52,-0.08\nbad,1,999\n")
+        f.close()
+        self.bc.pc.get = Mock(return_value={'geo': {'lat': 1, 'lng': 2}})
+        self.bc.load_postcode_centroids(f.name)
+        self.assertEquals((51.52, -0.08), self.bc.locate_postcode("ec2a1ad"))
+        self.assertEquals((1.0, 2.0), self.bc.locate_postcode("bad"))
+        self.assertEquals(1, self.bc.postcode_stats['centroid_hits'])
+
+        self.bc.load_postcode_centroids(f.name, remote_fallback=False)
+        self.assertRaises(InvalidPostcodeException, 
+                          self.bc.locate_postcode, "N1 1AA")
+        self.assertEquals(1, self.bc.pc.get.call_count)
+
     def test_find_with_postcode(self):
         """ Tests boris.BikeChecker.find_with_postcode """
         self.bc.pc.get = Mock(return_value={'geo': {'lat':1, 'lng': 2}})
-        self.bc.find_with_geo = Mock()
-        self.bc.find_with_postcode("abc 123")
+        self.bc._k_nearest = Mock(return_value=[])
+        self.assertEquals({}, self.bc.find_with_postcode("abc 123"))
         p = lambda x: True
         self.bc.find_with_postcode("abc 123", predicate=p)
-        self.bc.find_with_geo.assert_has_calls([call(1, 2, predicate=None), 
-                                                call(1, 2, predicate=p)])
+        snapshot = self.bc._snapshot
+        self.bc._k_nearest.assert_has_calls([call(snapshot, 1, 2, 1, None), 
+                                             call(snapshot, 1, 2, 1, p)])
+
+        # each search is a single query, with a single check of the cache
+        events = []
+        self.bc.add_hook(lambda event, seconds: events.append(event))
+        before = self.bc.stats()
+        self.bc.find_with_postcode("abc 123")
+        after = self.bc.stats()
+        self.assertEquals(['query.find_with_postcode'], events)
+        self.assertEquals(1, after['cache_hits'] + after['cache_misses'] - 
+                          before['cache_hits'] - before['cache_misses'])
 
 
 
@@ -0,0 +1,159 @@
+import unittest
+import datetime
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from StringIO import StringIO
+
+from mock import patch, Mock
+
+import boris
+from boris import BikeChecker, InvalidPostcodeException
+from test_boris import FEED
+
+# keep the module's checker away from the user's own cache of station data
+_CACHE_DIR = tempfile.mkdtemp()
+os.environ['BORIS_CACHE'] = os.path.join(_CACHE_DIR, 'stations')
+import client
+del os.environ['BORIS_CACHE']
+shutil.rmtree(_CACHE_DIR)
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        now = boris._time_ms(datetime.datetime.utcnow())
+        checker = BikeChecker(endpoint=StringIO(FEED.replace('1353300000000', 
+                                                             '%d' % now)))
+        patcher = patch.object(client, 'bc', checker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _serve(self, address):
+        server = client.make_server(address)
+        thread = threading.Thread(target=server.serve_forever, 
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_forward(self):
+        """ Tests searches are forwarded to a running client daemon """
+        port = self._serve('localhost:0').server_address[1]
+        address = 'localhost:%d' % port
+        results, updated = client.forward([u'lodge', u'road'], 
+                                          address=address)
+        self.assertEquals(8, results[0]['id'])
+        self.assertEquals(client.bc.last_updated.replace(microsecond=0), 
+                          updated)
+        results, _ = client.forward([u'51.5', u'-0.14'], min_bikes=1, 
+                                    address=address)
+        self.assertEquals(0.0, results['distance'])
+        self.assertRaises(ValueError, client.forward, [u'1', u'2', u'3'], 
+                          address=address)
+        response = urllib2.urlopen('http://%s/stations' % address)
+        self.assertEquals('application/json', 
+                          response.info()['Content-Type'])
+        self.assertEquals(client.bc.dumps(), response.read())
+
+        path = os.path.join(tempfile.mkdtemp(), 'boris.sock')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+        self._serve(path)
+        results, _ = client.forward([u'51.5', u'-0.14'], address=path)
+        self.assertEquals(8, results['station']['id'])
+        os.remove(path)
+        self.assertIsNone(client.forward([u'soho'], address=path))
+        open(path, 'w').close()
+
+
+    def test_batch(self):
+        """ Tests client.batch_bikes answers searches in order """
+        def lookup(postcode):
+            if postcode != 'zz99zz':
+                return {'geo': {'lat': 51.5, 'lng': -0.14}}
+        client.bc.pc.get = Mock(side_effect=lookup)
+        lines = ["lodge road\n", "51.5,-0.14", "\n", "EC2A 1AD", "ec2a1ad", 
+                 "zz99zz", "1 2 3", "51.5 -0.14"]
+        answers = list(client.batch_bikes(lines, min_bikes=1))
+        self.assertEquals([u'lodge road', u'51.5,-0.14', u'EC2A 1AD', 
+                           u'ec2a1ad', u'zz99zz', u'1 2 3', u'51.5 -0.14'], 
+                          [search for search, _, _ in answers])
+        self.assertEquals(8, answers[0][1][0]['id'])
+        for i in (1, 2, 3, 6):
+            self.assertEquals((8, None), (answers[i][1]['station']['id'], 
+                                          answers[i][2]))
+        self.assertIsInstance(answers[4][2], InvalidPostcodeException)
+        self.assertIsInstance(answers[5][2], ValueError)
+        self.assertEquals(2, client.bc.pc.get.call_count)
+
+        # invalid points are reported individually
+        answers = list(client.batch_bikes(["91 0", "51.5 -0.14"]))
+        self.assertIsInstance(answers[0][2], ValueError)
+        self.assertEquals(0.0, answers[1][1]['distance'])
+
+    def test_forward_errors(self):
+        """ Tests daemon failures are reported rather than crashing """
+        client.bc._process_stations = Mock(
+            side_effect=boris.InvalidDataException("No Station data"))
+        client.bc._snapshot = boris._Snapshot()
+        address = 'localhost:%d' % self._serve('localhost:0').server_address[1]
+        self.assertRaisesRegexp(ValueError, 'No Station data', client.forward, 
+                                [u'soho'], address=address)
+
+        # a daemon that drops the connection is treated as not running
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        def drop():
+            conn, _ = listener.accept()
+            conn.close()
+        thread = threading.Thread(target=drop)
+        thread.daemon = True
+        thread.start()
+        address = 'localhost:%d' % listener.getsockname()[1]
+        self.assertIsNone(client.forward([u'soho'], address=address))
+
+        # as is some other service answering at the address
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write('<html></html>')
+            def log_message(self, *args):
+                pass
+        other = HTTPServer(('localhost', 0), Handler)
+        thread = threading.Thread(target=other.handle_request)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(other.server_close)
+        address = 'localhost:%d' % other.server_address[1]
+        self.assertIsNone(client.forward([u'soho'], address=address))
+
+    def test_unix_address_in_use(self):
+        """ Tests a daemon only replaces a stale unix socket """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'notes.txt')
+        open(path, 'w').close()
+        self.assertRaises(ValueError, client.make_server, path)
+        self.assertTrue(os.path.isfile(path))
+
+        path = os.path.join(directory, 'boris.sock')
+        self._serve(path)
+        self.assertRaises(ValueError, client.make_server, path)
+
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        path = os.path.join(directory, 'stale.sock')
+        stale.bind(path)
+        stale.close()
+        self._serve(path)
+        results, _ = client.forward([u'51.5', u'-0.14'], address=path)
+        self.assertEquals(8, results['station']['id'])